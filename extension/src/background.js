@@ -1,7 +1,14 @@
 let mailbox_messages = {};
+let mailboxEpoch = null;
+let mailboxVersion = null;
+// Set while we wait for a snapshot we asked for, so deltas arriving before
+// it don't each ask for another
+let snapshotPending = false;
 let socket = null;
 let currentThreadId = null;
 let sidePanelPort = null;
+// The progress of model downloads, by file name
+let downloads = {};
 
 chrome.runtime.onInstalled.addListener(() => {
   console.log('Extension installed');
@@ -14,7 +21,13 @@ chrome.runtime.onStartup.addListener(() => {
 });
 
 function connectWebSocket() {
-  socket = new WebSocket('ws://127.0.0.1:17725/ws');
+  // Resume from the last state we saw, so the server only replays what we missed
+  let url = 'ws://127.0.0.1:17725/ws';
+  if (mailboxEpoch !== null && mailboxVersion !== null) {
+    url += `?epoch=${encodeURIComponent(mailboxEpoch)}&version=${mailboxVersion}`;
+  }
+  socket = new WebSocket(url);
+  snapshotPending = false;
   
   socket.onopen = () => {
     console.log('WebSocket connection opened');
@@ -25,11 +38,38 @@ function connectWebSocket() {
     const data = JSON.parse(event.data);
     if (data.type === 'mailbox') {
       mailbox_messages = data.messages;
+      mailboxEpoch = data.epoch;
+      mailboxVersion = data.version;
+      snapshotPending = false;
       console.log('Mailbox synchronized:', mailbox_messages);
-      // Broadcast the updated mailbox messages to the side panel if it's open
-      if (sidePanelPort) {
-        sidePanelPort.postMessage({ action: 'update_mailbox', mailbox: mailbox_messages });
+      broadcastMailbox();
+    } else if (data.type === 'mailbox_delta') {
+      // The snapshot we asked for covers this delta, or deltas after it
+      // re-apply on top of it
+      if (snapshotPending) {
+        return;
+      }
+      // Versions start over with each epoch, so only compare them within one
+      const sameEpoch = data.epoch === mailboxEpoch;
+      // Ignore deltas we've already applied
+      if (sameEpoch && mailboxVersion !== null && data.version <= mailboxVersion) {
+        return;
       }
+      // If we missed a delta, our copy of the mailbox is stale, so ask for a
+      // fresh snapshot instead of applying this one
+      if (!sameEpoch || mailboxVersion === null || data.version !== mailboxVersion + 1) {
+        console.log(`Mailbox delta ${data.epoch}/${data.version} does not follow ${mailboxEpoch}/${mailboxVersion}, requesting snapshot`);
+        snapshotPending = true;
+        socket.send(JSON.stringify({ action: 'get_mailbox' }));
+        return;
+      }
+      applyMailboxChanges(data.changes);
+      mailboxVersion = data.version;
+      console.log(`Mailbox updated to version ${mailboxVersion}:`, data.changes);
+      broadcastMailbox();
+    } else if (data.type === 'download_progress') {
+      downloads = { ...downloads, [data.name]: data };
+      broadcastDownloads();
     }
   };
 
@@ -43,6 +83,32 @@ function connectWebSocket() {
   };
 }
 
+function applyMailboxChanges(changes) {
+  // Copy the mailbox so the side panel sees a new object
+  mailbox_messages = { ...mailbox_messages };
+  for (const change of changes) {
+    if (change.op === 'upsert') {
+      mailbox_messages[change.thread_id] = change.message;
+    } else if (change.op === 'delete') {
+      delete mailbox_messages[change.thread_id];
+    }
+  }
+}
+
+function broadcastMailbox() {
+  // Broadcast the updated mailbox messages to the side panel if it's open
+  if (sidePanelPort) {
+    sidePanelPort.postMessage({ action: 'update_mailbox', mailbox: mailbox_messages });
+  }
+}
+
+function broadcastDownloads() {
+  // Broadcast the download progress to the side panel if it's open
+  if (sidePanelPort) {
+    sidePanelPort.postMessage({ action: 'update_downloads', downloads: downloads });
+  }
+}
+
 chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   console.log("Message received in background script:", message);
 
@@ -91,6 +157,7 @@ chrome.runtime.onConnect.addListener((port) => {
     // Send the current mailbox state when the side panel connects
     console.log('Sending mailbox to side panel:', mailbox_messages);
     sidePanelPort.postMessage({ action: 'update_mailbox', mailbox: mailbox_messages });
+    sidePanelPort.postMessage({ action: 'update_downloads', downloads: downloads });
 
     port.onMessage.addListener((msg) => {
       console.log('Message received in background script:', msg);
@@ -10,6 +10,8 @@ document.addEventListener('DOMContentLoaded', () => {
         } else if (message.action === 'update_mailbox') {
             console.log('Updating mailbox:', message.mailbox);
             document.dispatchEvent(new CustomEvent('setMailbox', { detail: message.mailbox }));
+        } else if (message.action === 'update_downloads') {
+            document.dispatchEvent(new CustomEvent('setDownloads', { detail: message.downloads }));
         }
     });
 });
@@ -21,6 +23,7 @@ document.addEventListener('alpine:init', () => {
         messageType: 'Unknown',
         mailbox: {},
         selectedFunctions: [],
+        downloadStatus: '',
         init() {
             document.addEventListener('setThreadId', (event) => {
                 this.setThreadId(event.detail);
@@ -28,6 +31,9 @@ document.addEventListener('alpine:init', () => {
             document.addEventListener('setMailbox', (event) => {
                 this.setMailbox(event.detail);
             });
+            document.addEventListener('setDownloads', (event) => {
+                this.setDownloads(event.detail);
+            });
         },
         setThreadId(newThreadId) {
             console.log('Setting thread ID to:', newThreadId);
@@ -38,6 +44,22 @@ document.addEventListener('alpine:init', () => {
             this.mailbox = newMailbox;
             this.updateDetails(this.threadId);
         },
+        setDownloads(downloads) {
+            // Show the downloads which haven't finished yet, like the models
+            // on first run
+            this.downloadStatus = Object.values(downloads)
+                .filter((download) => download.status !== 'complete')
+                .map((download) => {
+                    if (download.status === 'failed') {
+                        return `Downloading ${download.name} failed`;
+                    } else if (download.status === 'verifying') {
+                        return `Verifying ${download.name}...`;
+                    }
+                    const percent = download.total ? ` ${Math.floor(100 * download.downloaded / download.total)}%` : '';
+                    return `Downloading ${download.name}...${percent}`;
+                })
+                .join('\n');
+        },
         updateDetails(threadId) {
             const messageDetails = this.mailbox[threadId];
             this.summary = messageDetails ? messageDetails.summary : 'No summary available.';
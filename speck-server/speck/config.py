@@ -1,11 +1,13 @@
 import os
 from jinja2 import ChoiceLoader, Environment, FileSystemLoader, select_autoescape
 import platform
+from pydantic import BaseModel, model_validator
 from pydantic_settings import BaseSettings
 from sqlalchemy import event
 from sqlmodel import Session, create_engine
 import sqlite_vec
 import sys
+from typing import Literal, Optional
 
 
 # Determine our base directory based on whether we're packaged in PyInstaller or not
@@ -17,6 +19,19 @@ else:
     BASE_DIR: str = os.path.dirname(os.path.abspath(__file__))
 
 
+class RecurringTask(BaseModel):
+    """A task the scheduler queues periodically. Give one of interval, cron or interval_policy."""
+    task: str  # Dotted path, like 'emails.tasks.sync_inbox'
+    interval: Optional[float] = None  # Seconds between runs, and the fallback if interval_policy fails
+    cron: Optional[str] = None  # Cron expression, like '*/15 * * * *'
+    interval_policy: Optional[str] = None  # Dotted path of a function returning (seconds until the next run, reason)
+    jitter: float = 0  # Up to this many seconds are randomly added to each wait
+    skip_if_running: bool = True  # Don't queue another run while the last one is queued or running
+    timeout: Optional[float] = None  # Seconds each run may take, see TaskManager.add_task()
+    args: tuple = ()
+    kwargs: dict = {}
+
+
 class Settings(BaseSettings):
     app_name: str = 'Speck' if PACKAGED else 'Speck (dev)'
     os_name: str = platform.system()
@@ -31,19 +46,93 @@ class Settings(BaseSettings):
     # Database
     database_url: str = f'sqlite:///{os.path.join(speck_data_dir, "speck.db")}'
 
+    # With the 'split' layout, blobs and embeddings live in their own database
+    # files ATTACHed to the main one, so bulk blob and vector writes don't
+    # hold the hot metadata database's write lock or churn its page cache
+    database_layout: Literal['single', 'split'] = 'single'
+    blob_database_path: str = os.path.join(speck_data_dir, 'speck-blobs.db')
+    vector_database_path: str = os.path.join(speck_data_dir, 'speck-vectors.db')
+    # Each database's pragmas in the split layout. The single layout keeps
+    # SQLite's defaults, as it always has.
+    database_pragmas: dict[str, dict[str, str]] = {
+        'main': {'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': '-32000'},
+        'blobs': {'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': '-2000'},
+        'vectors': {'journal_mode': 'wal', 'synchronous': 'normal', 'cache_size': '-16000'},
+    }
+
+    # Cache
+    cache_backend: Literal['sqlite', 'manager'] = 'sqlite'  # manager is the old multiprocessing Manager dict
+    cache_database_path: str = os.path.join(speck_data_dir, 'cache.db')
+    cache_max_bytes: int = 64 * 1024 * 1024  # Least recently used entries past this are evicted, sqlite backend only
+
     # Task manager
     task_manager_log_file: str = os.path.join(log_dir, 'worker.log') if PACKAGED else ''
-    recurring_tasks: list[tuple[str, int, tuple, dict]] = [
-        ('emails.tasks.sync_inbox', 60, (), {})  # (task, interval in seconds, args, kwargs)
+    task_queue_database_path: str = os.path.join(speck_data_dir, 'tasks.db')
+    task_visibility_timeout: float = 60  # Seconds a claimed task stays claimed if its worker stops heartbeating
+    task_max_attempts: int = 3  # Attempts before a failing task is dead-lettered
+    task_retry_backoff: float = 5  # Seconds before a failed task's first retry, doubling each time
+    task_claim_batch_size: int = 4  # Tasks a worker claims at once
+    task_history_size: int = 1000  # Finished and cancelled tasks kept for the /tasks stats
+    worker_task_concurrency: int = 16  # Tasks a worker runs at once, async tasks on its event loop
+    worker_sync_threads: int = 1  # Threads a worker runs sync tasks on
+    task_cancel_grace_period: float = 15  # Seconds a timed out or cancelled task has to stop before its worker is killed
+    process_message_timeout: float = 900  # Seconds processing a message with the LLM may take
+    generate_embedding_timeout: float = 300
+    execute_function_timeout: float = 300  # Seconds a library function's browser automation may take
+
+    # Worker pool
+    worker_start_method: Optional[Literal['spawn', 'forkserver']] = None  # Defaults to forkserver on Linux and spawn elsewhere
+    min_workers: int = 1
+    max_workers: int = 4
+    worker_autoscale_interval: float = 5  # Seconds between checks of whether to resize the pool
+    worker_scale_up_wait: float = 10  # Add a worker once a queued task has waited this long
+    worker_idle_timeout: float = 60  # Retire a worker once the queue has been empty this long
+    worker_min_available_memory: int = 1024 * 1024 * 1024  # Don't add workers with less free memory than this
+    worker_max_llm_cpu_percent: float = 80  # Don't add workers while llamafile uses more of the CPU than this
+    recurring_tasks: list[RecurringTask] = [
+        RecurringTask(task='emails.tasks.sync_inbox', interval=60, interval_policy='emails.sync.get_sync_interval', jitter=5, timeout=600),
     ]
 
+    # Inbox sync
+    sync_interval: float = 60  # Between syncs while the mailbox is changing
+    sync_interval_active: float = 15  # While the user is active
+    sync_interval_max: float = 600  # Quiet mailboxes back off up to this
+    sync_active_window: float = 300  # Seconds the user counts as active after connecting or running a function
+
+    # API server
+    server_workers: int = 1  # More than one relays worker events through the event broker
+
+    # Event system
+    mailbox_change_log_size: int = 1000  # Deltas kept for replaying to reconnecting clients
+    event_send_queue_size: int = 100  # Events buffered per websocket before it counts as a slow consumer
+    event_slow_consumer_policy: Literal['snapshot', 'disconnect'] = 'snapshot'
+    event_coalesce_delay: float = 0.25  # Seconds of quiet before a burst of task completions is pushed
+    event_coalesce_max_delay: float = 2.0  # Longest a burst can hold back a push
+
+    # Email bodies
+    body_extractor: Literal['auto', 'selectolax', 'lxml', 'html2text'] = 'auto'  # auto picks the fastest one installed
+    body_max_html_chars: int = 500_000  # Longer HTML is truncated before conversion
+    body_extraction_processes: int = 2  # Size of the process pool used during sync, capped at the CPU count. Below 2 converts in the worker itself
+
     # Playwright
     playwright_browsers_dir: str = os.path.join(speck_data_dir, 'browsers')
     os.makedirs(playwright_browsers_dir, exist_ok=True)
     os.environ['PLAYWRIGHT_BROWSERS_PATH'] = playwright_browsers_dir
+    browser_profiles_dir: str = os.path.join(speck_data_dir, 'browser_profiles')  # Each site's cookies and storage, so functions start logged in
+    browser_pool_size: int = 3  # Sites a worker keeps a browser open for, closing the least recently used past this
+    browser_idle_timeout: float = 600  # Seconds a site's browser stays open unused
+    function_execution_profile: Literal['production', 'demo'] = 'production'  # demo shows the browser and slows it down, see library.execution
+    function_traces_dir: str = os.path.join(log_dir, 'traces')  # Playwright traces of function runs, open with "playwright show-trace"
+    function_traces_kept: int = 20
 
     # Model server
     models_dir: str = os.path.join(speck_data_dir, 'models')
+    embedding_model_url: str = 'https://huggingface.co/mixedbread-ai/mxbai-embed-large-v1/resolve/main/gguf/mxbai-embed-large-v1-f16.gguf?download=true'
+    embedding_model_sha256: Optional[str] = None  # Pinned digest, otherwise the one Hugging Face reports is checked
+    completion_model_url: str = 'https://huggingface.co/bartowski/gemma-2-9b-it-GGUF/resolve/main/gemma-2-9b-it-Q5_K_M.gguf?download=true'
+    completion_model_sha256: Optional[str] = None
+    download_connections: int = 4  # Ranged requests a model downloads over at once
+    download_chunk_size: int = 32 * 1024 * 1024  # Bytes per ranged request, and the unit an interrupted download resumes from
 
     llamafile_exe_path: str = os.path.join(BASE_DIR, 'llamafile')
     # Append a ".exe" extension if on Windows
@@ -63,6 +152,14 @@ class Settings(BaseSettings):
         'https://www.googleapis.com/auth/gmail.modify'
     ]
 
+    @model_validator(mode='after')
+    def check_cache_backend(self):
+        # Only the main process has the Manager, so the extra server
+        # processes couldn't open the cache
+        if self.cache_backend == 'manager' and self.server_workers > 1:
+            raise ValueError("The manager cache backend only works with one server worker, use the sqlite backend")
+        return self
+
 settings = Settings()
 
 # Make sure the data and log directories exist
@@ -70,19 +167,50 @@ os.makedirs(settings.speck_data_dir, exist_ok=True)
 os.makedirs(settings.log_dir, exist_ok=True)
 
 # SQLModel
-db_engine = create_engine(settings.database_url)
+base_db_engine = create_engine(settings.database_url)
+
+# Tables in the blob and vector databases declare a 'blobs' or 'vectors'
+# schema. In the single layout those schemas map back onto the main database.
+DATABASE_SCHEMAS = {
+    'blobs': settings.blob_database_path,
+    'vectors': settings.vector_database_path,
+}
+if settings.database_layout == 'split':
+    db_engine = base_db_engine
+else:
+    db_engine = base_db_engine.execution_options(
+        schema_translate_map={schema: None for schema in DATABASE_SCHEMAS}
+    )
 
 def get_db_session():
     with Session(db_engine) as session:
         yield session
 
-# Enable sqlite-vec for embedding storage
-@event.listens_for(db_engine, 'connect')
+def qualify_table(schema: str, table: str):
+    """A table's name for use in raw SQL, which the schema translate map doesn't reach."""
+    if settings.database_layout == 'split':
+        return f'{schema}.{table}'
+    return table
+
+@event.listens_for(base_db_engine, 'connect')
 def on_connect(connection, _):
+    # Enable sqlite-vec for embedding storage
     connection.enable_load_extension(True)
     sqlite_vec.load(connection)
     connection.enable_load_extension(False)
 
+    if settings.database_layout != 'split':
+        return
+
+    # Attach the blob and vector databases
+    for schema, path in DATABASE_SCHEMAS.items():
+        connection.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+
+    # Each database gets its own pragmas, and its own WAL
+    for schema in ['main', *DATABASE_SCHEMAS]:
+        for pragma, value in settings.database_pragmas.get(schema, {}).items():
+            connection.execute(f'PRAGMA {schema}.{pragma} = {value}')
+
 # Jinja2
 template_env = Environment(
     loader=ChoiceLoader([
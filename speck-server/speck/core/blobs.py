@@ -0,0 +1,67 @@
+import hashlib
+import zlib
+from sqlmodel import Column, Field as SQLModelField, Session, SQLModel, BLOB, select, text
+import zstandard
+
+from config import db_engine, qualify_table
+
+
+class Blob(SQLModel, table=True):
+    """
+    A compressed, content-addressed blob, like a message's raw RFC822 bytes.
+    Kept out of the tables the UI and scheduler query, so large payloads
+    don't bloat the pages those queries touch.
+    """
+    __table_args__ = {'schema': 'blobs'}
+
+    # SHA-256 of the uncompressed bytes, so identical blobs are stored once
+    digest: str = SQLModelField(primary_key=True)
+
+    codec: str
+    size: int
+    data: bytes = SQLModelField(sa_column=Column(BLOB))
+
+
+def compress(data: bytes):
+    """Compress bytes with zstd, returning (codec, compressed)."""
+    return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+
+
+def decompress(codec: str, data: bytes):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        # Blobs stored by installs which didn't have zstandard
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown blob codec: {codec}")
+
+
+def put_blob(session: Session, data: bytes):
+    """
+    Store bytes in the blob table if they aren't there already, and return
+    their digest. Doesn't commit the session.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if session.get(Blob, digest) is None:
+        codec, compressed = compress(data)
+        session.add(Blob(digest=digest, codec=codec, size=len(data), data=compressed))
+    return digest
+
+
+def get_blob(digest: str):
+    """Load and decompress a blob by its digest."""
+    with Session(db_engine) as session:
+        blob = session.exec(select(Blob).where(Blob.digest == digest)).one()
+    return decompress(blob.codec, blob.data)
+
+
+def delete_unreferenced_blobs(session: Session, referencing_columns):
+    """
+    Delete blobs which none of the given (table, column) pairs reference any
+    more. Doesn't commit the session.
+    """
+    references = ' UNION '.join(
+        f'SELECT {column} FROM {table} WHERE {column} IS NOT NULL'
+        for table, column in referencing_columns
+    )
+    session.exec(text(f'DELETE FROM {qualify_table("blobs", "blob")} WHERE digest NOT IN ({references})'))
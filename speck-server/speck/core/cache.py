@@ -1,35 +1,433 @@
+from collections import Counter
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
 
+from config import settings
 
-class SharedCache:
-    """Simple cache shared across all processes using a multiprocessing manager"""
+# Bump when the SQLite cache's tables change. It's only a cache, so an old
+# one is dropped rather than migrated.
+CACHE_SCHEMA_VERSION = 2
+
+# How stale an entry's last access time can get before a read refreshes it,
+# so LRU eviction doesn't turn every read into a write
+ACCESS_TIME_RESOLUTION = 60
+
+# How often each process adds its hit and miss counts to the shared totals
+STATS_FLUSH_INTERVAL = 5
+
+# Eviction frees space down to this fraction of the size limit, so it doesn't
+# run again on the very next write
+EVICTION_TARGET = 0.9
+
+
+def _get_expires_at(ttl: Optional[float]):
+    return time.time() + ttl if ttl is not None else None
+
+
+class BaseCache:
+    """Namespaces, single-flight computation and stats, for either backend."""
+    def __init__(self):
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def namespace(self, name: str):
+        """Get a view of the cache whose keys are prefixed with a namespace."""
+        return CacheNamespace(self, name)
+
+    def incr(self, key, delta: int = 1, ttl: Optional[float] = None, pinned: bool = False):
+        """Atomically add to a counter, which starts at 0. Returns the new value."""
+        return self.update(key, lambda value: (value or 0) + delta, ttl, pinned)
+
+    def get_or_compute(self, key, compute: Callable[[], Any], ttl: Optional[float] = None, lock_timeout: float = 60):
+        """
+        Get a key's value, computing and caching it if it isn't set. Only one
+        thread or process computes a missing value at a time, the others wait
+        for its result. compute() must not return None, which means unset.
+
+        If the computing process dies, its lock expires after lock_timeout
+        seconds and another one takes over.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        lock_key = f'{key}#computing'
+        delay = 0.01
+        while True:
+            if self.add(lock_key, os.getpid(), ttl=lock_timeout):
+                try:
+                    # Someone may have finished computing it while we waited
+                    value = self._peek(key)
+                    if value is None:
+                        value = compute()
+                        self.set(key, value, ttl=ttl)
+                    return value
+                finally:
+                    try:
+                        self.delete(lock_key)
+                    except KeyError:
+                        pass
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+            value = self._peek(key)
+            if value is not None:
+                return value
+
+
+class CacheNamespace:
+    """A view of the cache whose keys are all prefixed with a namespace."""
+    def __init__(self, cache: BaseCache, name: str):
+        self.cache = cache
+        self.prefix = f'{name}:'
+
+    def get(self, key):
+        return self.cache.get(self.prefix + key)
+
+    def set(self, key, value, ttl: Optional[float] = None, pinned: bool = False):
+        self.cache.set(self.prefix + key, value, ttl=ttl, pinned=pinned)
+
+    def delete(self, key):
+        self.cache.delete(self.prefix + key)
+
+    def add(self, key, value, ttl: Optional[float] = None):
+        return self.cache.add(self.prefix + key, value, ttl=ttl)
+
+    def update(self, key, function: Callable[[Any], Any], ttl: Optional[float] = None, pinned: bool = False):
+        return self.cache.update(self.prefix + key, function, ttl=ttl, pinned=pinned)
+
+    def incr(self, key, delta: int = 1, ttl: Optional[float] = None, pinned: bool = False):
+        return self.cache.incr(self.prefix + key, delta, ttl=ttl, pinned=pinned)
+
+    def get_or_compute(self, key, compute: Callable[[], Any], ttl: Optional[float] = None, lock_timeout: float = 60):
+        return self.cache.get_or_compute(self.prefix + key, compute, ttl=ttl, lock_timeout=lock_timeout)
+
+    def clear(self):
+        """Delete every key in the namespace."""
+        self.cache._clear_prefix(self.prefix)
+
+
+class SharedCache(BaseCache):
+    """
+    Simple cache shared across all processes using a multiprocessing manager.
+    Unbounded, it doesn't evict anything, and its stats are per process.
+    """
     def __init__(self, cache_manager_dict, cache_manager_lock):
+        super().__init__()
         self.cache = cache_manager_dict
         self.lock = cache_manager_lock
 
-    def get(self, key):
+    def _get_live(self, key):
+        # Entries are (value, expires_at) tuples
+        entry = self.cache.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return None
+        return entry
+
+    def _peek(self, key):
         with self.lock:
-            return self.cache.get(key)
+            entry = self._get_live(key)
+            return entry[0] if entry else None
+
+    def get(self, key):
+        value = self._peek(key)
+        self._count('hits' if value is not None else 'misses')
+        return value
 
-    def set(self, key, value):
+    def set(self, key, value, ttl: Optional[float] = None, pinned: bool = False):
         with self.lock:
-            self.cache[key] = value
+            self.cache[key] = (value, _get_expires_at(ttl))
 
     def delete(self, key):
         with self.lock:
+            if self._get_live(key) is None:
+                self.cache.pop(key, None)
+                raise KeyError(key)
             del self.cache[key]
 
+    def add(self, key, value, ttl: Optional[float] = None):
+        """Set a key only if it isn't set already. Returns whether it was set."""
+        with self.lock:
+            if self._get_live(key) is not None:
+                return False
+            self.cache[key] = (value, _get_expires_at(ttl))
+            return True
+
+    def update(self, key, function: Callable[[Any], Any], ttl: Optional[float] = None, pinned: bool = False):
+        """
+        Atomically replace a key's value with function(value), where value is
+        None if the key isn't set. Returns the new value.
+        """
+        with self.lock:
+            entry = self._get_live(key)
+            value = function(entry[0] if entry else None)
+            self.cache[key] = (value, _get_expires_at(ttl))
+            return value
+
+    def _clear_prefix(self, prefix: str):
+        with self.lock:
+            for key in [key for key in self.cache.keys() if key.startswith(prefix)]:
+                del self.cache[key]
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        return {
+            'hits': stats.get('hits', 0),
+            'misses': stats.get('misses', 0),
+            'evictions': 0,
+            'entries': len(self.cache),
+            'bytes': None,
+        }
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache shared across processes through a key-value table in its own WAL
+    mode SQLite database. Each process reads the database directly, instead
+    of making round trips to a manager process, and server processes spawned
+    by uvicorn can open it too. Values are pickled.
+
+    When the pickled values pass max_bytes, the least recently used entries
+    which aren't pinned are evicted, expired ones first.
+    """
+    def __init__(self, path: str, max_bytes: Optional[int] = None):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._stats_flushed_at = time.monotonic()
+
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if connection.execute('PRAGMA user_version').fetchall()[0][0] != CACHE_SCHEMA_VERSION:
+                connection.execute('DROP TABLE IF EXISTS cache')
+                connection.execute('DROP TABLE IF EXISTS cache_stats')
+                connection.execute(
+                    'CREATE TABLE cache ('
+                    'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, expires_at REAL, '
+                    'accessed_at REAL NOT NULL, pinned INTEGER NOT NULL DEFAULT 0'
+                    ') WITHOUT ROWID'
+                )
+                connection.execute('CREATE INDEX ix_cache_accessed_at ON cache (accessed_at)')
+
+                # Hit, miss and eviction counts, plus the total size of the
+                # values so writes don't have to sum them
+                connection.execute('CREATE TABLE cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL) WITHOUT ROWID')
+                connection.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION}')
+
+    def _get_connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread
+        # gets its own. Autocommit, with explicit transactions for atomic ops.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = wal')
+            connection.execute('PRAGMA synchronous = normal')
+            self._local.connection = connection
+        return connection
+
+    def _get_row(self, connection, key):
+        # Fetch all the rows, since a statement which isn't stepped to the end
+        # holds its read transaction open and keeps seeing an old snapshot
+        rows = connection.execute(
+            'SELECT value, size, accessed_at FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())
+        ).fetchall()
+        return rows[0] if rows else None
+
+    def _peek(self, key):
+        row = self._get_row(self._get_connection(), key)
+        return pickle.loads(row[0]) if row else None
+
+    def get(self, key):
+        connection = self._get_connection()
+        row = self._get_row(connection, key)
+        if row is None:
+            self._count('misses')
+            return None
+
+        value, _, accessed_at = row
+        now = time.time()
+        if now - accessed_at > ACCESS_TIME_RESOLUTION:
+            connection.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+
+        self._count('hits')
+        return pickle.loads(value)
+
+    def _count(self, name: str, amount: int = 1):
+        super()._count(name, amount)
+        if time.monotonic() - self._stats_flushed_at > STATS_FLUSH_INTERVAL:
+            self._flush_stats()
+
+    def _flush_stats(self):
+        with self._stats_lock:
+            stats = self._stats
+            self._stats = Counter()
+            self._stats_flushed_at = time.monotonic()
+
+        if stats:
+            self._get_connection().executemany(
+                'INSERT INTO cache_stats (name, value) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+                stats.items()
+            )
+
+    def _add_bytes(self, connection, delta: int):
+        connection.execute(
+            "INSERT INTO cache_stats (name, value) VALUES ('bytes', ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (delta,)
+        )
+        return connection.execute("SELECT value FROM cache_stats WHERE name = 'bytes'").fetchall()[0][0]
+
+    def _write(self, connection, key, value, ttl: Optional[float], pinned: bool = False):
+        """Write an entry and evict others if the cache is full. Call in a transaction."""
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        rows = connection.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchall()
+        old_size = rows[0][0] if rows else 0
+
+        connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, size, expires_at, accessed_at, pinned) VALUES (?, ?, ?, ?, ?, ?)',
+            (key, data, len(data), _get_expires_at(ttl), time.time(), pinned)
+        )
+
+        total_bytes = self._add_bytes(connection, len(data) - old_size)
+        if self.max_bytes is not None and total_bytes > self.max_bytes:
+            self._evict(connection, total_bytes - int(self.max_bytes * EVICTION_TARGET))
+
+    def _evict(self, connection, bytes_to_free: int):
+        """Evict expired and then least recently used entries. Call in a transaction."""
+        evicted_keys = []
+        freed_bytes = 0
+
+        cursor = connection.execute(
+            'SELECT key, size FROM cache WHERE pinned = 0 '
+            'ORDER BY expires_at IS NOT NULL AND expires_at <= ? DESC, accessed_at',
+            (time.time(),)
+        )
+        for key, size in cursor:
+            if freed_bytes >= bytes_to_free:
+                break
+            evicted_keys.append((key,))
+            freed_bytes += size
+        cursor.close()
+
+        connection.executemany('DELETE FROM cache WHERE key = ?', evicted_keys)
+        self._add_bytes(connection, -freed_bytes)
+        self._count('evictions', len(evicted_keys))
+
+    def set(self, key, value, ttl: Optional[float] = None, pinned: bool = False):
+        """Set a key. Pinned keys are never evicted, only deleted or expired."""
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            self._write(connection, key, value, ttl, pinned)
+
+    def delete(self, key):
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            live = self._get_row(connection, key) is not None
+            rows = connection.execute('SELECT size FROM cache WHERE key = ?', (key,)).fetchall()
+            if rows:
+                connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self._add_bytes(connection, -rows[0][0])
+        if not live:
+            raise KeyError(key)
+
+    def add(self, key, value, ttl: Optional[float] = None):
+        """Set a key only if it isn't set already. Returns whether it was set."""
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if self._get_row(connection, key) is not None:
+                return False
+            self._write(connection, key, value, ttl)
+            return True
+
+    def update(self, key, function: Callable[[Any], Any], ttl: Optional[float] = None, pinned: bool = False):
+        """
+        Atomically replace a key's value with function(value), where value is
+        None if the key isn't set. Returns the new value.
+        """
+        connection = self._get_connection()
+        with connection:
+            # Take the write lock before reading, so nobody else can update
+            # the key in between
+            connection.execute('BEGIN IMMEDIATE')
+            row = self._get_row(connection, key)
+            value = function(pickle.loads(row[0]) if row else None)
+            self._write(connection, key, value, ttl, pinned)
+        return value
+
+    def _clear_prefix(self, prefix: str):
+        # Keys with the prefix sort between it and the prefix with its last
+        # character incremented, so this can use the primary key
+        upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            freed_bytes = connection.execute(
+                'SELECT total(size) FROM cache WHERE key >= ? AND key < ?', (prefix, upper_bound)
+            ).fetchall()[0][0]
+            connection.execute('DELETE FROM cache WHERE key >= ? AND key < ?', (prefix, upper_bound))
+            self._add_bytes(connection, -int(freed_bytes))
+
+    def clear(self):
+        """Delete every key, and reset the stats."""
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM cache')
+            connection.execute('DELETE FROM cache_stats')
+
+    def get_stats(self):
+        """Hit, miss and eviction counts across all processes, and the cache's size."""
+        self._flush_stats()
+
+        connection = self._get_connection()
+        stats = dict(connection.execute('SELECT name, value FROM cache_stats').fetchall())
+        return {
+            'hits': stats.get('hits', 0),
+            'misses': stats.get('misses', 0),
+            'evictions': stats.get('evictions', 0),
+            'entries': connection.execute('SELECT count(*) FROM cache').fetchall()[0][0],
+            'bytes': stats.get('bytes', 0),
+        }
+
+
 cache = None
 
 def initialize_cache(
         manager=None,
         cache_manager_dict=None,
         cache_manager_lock=None):
+    global cache
+    if settings.cache_backend == 'sqlite':
+        cache = SQLiteCache(settings.cache_database_path, max_bytes=settings.cache_max_bytes)
+        return cache
+
     # If cache_manager_dict and cache_manager_lock are not provided, use the manager to create them
     if cache_manager_dict is None or cache_manager_lock is None:
         cache_manager_dict = manager.dict()
         cache_manager_lock = manager.Lock()
 
-    global cache
     cache = SharedCache(cache_manager_dict, cache_manager_lock)
 
     return cache
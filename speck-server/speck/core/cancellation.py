@@ -0,0 +1,59 @@
+import contextvars
+import threading
+import time
+from typing import Optional
+
+
+class TaskCancelled(Exception):
+    """Raised in a task which was cancelled or ran past its timeout."""
+
+
+class CancellationToken:
+    """
+    Tells a running task it should stop, because it was cancelled or its
+    timeout passed. Sync tasks can't be interrupted, so long-running ones
+    should call check_cancelled() between steps. Workers which keep running
+    past the grace period are killed, see TaskManager.
+    """
+    def __init__(self, task_id: int, timeout: Optional[float] = None, final_attempt: bool = False):
+        self.task_id = task_id
+        self.timeout = timeout
+        self.final_attempt = final_attempt  # Whether the task is retried if this attempt fails
+        self.deadline = None  # Set once the task starts running
+        self.timed_out = False
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def start(self):
+        """Start the timeout, once the task is actually running."""
+        if self.timeout:
+            self.deadline = time.monotonic() + self.timeout
+
+    def is_overdue(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def cancel(self, timed_out: bool = False):
+        if not self.cancelled:
+            self.timed_out = timed_out
+            self._cancelled.set()
+
+    def check(self):
+        if self.cancelled:
+            raise TaskCancelled(f"Timed out after {self.timeout:.0f}s" if self.timed_out else "Cancelled")
+
+
+# The token of the task running in this context. Async tasks each run in a
+# context of their own, and sync tasks get a copy of theirs.
+current_token = contextvars.ContextVar('current_token', default=None)
+
+def check_cancelled():
+    """
+    Raise TaskCancelled if the task we're running in was cancelled or timed
+    out. Does nothing outside of tasks.
+    """
+    token = current_token.get()
+    if token is not None:
+        token.check()
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+import uuid
+from sqlalchemy.exc import NoResultFound
+from sqlmodel import Session, select
+
+from config import db_engine, settings
+
+logger = logging.getLogger(__name__)
+
+# Tasks which return the thread ids they changed, so the event bus can push
+# mailbox deltas to the browser extension
+MAILBOX_TASKS = ("sync_inbox", "process_inbox_message", "execute_function_for_message")
+
+
+class EventBus:
+    """
+    Hands task completion events from the task manager's threads to the
+    server's event loop, or to the event broker when the API runs in several
+    processes. Bursts of completions are coalesced, so 50 processed messages
+    become one mailbox delta instead of 50.
+
+    The event bus runs in the main process alongside the task manager, and
+    assigns every delta its version.
+    """
+    def __init__(self):
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+
+        # The server's running event loop, which owns the websockets, if the
+        # API is served from this process
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Other destinations for deltas, like the cross-process event broker
+        self.subscribers: List[Callable[[dict], None]] = []
+
+        self._lock = threading.Lock()
+        self._changed_thread_ids = set()
+        self._pending = threading.Event()
+
+        self._stop_event = threading.Event()
+        self._dispatcher_thread = None
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Deliver events on the given loop. Called once the server is running."""
+        # Imported here, since it pulls in FastAPI, which workers don't need
+        from core.event_manager import event_manager
+        event_manager.reset_mailbox_version(self.epoch, self.version)
+        self.loop = loop
+
+    def subscribe(self, callback: Callable[[dict], None]):
+        """
+        Also deliver every event to a callback: deltas on the dispatcher
+        thread, other events on whichever thread published them.
+        """
+        self.subscribers.append(callback)
+
+    def start(self):
+        self._stop_event.clear()
+        self._dispatcher_thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._pending.set()
+        if self._dispatcher_thread:
+            self._dispatcher_thread.join()
+
+    def publish_task_result(self, task_name: str, result):
+        """Record a completed task's changes. Safe to call from any thread."""
+        if task_name not in MAILBOX_TASKS or not result:
+            return
+
+        with self._lock:
+            self._changed_thread_ids.update(result)
+        self._pending.set()
+
+    def publish_event(self, event: dict):
+        """
+        Deliver an event which isn't a mailbox change, like a download's
+        progress, as is. Safe to call from any thread. These aren't
+        versioned, so reconnecting clients don't get them replayed.
+        """
+        for callback in self.subscribers:
+            callback(event)
+
+        if self.loop is not None and not self.loop.is_closed():
+            from core.event_manager import event_manager
+            asyncio.run_coroutine_threadsafe(event_manager.notify(event), self.loop)
+
+    def _dispatch(self):
+        while not self._stop_event.is_set():
+            if not self._pending.wait(timeout=1):
+                continue
+
+            # Debounce: keep collecting until things go quiet for the
+            # coalesce delay, but never hold changes back past the max delay
+            first_event_at = time.monotonic()
+            while not self._stop_event.is_set():
+                self._pending.clear()
+                remaining = settings.event_coalesce_max_delay - (time.monotonic() - first_event_at)
+                if remaining <= 0:
+                    break
+                if not self._pending.wait(timeout=min(settings.event_coalesce_delay, remaining)):
+                    break
+
+            with self._lock:
+                thread_ids = list(self._changed_thread_ids)
+                self._changed_thread_ids.clear()
+
+            if thread_ids:
+                try:
+                    self._flush(thread_ids)
+                except Exception as e:
+                    logger.error(f"Error pushing mailbox changes: {e}", exc_info=True)
+
+    def _flush(self, thread_ids):
+        """Load the changed threads and deliver them as one versioned delta."""
+        loop_attached = self.loop is not None and not self.loop.is_closed()
+        if not loop_attached and not self.subscribers:
+            # Nobody is listening, and clients get a snapshot when they connect
+            logger.info(f"Dropping {len(thread_ids)} mailbox changes, the server isn't running")
+            return
+
+        from emails.models import Mailbox
+        with Session(db_engine) as session:
+            try:
+                mailbox = session.exec(select(Mailbox)).one()
+            except NoResultFound:
+                return
+        changes = mailbox.get_thread_changes(thread_ids)
+
+        self.version += 1
+        event = { "type": "mailbox_delta", "epoch": self.epoch, "version": self.version, "changes": changes }
+        logger.info(f'Pushing {len(changes)} mailbox changes to event system as version {self.version}')
+
+        for callback in self.subscribers:
+            callback(event)
+
+        if loop_attached:
+            from core.event_manager import event_manager
+            future = asyncio.run_coroutine_threadsafe(
+                event_manager.publish_mailbox_delta(event),
+                self.loop
+            )
+            future.result(timeout=10)
+
+event_bus = EventBus()
@@ -1,28 +1,215 @@
-from typing import Dict
+import asyncio
+from collections import deque
+import json
+import logging
+from typing import Dict, Optional, Set
+import uuid
 from fastapi import WebSocket
+from starlette.concurrency import run_in_threadpool
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Queued in place of dropped events, telling the writer to send a snapshot
+SEND_SNAPSHOT = object()
+
+
+def encode_event(message: dict) -> str:
+    """Encode an event the same way WebSocket.send_json does."""
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+class Connection:
+    """
+    A websocket plus its bounded send queue. A writer task drains the queue,
+    so a slow client never holds up delivery to the others.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.send_queue = asyncio.Queue(maxsize=settings.event_send_queue_size)
+        self.writer_task: Optional[asyncio.Task] = None
+
 
 class EventManager:
     def __init__(self):
-        self.connections: Dict[str, WebSocket] = {}
+        self.connections: Dict[str, Connection] = {}
+
+        # The version of the last mailbox delta, so clients can detect gaps.
+        # Versions are assigned by the event bus, and start over with a new
+        # epoch every time the server starts.
+        self.mailbox_epoch = uuid.uuid4().hex
+        self.mailbox_version = 0
 
-    async def connect(self, websocket: WebSocket):
+        # The most recent deltas, replayed to clients which reconnect
+        self.change_log = deque(maxlen=settings.mailbox_change_log_size)
+
+        # Closes of slow clients' websockets still in flight. The loop only
+        # keeps weak references to tasks, so they're kept here until done.
+        self.closing_tasks: Set[asyncio.Task] = set()
+
+    async def accept(self, websocket: WebSocket):
         await websocket.accept()
+
+    async def connect(self, websocket: WebSocket, epoch: Optional[str] = None, version: Optional[int] = None):
+        """
+        Register an accepted websocket to receive future events. First queue
+        what it needs to catch up from the epoch and version it last saw: the
+        deltas it missed, or else a full snapshot. Nothing else runs on the
+        loop in between, so catch-up and live deltas go out in order through
+        the one writer.
+        """
+        connection = Connection(websocket)
+
+        missed_events = self.get_changes_since(epoch, version)
+        max_queued = connection.send_queue.maxsize
+        if missed_events is not None and (max_queued <= 0 or len(missed_events) <= max_queued):
+            logger.info(f"Replaying {len(missed_events)} mailbox changes since version {version}")
+            for event in missed_events:
+                connection.send_queue.put_nowait(encode_event(event))
+        else:
+            connection.send_queue.put_nowait(SEND_SNAPSHOT)
+
+        connection.writer_task = asyncio.create_task(self._write(connection))
+
         connection_id = str(id(websocket))
-        self.connections[connection_id] = websocket
+        self.connections[connection_id] = connection
 
     def disconnect(self, websocket: WebSocket):
         connection_id = str(id(websocket))
-        if connection_id in self.connections:
-            del self.connections[connection_id]
+        connection = self.connections.pop(connection_id, None)
+        if connection is not None and connection.writer_task is not asyncio.current_task():
+            connection.writer_task.cancel()
+
+    async def _write(self, connection: Connection):
+        """Send a connection's queued events until it disconnects."""
+        while True:
+            encoded_event = await connection.send_queue.get()
+
+            try:
+                if encoded_event is SEND_SNAPSHOT:
+                    snapshot = await self.get_mailbox_snapshot_event()
+                    if snapshot is None:
+                        continue
+                    encoded_event = encode_event(snapshot)
+
+                await connection.websocket.send_text(encoded_event)
+            except Exception:
+                self.disconnect(connection.websocket)
+                return
+
+    def _enqueue(self, encoded_event: str):
+        """Queue an encoded event on every connection, handling slow consumers."""
+        for connection in list(self.connections.values()):
+            try:
+                connection.send_queue.put_nowait(encoded_event)
+            except asyncio.QueueFull:
+                self._handle_slow_consumer(connection)
+
+    def _handle_slow_consumer(self, connection: Connection):
+        """Apply the slow consumer policy to a connection whose queue is full."""
+        if settings.event_slow_consumer_policy == 'disconnect':
+            # The client will reconnect and catch up from the change log
+            logger.info('Disconnecting slow websocket client')
+            self.disconnect(connection.websocket)
+            closing_task = asyncio.create_task(connection.websocket.close(code=1013))
+            self.closing_tasks.add(closing_task)
+            closing_task.add_done_callback(self._closed)
+            return
+
+        # Otherwise, drop everything it hasn't been sent yet and replace it
+        # with a snapshot, which the writer fetches when it gets to it
+        logger.info('Dropping queued events for slow websocket client, sending a snapshot instead')
+        while not connection.send_queue.empty():
+            connection.send_queue.get_nowait()
+        connection.send_queue.put_nowait(SEND_SNAPSHOT)
+
+    def _closed(self, closing_task: asyncio.Task):
+        self.closing_tasks.discard(closing_task)
+        if not closing_task.cancelled() and closing_task.exception() is not None:
+            # It may have disconnected by itself already
+            logger.info(f"Error closing slow websocket client: {closing_task.exception()}")
 
     async def notify(self, message: dict):
-        connection_ids = list(self.connections.keys())
-        for connection_id in connection_ids:
-            websocket = self.connections.get(connection_id)
-            if websocket:
+        """
+        Encode an event once and fan it out to every connection. Must run on
+        the server's event loop; other threads publish through the event bus.
+        """
+        self._enqueue(encode_event(message))
+
+    async def get_mailbox_snapshot_event(self):
+        """Load the Mailbox and wrap it in a snapshot event, or None if there isn't one."""
+        def load_messages():
+            from sqlalchemy.exc import NoResultFound
+            from sqlmodel import Session, select
+
+            from config import db_engine
+            from emails.models import Mailbox
+
+            with Session(db_engine) as session:
                 try:
-                    await websocket.send_json(message)
-                except Exception as e:
-                    self.disconnect(websocket)
+                    # TODO: Enhance to support multiple mailboxes
+                    mailbox = session.exec(select(Mailbox)).one()
+                except NoResultFound:
+                    return None
+                return mailbox.get_messages()
+
+        # Take the version first, so deltas published while we load are
+        # re-applied by the client rather than skipped
+        version = self.mailbox_version
+        messages = await run_in_threadpool(load_messages)
+        if messages is None:
+            return None
+        return self.get_mailbox_snapshot(messages, version=version)
+
+    def request_snapshot(self, websocket: WebSocket):
+        """Queue a full snapshot for a single connection, after its pending events."""
+        connection = self.connections.get(str(id(websocket)))
+        if connection is None:
+            return
+
+        try:
+            connection.send_queue.put_nowait(SEND_SNAPSHOT)
+        except asyncio.QueueFull:
+            self._handle_slow_consumer(connection)
+
+    def get_mailbox_snapshot(self, messages: dict, version: Optional[int] = None):
+        """Wrap a full Mailbox state in an event tagged with the current version."""
+        return {
+            "type": "mailbox",
+            "epoch": self.mailbox_epoch,
+            "version": self.mailbox_version if version is None else version,
+            "messages": messages
+        }
+
+    def get_changes_since(self, epoch: Optional[str], version: Optional[int]):
+        """
+        Get the delta events a client at the given epoch and version missed,
+        or None if it needs a full snapshot instead because the change log no
+        longer covers the gap.
+        """
+        if epoch != self.mailbox_epoch or version is None or version > self.mailbox_version:
+            return None
+
+        missed_events = [event for event in self.change_log if event["version"] > version]
+
+        # The change log must contain every version after the client's
+        first_missed_version = missed_events[0]["version"] if missed_events else self.mailbox_version + 1
+        if first_missed_version != version + 1:
+            return None
+
+        return missed_events
+
+    def reset_mailbox_version(self, epoch: str, version: int):
+        """Adopt the event bus's epoch and version, e.g. when subscribing to it."""
+        self.mailbox_epoch = epoch
+        self.mailbox_version = version
+        self.change_log.clear()
+
+    async def publish_mailbox_delta(self, event: dict, encoded_event: Optional[str] = None):
+        """Record a versioned delta event from the event bus and fan it out."""
+        self.mailbox_version = event["version"]
+        self.change_log.append(event)
+        self._enqueue(encoded_event or encode_event(event))
 
 event_manager = EventManager()
@@ -5,6 +5,7 @@ import threading
 import time
 import requests
 from functools import wraps
+from urllib.parse import urlparse
 import platform
 import psutil
 
@@ -14,6 +15,14 @@ from core.cache import cache
 logger = logging.getLogger(__name__)
 
 
+def get_model_path(model_type):
+    """Where the model of a type is downloaded to, named after its URL."""
+    if model_type not in ('embedding', 'completion'):
+        raise ValueError(f"Invalid model type: {model_type}. Must be 'embedding' or 'completion'")
+    url = getattr(settings, f'{model_type}_model_url')
+    return os.path.join(settings.models_dir, os.path.basename(urlparse(url).path))
+
+
 class LLMServiceManager:
     def __init__(self):
         self.stdout_log = None
@@ -28,15 +37,16 @@ class LLMServiceManager:
         return state
 
     def _write_state(self, state):
-        cache.set('llm_service_state', state)
+        # Pinned, since evicting it would lose track of running servers
+        cache.set('llm_service_state', state, pinned=True)
 
     def start_llamafile_process(self, model_type):
         if model_type == 'embedding':
-            model_path = os.path.join(settings.models_dir, 'mxbai-embed-large-v1-f16.gguf')
+            model_path = get_model_path('embedding')
             context_size = '512'
             llamafile_port = '17726'
         elif model_type == 'completion':
-            model_path = os.path.join(settings.models_dir, 'gemma-2-9b-it-Q5_K_M.gguf')
+            model_path = get_model_path('completion')
             context_size = '8192'
             llamafile_port = '17727'
         else:
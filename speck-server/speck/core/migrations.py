@@ -0,0 +1,133 @@
+import logging
+from sqlmodel import Session, text
+
+from config import db_engine, settings
+
+logger = logging.getLogger(__name__)
+
+
+def _get_columns(connection, table):
+    return {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info({table})')}
+
+
+def move_raw_messages_to_blobs(connection):
+    """
+    Move Message.raw into the compressed, content-addressed blob table and
+    drop the column.
+    """
+    from core.blobs import put_blob
+
+    columns = _get_columns(connection, 'message')
+    if 'raw_digest' not in columns:
+        connection.exec_driver_sql('ALTER TABLE message ADD COLUMN raw_digest VARCHAR')
+    if 'raw' not in columns:
+        return
+
+    rows = connection.exec_driver_sql('SELECT id, raw FROM message WHERE raw IS NOT NULL').fetchall()
+    logger.info(f"Moving {len(rows)} raw messages to the blob table")
+
+    with Session(bind=connection) as session:
+        for message_id, raw in rows:
+            # raw was declared as str but has always held bytes
+            if isinstance(raw, str):
+                raw = raw.encode()
+            digest = put_blob(session, raw)
+            session.exec(
+                text('UPDATE message SET raw_digest = :digest WHERE id = :id').bindparams(
+                    digest=digest,
+                    id=message_id
+                )
+            )
+        session.flush()
+
+    connection.exec_driver_sql('ALTER TABLE message DROP COLUMN raw')
+
+
+def add_message_fetch_depth(connection):
+    """Add Message.fetch_depth. Every message synced so far was fetched in full."""
+    if 'fetch_depth' not in _get_columns(connection, 'message'):
+        connection.exec_driver_sql("ALTER TABLE message ADD COLUMN fetch_depth VARCHAR NOT NULL DEFAULT 'raw'")
+
+
+def add_mailbox_change_version(connection):
+    """
+    Add Mailbox.change_version, and the triggers which bump it whenever one
+    of its messages is written, so the mailbox API's ETags change with the
+    data they describe.
+    """
+    if 'change_version' not in _get_columns(connection, 'mailbox'):
+        connection.exec_driver_sql('ALTER TABLE mailbox ADD COLUMN change_version INTEGER NOT NULL DEFAULT 0')
+
+    for event, mailbox_ids in [
+        ('INSERT', 'NEW.mailbox_id'),
+        ('UPDATE', 'OLD.mailbox_id, NEW.mailbox_id'),
+        ('DELETE', 'OLD.mailbox_id'),
+    ]:
+        connection.exec_driver_sql(
+            f'CREATE TRIGGER IF NOT EXISTS message_{event.lower()}_change_version AFTER {event} ON message '
+            f'BEGIN UPDATE mailbox SET change_version = change_version + 1 WHERE id IN ({mailbox_ids}); END'
+        )
+
+
+# Append new migrations to the end, never reorder or remove them
+MIGRATIONS = [
+    move_raw_messages_to_blobs,
+    add_message_fetch_depth,
+    add_mailbox_change_version,
+]
+
+
+def migrate_database():
+    """
+    Apply any migrations the database hasn't had yet.
+
+    SQLModel's create_all only creates missing tables, so changes to tables
+    which already exist are made here. Each migration runs once, in order,
+    and the database's user_version records how many have been applied.
+    """
+    with db_engine.begin() as connection:
+        applied = connection.exec_driver_sql('PRAGMA user_version').scalar()
+
+        for version, migration in enumerate(MIGRATIONS[applied:], start=applied + 1):
+            logger.info(f"Applying database migration {version}: {migration.__name__}")
+            migration(connection)
+            connection.exec_driver_sql(f'PRAGMA user_version = {version}')
+
+    # Reclaim the space freed by the migrations, outside a transaction
+    if applied < len(MIGRATIONS):
+        with db_engine.connect() as connection:
+            connection.exec_driver_sql('VACUUM')
+
+
+def migrate_database_layout():
+    """
+    When switching to the split database layout, move blobs and embeddings
+    out of the main database into the ATTACHed ones.
+    """
+    if settings.database_layout != 'split':
+        return
+
+    moved_tables = False
+    with db_engine.begin() as connection:
+        main_tables = {
+            row[0] for row in connection.exec_driver_sql("SELECT name FROM main.sqlite_master WHERE type = 'table'")
+        }
+
+        for schema, table, columns in [
+            ('blobs', 'blob', 'digest, codec, size, data'),
+            ('vectors', 'vec_message', 'message_id, body_embedding'),
+        ]:
+            if table not in main_tables:
+                continue
+
+            logger.info(f"Moving {table} into the {schema} database")
+            connection.exec_driver_sql(
+                f'INSERT INTO {schema}.{table} ({columns}) SELECT {columns} FROM main.{table}'
+            )
+            connection.exec_driver_sql(f'DROP TABLE main.{table}')
+            moved_tables = True
+
+    # Reclaim the space the moved tables used in the main database
+    if moved_tables:
+        with db_engine.connect() as connection:
+            connection.exec_driver_sql('VACUUM main')
@@ -0,0 +1,266 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import signal
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Callable, Optional
+
+from core.event_manager import encode_event, event_manager
+
+logger = logging.getLogger(__name__)
+
+# How the extra server processes find the broker. Set by the main process
+# before uvicorn spawns them, so they inherit it.
+BROKER_ADDRESS_ENV = 'SPECK_EVENT_BROKER_ADDRESS'
+BROKER_AUTHKEY_ENV = 'SPECK_EVENT_BROKER_AUTHKEY'
+
+# Times a server process tries to reconnect to the broker, backing off up to
+# 5s between attempts
+RECONNECT_ATTEMPTS = 6
+
+
+class EventBroker:
+    """
+    Local pub/sub backbone which lets the API run in several uvicorn worker
+    processes. Runs in the main process next to the event bus, and relays
+    every mailbox delta to each subscribed server process, whichever of them
+    holds a given websocket. Subscribers can also submit tasks and wake the
+    scheduler through it.
+
+    Uses a multiprocessing Listener, which is a Unix domain socket on macOS
+    and Linux and a named pipe on Windows.
+    """
+    def __init__(
+            self,
+            add_task: Callable,
+            epoch: str,
+            get_version: Callable[[], int],
+            wake_scheduler: Optional[Callable[[], None]] = None
+        ):
+        self.add_task = add_task
+        self.wake_scheduler = wake_scheduler
+        self.epoch = epoch
+        self.get_version = get_version
+
+        self.authkey = secrets.token_bytes(32)
+        self.listener = None
+        self.address = None
+
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._accept_thread = None
+
+    def start(self):
+        self.listener = Listener(authkey=self.authkey)
+        self.address = self.listener.address
+
+        # Let the server processes uvicorn spawns find us
+        os.environ[BROKER_ADDRESS_ENV] = self.address
+        os.environ[BROKER_AUTHKEY_ENV] = self.authkey.hex()
+
+        self._accept_thread = threading.Thread(target=self._accept, daemon=True)
+        self._accept_thread.start()
+        logger.info(f"Event broker listening on {self.address}")
+
+    def stop(self):
+        with self._lock:
+            for connection in self._subscribers:
+                connection.close()
+            self._subscribers.clear()
+
+        if self.listener:
+            self.listener.close()
+
+    def publish(self, event: dict):
+        """Encode an event once and send it to every subscriber."""
+        payload = encode_event(event).encode()
+
+        with self._lock:
+            for connection in list(self._subscribers):
+                try:
+                    connection.send_bytes(payload)
+                except (OSError, EOFError):
+                    self._subscribers.remove(connection)
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                # The listener was closed
+                return
+            except Exception as e:
+                logger.error(f"Event broker rejected a connection: {e}")
+                continue
+
+            with self._lock:
+                # Tell the subscriber where the event stream currently is,
+                # then add it so it receives every delta after that
+                hello = { "type": "hello", "epoch": self.epoch, "version": self.get_version() }
+                connection.send_bytes(encode_event(hello).encode())
+                self._subscribers.append(connection)
+
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(self, connection):
+        """Handle requests a subscriber sends upstream."""
+        while True:
+            try:
+                request = connection.recv()
+            except Exception as e:
+                if isinstance(e, (OSError, EOFError)) or connection.closed:
+                    with self._lock:
+                        if connection in self._subscribers:
+                            self._subscribers.remove(connection)
+                    return
+
+                # Like a task which can't be unpickled, since its module
+                # changed. The request was read whole, so carry on with the
+                # next one.
+                logger.exception("Event broker couldn't read a request")
+                continue
+
+            try:
+                action, task, args, kwargs = request
+                if action == 'add_task':
+                    self.add_task(task, *args, **kwargs)
+                elif action == 'wake_scheduler' and self.wake_scheduler is not None:
+                    self.wake_scheduler()
+            except Exception:
+                logger.exception("Event broker couldn't handle a request")
+
+
+class EventSubscriber:
+    """
+    Connects a server process to the event broker, feeding the deltas it
+    receives to this process's EventManager on its event loop.
+    """
+    def __init__(self, address: str, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self.connection = Client(address, authkey=authkey)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._send_lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        return cls(
+            address=os.environ[BROKER_ADDRESS_ENV],
+            authkey=bytes.fromhex(os.environ[BROKER_AUTHKEY_ENV])
+        )
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def send(self, request: tuple):
+        with self._send_lock:
+            self.connection.send(request)
+
+    def _reconnect(self):
+        """
+        Connect to the broker again, which sends a new hello, or stop this
+        server process if it can't be reached, so uvicorn replaces it rather
+        than it serve websockets which never get another event.
+        """
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(min(2 ** attempt * 0.5, 5))
+            try:
+                connection = Client(self.address, authkey=self.authkey)
+            except (OSError, EOFError) as e:
+                logger.warning(f"Couldn't reconnect to the event broker (attempt {attempt + 1}): {e}")
+                continue
+
+            with self._send_lock:
+                self.connection = connection
+            logger.info("Reconnected to the event broker")
+            return True
+
+        logger.error("Couldn't reconnect to the event broker, stopping this server process")
+        os.kill(os.getpid(), signal.SIGTERM)
+        return False
+
+    def _read(self):
+        while True:
+            try:
+                payload = self.connection.recv_bytes()
+            except (OSError, EOFError):
+                logger.error("Lost connection to the event broker")
+                if not self._reconnect():
+                    return
+                continue
+
+            encoded_event = payload.decode()
+            event = json.loads(encoded_event)
+
+            if event["type"] == "hello":
+                self.loop.call_soon_threadsafe(
+                    event_manager.reset_mailbox_version, event["epoch"], event["version"]
+                )
+            elif event["type"] == "mailbox_delta":
+                asyncio.run_coroutine_threadsafe(
+                    event_manager.publish_mailbox_delta(event, encoded_event),
+                    self.loop
+                )
+            else:
+                asyncio.run_coroutine_threadsafe(event_manager.notify(event), self.loop)
+
+
+class BrokerTaskManager:
+    """
+    Stands in for the TaskManager in extra server processes, which don't own
+    the task queue, by submitting tasks through the event broker.
+    """
+    def __init__(self, subscriber: EventSubscriber):
+        self.subscriber = subscriber
+        self._task_queue = None
+
+    @property
+    def task_queue(self):
+        """The task queue's database, which any process can open, for cancelling tasks and stats."""
+        if self._task_queue is None:
+            from config import settings
+            from core.task_queue import TaskQueue
+            self._task_queue = TaskQueue(settings.task_queue_database_path, history_size=settings.task_history_size)
+        return self._task_queue
+
+    def add_task(self, task: Callable, *args, **kwargs):
+        """Queue a task through the event broker. Doesn't return its id."""
+        logger.info(f"Adding task {task.__name__} through the event broker")
+        self.subscriber.send(('add_task', task, args, kwargs))
+
+    def cancel_task(self, task_id: int):
+        return self.task_queue.cancel(task_id)
+
+    def wake_scheduler(self):
+        """Wake the scheduler in the main process, through the event broker."""
+        self.subscriber.send(('wake_scheduler', None, (), {}))
+
+
+subscriber = None
+
+def initialize_server_process():
+    """
+    Set up a server process spawned by uvicorn when the API runs in several
+    workers. Must run before the routes are imported, since they bind the
+    task manager at import time. Does nothing in the main process.
+    """
+    from core import task_manager as task_manager_module
+    if task_manager_module.task_manager is not None or BROKER_ADDRESS_ENV not in os.environ:
+        return None
+
+    global subscriber
+    subscriber = EventSubscriber.from_environment()
+    task_manager_module.task_manager = BrokerTaskManager(subscriber)
+
+    # Open the shared cache, if it's one other processes can open
+    from config import settings
+    from core.cache import initialize_cache
+    if settings.cache_backend == 'sqlite':
+        initialize_cache()
+
+    return subscriber
@@ -0,0 +1,132 @@
+import asyncio
+from contextlib import contextmanager
+import logging
+import time
+from typing import Optional
+
+from config import settings
+from core.cancellation import current_token
+
+logger = logging.getLogger(__name__)
+
+# What the app prepares on startup, each by a task of its own so they
+# prepare in parallel. Tasks declare which of them they need with @requires.
+RESOURCES = ('browser', 'embedding_model', 'completion_model')
+
+
+class ResourceNotReady(Exception):
+    """Raised in a task whose resources couldn't be prepared."""
+
+
+def _get_readiness_cache():
+    # The shared cache, since resources are prepared in workers and
+    # readiness is served by the API
+    from core.cache import cache
+    return cache.namespace('readiness')
+
+
+def get_required_resources():
+    """The resources this configuration uses. Completions run in the cloud by default."""
+    return [
+        resource for resource in RESOURCES
+        if resource != 'completion_model' or settings.use_local_completions
+    ]
+
+
+def get_resource_status(resource: str):
+    """A resource's status, one of pending, preparing, ready, failed or not_required."""
+    if resource not in get_required_resources():
+        return {"status": "not_required"}
+    return _get_readiness_cache().get(resource) or {"status": "pending"}
+
+
+def set_resource_status(resource: str, status: str, error: Optional[str] = None, task_id: Optional[int] = None):
+    _get_readiness_cache().set(
+        resource,
+        {"status": status, "error": error, "task_id": task_id, "updated_at": time.time()},
+        pinned=True
+    )
+    logger.info(f"Resource {resource} is {status}")
+
+    # Imported here, since the task manager imports the task modules
+    from core.task_manager import publish_event
+    publish_event({"type": "readiness", "resource": resource, "status": status, "error": error})
+
+
+def is_ready(resource: str):
+    return get_resource_status(resource)["status"] in ('ready', 'not_required')
+
+
+def is_failed(resource: str, task_queue):
+    """
+    Whether a resource couldn't be prepared. One still preparing has failed
+    too if its task isn't pending any more, like when the worker running its
+    last attempt died.
+    """
+    status = get_resource_status(resource)
+    if status["status"] == 'preparing' and status.get("task_id") is not None:
+        if not task_queue.is_pending(status["task_id"]):
+            set_resource_status(resource, 'failed', status.get("error") or "The task preparing it stopped", status["task_id"])
+            return True
+    return status["status"] == 'failed'
+
+
+def get_readiness():
+    """Every resource's status, and whether they're all ready."""
+    resources = {resource: get_resource_status(resource) for resource in RESOURCES}
+    return {
+        "ready": all(is_ready(resource) for resource in RESOURCES),
+        "resources": resources,
+    }
+
+
+def requires(*resources: str):
+    """
+    Mark a task as needing resources, so workers hold it in the queue until
+    they're ready rather than have it fail, or wait and tie up a worker.
+    """
+    unknown_resources = set(resources) - set(RESOURCES)
+    if unknown_resources:
+        raise ValueError(f"Unknown resources: {', '.join(sorted(unknown_resources))}")
+
+    def decorator(task):
+        task.requires = resources
+        return task
+    return decorator
+
+
+def get_unready_resources(task):
+    """The resources a task needs which aren't ready yet."""
+    return [resource for resource in getattr(task, 'requires', ()) if not is_ready(resource)]
+
+
+@contextmanager
+def preparing(resource: str):
+    """
+    Mark a resource preparing for the duration of the block, then ready, or
+    failed if it raises on the task's last attempt. Until then it stays
+    preparing while the task is retried, so tasks which require it wait
+    rather than fail on a transient error.
+    """
+    token = current_token.get()
+    task_id = token.task_id if token is not None else None
+    set_resource_status(resource, 'preparing', task_id=task_id)
+    try:
+        yield
+    except (Exception, asyncio.CancelledError) as e:
+        # Cancelled tasks aren't retried, though ones which timed out are
+        retried = token is not None and not token.final_attempt and (token.timed_out or not token.cancelled)
+        set_resource_status(resource, 'preparing' if retried else 'failed', f'{type(e).__name__}: {e}', task_id)
+        if not retried:
+            _release_waiting_tasks(resource)
+        raise
+    set_resource_status(resource, 'ready', task_id=task_id)
+    _release_waiting_tasks(resource)
+
+
+def _release_waiting_tasks(resource: str):
+    """Let the tasks waiting for a resource run, or fail, now it's done preparing."""
+    # Imported here, since the task manager imports this module
+    from core.task_manager import task_manager
+    if task_manager is not None:
+        task_manager.task_queue.release_waiting(resource)
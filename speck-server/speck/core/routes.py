@@ -1,14 +1,16 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
 import logging
 import json
-from typing import List
-from sqlalchemy.exc import NoResultFound
-from sqlmodel import Session, select
+from typing import Optional
 
-from config import db_engine
+import anyio
+from starlette.concurrency import run_in_threadpool
+
+from config import settings
+from core import readiness
 from core.event_manager import event_manager
 from core.task_manager import task_manager
-from emails.models import Mailbox, Message
+from emails.sync import record_client_connected, record_client_disconnected, record_user_activity
 
 logger = logging.getLogger(__name__)
 
@@ -16,37 +18,109 @@ router = APIRouter()
 
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await event_manager.connect(websocket)
-
-    with Session(db_engine) as session:
-        try:
-            # Send the latest Mailbox state upon initial connection
-            # TODO: Enhance to support multiple mailboxes
-            mailbox = session.exec(select(Mailbox)).one()
-            await event_manager.notify({ "type": "mailbox", "messages": mailbox.get_messages() })
-        except NoResultFound:
-            # If we didn't find a Mailbox, then do nothing
-            return
+async def websocket_endpoint(
+        websocket: WebSocket,
+        epoch: Optional[str] = None,
+        version: Optional[int] = None
+    ):
+    """
+    Pushes Mailbox state to the browser extension. A reconnecting client
+    passes the epoch and version it last saw, and only receives the deltas it
+    missed, falling back to a full snapshot if the change log doesn't reach
+    back that far. The catch-up goes only to the connecting socket, queued
+    ahead of any live deltas.
+    """
+    await event_manager.accept(websocket)
+    await event_manager.connect(websocket, epoch=epoch, version=version)
 
+    # Recording the client and queueing tasks write to SQLite, so they run in
+    # the thread pool rather than hold up every other connection
+    client_recorded = False
     try:
+        # Sync more often while the extension is connected
+        await run_in_threadpool(record_client_connected)
+        client_recorded = True
+
         while True:
             data = await websocket.receive_text()
-            await websocket.send_text(f"Message text was: {data}")
 
             message = json.loads(data)
             action = message.get('action')
 
-            if action == 'execute_function':
+            if action == 'get_mailbox':
+                # The client missed a delta, so send it a fresh snapshot
+                event_manager.request_snapshot(websocket)
+
+            elif action == 'execute_function':
                 thread_id = message['args']['thread_id']
                 function_name = message['args']['function_name']
+                await run_in_threadpool(record_user_activity)
 
+                # Functions act on the user's behalf, so never retry them
                 from emails.tasks import execute_function_for_message
-                task_manager.add_task(
+                await run_in_threadpool(
+                    task_manager.add_task,
                     task=execute_function_for_message,
                     thread_id=thread_id,
-                    function_name=function_name
+                    function_name=function_name,
+                    max_attempts=1,
+                    timeout=settings.execute_function_timeout
                 )
 
     except WebSocketDisconnect:
-        event_manager.disconnect(websocket)
\ No newline at end of file
+        pass
+    finally:
+        event_manager.disconnect(websocket)
+        if client_recorded:
+            # Even if the connection was cancelled, or the count of connected
+            # clients would never go back down
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(record_client_disconnected)
+
+
+@router.get("/readiness")
+def get_readiness():
+    """
+    Whether the browser and the models the app uses are ready, or still
+    pending, preparing, or failed with an error. Tasks which need a resource
+    wait in the queue until it's ready.
+    """
+    return readiness.get_readiness()
+
+
+@router.get("/tasks")
+def get_tasks():
+    """
+    How many tasks of each type are queued, running, finished, cancelled or
+    dead, with percentiles of how long they waited to be claimed and took to
+    run in seconds, over the recent history.
+    """
+    stats = task_manager.task_queue.get_stats()
+    return {
+        "queued": sum(task_stats['counts'].get('queued', 0) for task_stats in stats.values()),
+        "running": sum(task_stats['counts'].get('running', 0) for task_stats in stats.values()),
+        "tasks": stats
+    }
+
+
+@router.get("/tasks/{task_id}")
+def get_task(task_id: int):
+    """A task's status, timestamps, worker and last error."""
+    task = task_manager.task_queue.get_task(task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+    return task
+
+
+@router.post("/tasks/{task_id}/cancel")
+def cancel_task(task_id: int):
+    """
+    Cancel a queued or running task. Running tasks stop cooperatively, so the
+    status is 'cancelling' until they do.
+    """
+    status = task_manager.cancel_task(task_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Task not found, or already finished")
+
+    return {"id": task_id, "status": status}
\ No newline at end of file
@@ -0,0 +1,230 @@
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import List, Optional
+
+from config import RecurringTask
+from core.task_queue import TaskQueue, resolve_task
+
+logger = logging.getLogger(__name__)
+
+# How often adaptive intervals are re-evaluated while waiting, so a change
+# like the user becoming active can bring the next run forward
+ADAPTIVE_RECHECK_INTERVAL = 10
+
+
+class CronSchedule:
+    """
+    A minimal cron expression: minute, hour, day of month, month and day of
+    week fields. Each is *, a number, a range like 1-5, a step like */15 or
+    1-30/5, or a comma-separated list of those. Days of the week run from
+    0 (Sunday) to 6, with 7 also meaning Sunday. Runs in local time.
+    """
+    FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' doesn't have 5 fields")
+
+        self.minutes, self.hours, self.days, self.months, weekdays = [
+            self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.FIELD_RANGES)
+        ]
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+
+        # Like cron, when both day fields are restricted either can match
+        self.either_day_matches = fields[2] != '*' and fields[4] != '*'
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int):
+        values = set()
+        for part in field.split(','):
+            range_part, _, step = part.partition('/')
+            if range_part == '*':
+                start, end = low, high
+            elif '-' in range_part:
+                start, end = map(int, range_part.split('-'))
+            else:
+                start = int(range_part)
+                end = high if step else start
+
+            if not low <= start <= end <= high:
+                raise ValueError(f"Cron field '{field}' is out of range")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, run: datetime):
+        day_matches = run.day in self.days
+        weekday_matches = run.isoweekday() % 7 in self.weekdays
+        if self.either_day_matches:
+            return day_matches or weekday_matches
+        return day_matches and weekday_matches
+
+    def get_next_run(self, after: datetime):
+        """The first time the expression matches after the given time."""
+        run = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        give_up_at = run + timedelta(days=5 * 366)
+
+        # Skip whole months, days and hours which don't match
+        while run < give_up_at:
+            if run.month not in self.months:
+                run = (run.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(run):
+                run = run.replace(hour=0, minute=0) + timedelta(days=1)
+            elif run.hour not in self.hours:
+                run = run.replace(minute=0) + timedelta(hours=1)
+            elif run.minute not in self.minutes:
+                run += timedelta(minutes=1)
+            else:
+                return run
+
+        raise ValueError("Cron expression never matches")
+
+
+class ScheduledTask:
+    """A recurring task's schedule and the state of its runs."""
+    def __init__(self, recurring_task: RecurringTask):
+        self.recurring_task = recurring_task
+        self.name = recurring_task.task
+
+        if not (recurring_task.interval or recurring_task.cron or recurring_task.interval_policy):
+            raise ValueError(f"Recurring task {self.name} needs an interval, cron or interval_policy")
+
+        # Resolve everything up front, so a typo fails at startup rather than
+        # on the first run
+        resolve_task(self.name)
+        self.cron = CronSchedule(recurring_task.cron) if recurring_task.cron else None
+        self.interval_policy = resolve_task(recurring_task.interval_policy) if recurring_task.interval_policy else None
+
+        self.next_run_at: Optional[float] = None  # time.monotonic()
+        self.last_run_at: Optional[float] = None
+        self.last_task_id: Optional[int] = None
+        self.jitter = 0
+
+        # The wait before the next run and why, for the log
+        self.interval: Optional[float] = None
+        self.reason: Optional[str] = None
+
+    def update_interval(self):
+        """Work out the wait between the last run and the next one."""
+        if self.cron:
+            now = datetime.now()
+            self.interval = (self.cron.get_next_run(now) - now).total_seconds()
+            self.reason = f"cron schedule '{self.recurring_task.cron}'"
+        elif self.interval_policy:
+            try:
+                self.interval, self.reason = self.interval_policy()
+            except Exception as e:
+                logger.error(f"Error getting the interval for {self.name}, using its fixed interval: {e}", exc_info=True)
+                self.interval, self.reason = self.recurring_task.interval, 'interval policy failed'
+        else:
+            self.interval, self.reason = self.recurring_task.interval, 'fixed interval'
+        return self.interval
+
+
+class Scheduler:
+    """
+    Queues recurring tasks when they're due. Their next run times are kept
+    in a heap, and the scheduler thread sleeps until the earliest one rather
+    than polling.
+    """
+    def __init__(self, task_queue: TaskQueue, recurring_tasks: List[RecurringTask], initial_delay: float = 5):
+        self.task_queue = task_queue
+        self.scheduled_tasks = [ScheduledTask(recurring_task) for recurring_task in recurring_tasks]
+        self.initial_delay = initial_delay
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Give the setup tasks time to get in the queue first
+        first_run_at = time.monotonic() + self.initial_delay
+        for scheduled_task in self.scheduled_tasks:
+            self._push(scheduled_task, first_run_at)
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def wake(self):
+        """Re-evaluate adaptive intervals now, e.g. because the user became active."""
+        self._wakeup.set()
+
+    def _push(self, scheduled_task: ScheduledTask, run_at: float):
+        # Entries are never removed from the heap. Rescheduling pushes a new
+        # one, and stale ones are skipped when they come up.
+        scheduled_task.next_run_at = run_at
+        heapq.heappush(self._heap, (run_at, next(self._counter), scheduled_task))
+
+    def _run(self):
+        has_adaptive_tasks = any(scheduled_task.interval_policy for scheduled_task in self.scheduled_tasks)
+
+        while not self._stop_event.is_set():
+            with self._lock:
+                timeout = max(self._heap[0][0] - time.monotonic(), 0) if self._heap else None
+            if has_adaptive_tasks:
+                timeout = min(timeout, ADAPTIVE_RECHECK_INTERVAL) if timeout is not None else ADAPTIVE_RECHECK_INTERVAL
+
+            if self._wakeup.wait(timeout):
+                self._wakeup.clear()
+            if self._stop_event.is_set():
+                break
+
+            with self._lock:
+                if has_adaptive_tasks:
+                    self._reschedule_adaptive_tasks()
+
+                while self._heap and self._heap[0][0] <= time.monotonic():
+                    run_at, _, scheduled_task = heapq.heappop(self._heap)
+                    if run_at != scheduled_task.next_run_at:
+                        continue
+                    self._run_task(scheduled_task)
+
+    def _reschedule_adaptive_tasks(self):
+        for scheduled_task in self.scheduled_tasks:
+            if not scheduled_task.interval_policy or scheduled_task.last_run_at is None:
+                continue
+
+            previous_interval = scheduled_task.interval
+            run_at = scheduled_task.last_run_at + scheduled_task.update_interval() + scheduled_task.jitter
+            if scheduled_task.interval != previous_interval:
+                logger.info(f"Rescheduling {scheduled_task.name} to run every {scheduled_task.interval:.0f}s: {scheduled_task.reason}")
+                self._push(scheduled_task, run_at)
+
+    def _run_task(self, scheduled_task: ScheduledTask):
+        try:
+            if (
+                scheduled_task.recurring_task.skip_if_running
+                and scheduled_task.last_task_id is not None
+                and self.task_queue.is_pending(scheduled_task.last_task_id)
+            ):
+                logger.info(f"Skipping recurring task {scheduled_task.name}, its last run is still queued or running")
+            else:
+                logger.info(f"Scheduling recurring task {scheduled_task.name}")
+                scheduled_task.last_task_id = self.task_queue.put(
+                    scheduled_task.name,
+                    scheduled_task.recurring_task.args,
+                    scheduled_task.recurring_task.kwargs,
+                    timeout=scheduled_task.recurring_task.timeout,
+                    dedupe=True
+                )
+        except Exception as e:
+            logger.error(f"Error scheduling recurring task {scheduled_task.name}: {e}", exc_info=True)
+
+        scheduled_task.last_run_at = time.monotonic()
+        scheduled_task.jitter = random.uniform(0, scheduled_task.recurring_task.jitter)
+        self._push(scheduled_task, scheduled_task.last_run_at + scheduled_task.update_interval() + scheduled_task.jitter)
@@ -1,18 +1,64 @@
 import asyncio
-import importlib
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import inspect
 import multiprocessing
+import os
+import psutil
+from queue import Empty
+import sqlite3
 import threading
 import time
 import logging
 import sys
-from queue import Empty
 from typing import Callable, Optional
 from logging.handlers import QueueHandler, QueueListener
-from sqlmodel import Session, select
 
-from config import db_engine
+from config import settings
 from core.cache import initialize_cache
-from core.event_manager import event_manager
+from core.cancellation import CancellationToken, TaskCancelled, current_token
+from core.event_bus import event_bus
+from core.readiness import ResourceNotReady, get_unready_resources, is_failed, is_ready
+from core.scheduler import Scheduler
+from core.task_queue import TaskQueue, get_task_name, resolve_task
+
+# Modules the forkserver imports once, so the workers forked from it start
+# with them loaded. Only modules which don't bind the cache or task manager at
+# import time, since those are set up in each worker after it starts.
+FORKSERVER_PRELOAD = [
+    'config',
+    'core.blobs',
+    'core.cancellation',
+    'core.task_queue',
+    'emails.bodies',
+    'fireworks.client',
+    'google.oauth2.credentials',
+    'googleapiclient.discovery',
+    'httpx',
+    'library',
+    'pendulum',
+    'playwright.sync_api',
+    'psutil',
+]
+
+def configure_start_method():
+    """
+    Set how worker processes are started, before any are. Linux uses a
+    forkserver which preloads the heavy modules once, so workers start
+    faster and share those pages. macOS and Windows use spawn, as do
+    packaged builds, which PyInstaller only supports spawn in.
+    """
+    start_method = settings.worker_start_method
+    if start_method is None:
+        if sys.platform.startswith('linux') and not settings.packaged:
+            start_method = 'forkserver'
+        else:
+            start_method = 'spawn'
+
+    multiprocessing.set_start_method(start_method)
+    if start_method == 'forkserver':
+        # Modules which fail to import are skipped
+        multiprocessing.set_forkserver_preload(FORKSERVER_PRELOAD)
 
 # Function to configure worker logging
 def configure_worker_logging(log_queue):
@@ -22,8 +68,187 @@ def configure_worker_logging(log_queue):
         logger.setLevel(logging.INFO)
         logger.addHandler(queue_handler)
 
+# Keeps the leases on a worker's claimed tasks from running out while it's alive
+def heartbeat(task_queue, worker_name, done_event, logger):
+    while not done_event.wait(task_queue.visibility_timeout / 3):
+        try:
+            task_queue.extend_leases(worker_name)
+        except sqlite3.Error as e:
+            logger.error(f"Error extending task leases: {e}")
+
+def is_async_task(task_name: str):
+    try:
+        return inspect.iscoroutinefunction(resolve_task(task_name))
+    except (ImportError, AttributeError, ValueError):
+        # execute_task() reports the error
+        return False
+
+# Run a claimed task, sync tasks on the executor and async ones on the loop
+async def execute_task(claimed_task, running_tasks, task_queue, cache, sync_executor, result_queue, logger):
+    logger.info(f"Executing task {claimed_task.name} with args {claimed_task.args} and kwargs {claimed_task.kwargs}")
+    token = None
+    try:
+        task = resolve_task(claimed_task.name)
+
+        # Hold tasks whose resources are still being prepared in the queue,
+        # and fail those whose resources couldn't be
+        unready_resources = get_unready_resources(task)
+        if unready_resources:
+            failed_resources = [
+                resource for resource in unready_resources
+                if is_failed(resource, task_queue)
+            ]
+            if failed_resources:
+                raise ResourceNotReady(f"Couldn't prepare {', '.join(failed_resources)}")
+            logger.info(f"Deferring task {claimed_task.name} until {unready_resources[0]} is ready")
+            task_queue.wait_for_resource(claimed_task.id, unready_resources[0])
+            return
+
+        token = CancellationToken(
+            claimed_task.id,
+            claimed_task.timeout,
+            final_attempt=claimed_task.attempts >= claimed_task.max_attempts
+        )
+        running_tasks[asyncio.current_task()] = token
+        current_token.set(token)
+
+        # The timeout runs from when the task starts rather than from the
+        # claim, so time spent waiting for a sync thread doesn't count
+        def start():
+            token.start()
+            task_queue.start(claimed_task.id)
+
+        cache.set('last_task', task.__name__)
+        if is_async_task(claimed_task.name):
+            start()
+            result = await task(*claimed_task.args, **claimed_task.kwargs)
+        else:
+            def run_sync_task():
+                start()
+                return task(*claimed_task.args, **claimed_task.kwargs)
+
+            # Copy our context into the thread, so the task sees its token
+            result = await asyncio.get_running_loop().run_in_executor(
+                sync_executor,
+                contextvars.copy_context().run,
+                run_sync_task
+            )
+        task_queue.complete(claimed_task.id)
+        logger.info(f"Task {task.__name__} completed")
+
+        # Report the completed task to the main process, along with its
+        # result so it knows what changed
+        result_queue.put(('result', (task.__name__, result)))
+
+    except (TaskCancelled, asyncio.CancelledError) as e:
+        if token is None or not token.cancelled:
+            raise
+        if token.timed_out:
+            logger.error(f"Task {claimed_task.name} timed out after {claimed_task.timeout:.0f}s (attempt {claimed_task.attempts})")
+            task_queue.fail(claimed_task.id, f'TimeoutError: Timed out after {claimed_task.timeout:.0f}s')
+        else:
+            logger.info(f"Task {claimed_task.name} cancelled")
+            task_queue.mark_cancelled(claimed_task.id)
+
+    except Exception as e:
+        logger.error(f"Error executing task {claimed_task.name} (attempt {claimed_task.attempts}): {e}", exc_info=True)
+        task_queue.fail(claimed_task.id, f'{type(e).__name__}: {e}')
+
+# Cancel running tasks which were asked to cancel or ran past their timeout.
+# Async tasks are interrupted, sync ones have to notice their token.
+def cancel_running_tasks(running_tasks, task_queue, worker_name, logger):
+    cancel_requests = task_queue.get_cancel_requests(worker_name) if running_tasks else set()
+    for running_task, token in running_tasks.items():
+        if token is None or token.cancelled:
+            # Not started yet, or already cancelled
+            continue
+
+        if token.task_id in cancel_requests:
+            token.cancel()
+        elif token.is_overdue():
+            token.cancel(timed_out=True)
+        else:
+            continue
+
+        logger.info(f"Cancelling task {token.task_id}{' which timed out' if token.timed_out else ''}")
+        if running_task.get_name() == 'async':
+            running_task.cancel()
+
+# A worker's event loop, which keeps up to worker_task_concurrency tasks in flight
+async def run_tasks(task_queue, worker_name, stop_event, retire_event, cache, sync_executor, result_queue, logger):
+    loop = asyncio.get_running_loop()
+    running_tasks = {}  # Each running task's cancellation token, None until it starts
+    task_added = None
+
+    # The autoscaler retires a worker by setting its retire event, which lets
+    # it finish the tasks it's running first
+    while not stop_event.is_set() and not retire_event.is_set():
+        cancel_running_tasks(running_tasks, task_queue, worker_name, logger)
+
+        # Only claim as many tasks as we have room to start, so we don't sit
+        # on tasks other workers could be running: sync tasks only for the
+        # free sync threads, and async ones for the rest of the batch
+        running_sync_tasks = sum(1 for running_task in running_tasks if running_task.get_name() == 'sync')
+        free_sync_threads = max(0, settings.worker_sync_threads - running_sync_tasks)
+        free_slots = settings.worker_task_concurrency - len(running_tasks)
+        claimed_tasks = []
+        if free_slots > 0:
+            # Clear the wakeups before claiming, so a task added after the
+            # claim still wakes us
+            task_queue.clear_wakeups()
+            claimed_tasks = task_queue.claim(
+                worker_name,
+                limit=min(free_slots, settings.task_claim_batch_size),
+                max_sync=free_sync_threads,
+                is_async=is_async_task
+            )
+            for claimed_task in claimed_tasks:
+                running_task = asyncio.create_task(
+                    execute_task(claimed_task, running_tasks, task_queue, cache, sync_executor, result_queue, logger),
+                    name='async' if is_async_task(claimed_task.name) else 'sync'
+                )
+                # execute_task() adds its token once it starts
+                running_tasks[running_task] = None
+
+        if len(claimed_tasks) == settings.task_claim_batch_size:
+            # There may be more waiting
+            continue
+
+        # Wait for a task to finish, or with room for more, a task to be
+        # added. Wakes up periodically for retries whose backoff has passed,
+        # to check the stop and retire events and to cancel tasks.
+        waiting_on = set(running_tasks)
+        if free_slots > len(claimed_tasks):
+            if task_added is None or task_added.done():
+                task_added = loop.run_in_executor(None, task_queue.wait, 1)
+            waiting_on.add(task_added)
+        done, _ = await asyncio.wait(waiting_on, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+        for running_task in done:
+            running_tasks.pop(running_task, None)
+
+    if running_tasks:
+        logger.info(f"Waiting for {len(running_tasks)} running tasks to finish")
+        await asyncio.wait(running_tasks)
+
 # Worker function
-def worker(task_queue, stop_event, log_queue, cache_manager_dict, cache_manager_lock, task_manager_log_file, pipe_conn):
+# Set in worker processes, which send events to the main process along with
+# their task results
+worker_result_queue = None
+
+def publish_event(event: dict):
+    """
+    Push an event to the browser extension, like a download's progress,
+    from a worker or the main process.
+    """
+    if worker_result_queue is not None:
+        worker_result_queue.put(('event', event))
+    else:
+        event_bus.publish_event(event)
+
+def worker(task_queue, stop_event, retire_event, log_queue, cache_manager_dict, cache_manager_lock, task_manager_log_file, result_queue):
+    global worker_result_queue
+    worker_result_queue = result_queue
+
     configure_worker_logging(log_queue)
     logger = logging.getLogger(f'worker-{multiprocessing.current_process().name}')
 
@@ -41,46 +266,25 @@ def worker(task_queue, stop_event, log_queue, cache_manager_dict, cache_manager_
         log_file=task_manager_log_file
     )
 
-    while not stop_event.is_set():
-        try:
-            task, args, kwargs = task_queue.get(timeout=1)
-            logger.info(f"Executing task {task.__name__} with args {args} and kwargs {kwargs}")
-            try:
-                cache.set('last_task', task.__name__)
-                task(*args, **kwargs)
-                logger.info(f"Task {task.__name__} completed")
-
-                # Send a message through the pipe when the task is completed
-                pipe_conn.send(task.__name__)
-
-            except Exception as e:
-                logger.error(f"Error executing task {task.__name__}: {e}", exc_info=True)
-        except Empty:
-            continue
-
-# Scheduler function using threading
-def scheduler(task_queue, stop_event, log_queue, recurring_tasks):
-    configure_worker_logging(log_queue)
-    logger = logging.getLogger(f'scheduler-{threading.current_thread().name}')
-
-    # Schedule the initial next run times with an offset of 5 seconds to allow
-    # the setup tasks to get in the queue first
-    next_run_times = {task: time.time() + 5 for task, interval, args, kwargs in recurring_tasks}
-
-    while not stop_event.is_set():
-        current_time = time.time()
-        for task_name, interval, args, kwargs in recurring_tasks:
-            if current_time >= next_run_times[task_name]:
-                # Convert the task name into a function object
-                module_name, function_name = task_name.rsplit('.', 1)
-                module = importlib.import_module(module_name)
-                task = getattr(module, function_name)
-
-                logger.info(f"Scheduling recurring task {task.__name__}")
-                task_queue.put((task, args, kwargs))
-                next_run_times[task_name] = current_time + interval
-
-        time.sleep(1)
+    worker_name = f'{multiprocessing.current_process().name}-{os.getpid()}'
+    # The heartbeat waits on an event of its own rather than the stop event,
+    # since a process exiting while it waits on a multiprocessing.Event
+    # leaves the next set() blocked forever
+    heartbeat_done = threading.Event()
+    heartbeat_thread = threading.Thread(target=heartbeat, args=(task_queue, worker_name, heartbeat_done, logger), daemon=True)
+    heartbeat_thread.start()
+
+    # Sync tasks run on their own thread pool, so they don't block the
+    # event loop the async tasks share
+    sync_executor = ThreadPoolExecutor(max_workers=settings.worker_sync_threads, thread_name_prefix='task')
+    try:
+        asyncio.run(run_tasks(task_queue, worker_name, stop_event, retire_event, cache, sync_executor, result_queue, logger))
+    finally:
+        sync_executor.shutdown()
+
+    heartbeat_done.set()
+    heartbeat_thread.join()
+    logger.info(f"Worker {worker_name} exiting")
 
 # Function to setup logging in the main process
 def setup_main_logger(log_queue, log_file=None):
@@ -102,6 +306,21 @@ def setup_main_logger(log_queue, log_file=None):
     queue_listener.start()
     return logger, queue_listener
 
+class WorkerProcess:
+    """A worker process, and the event which asks it to retire."""
+    def __init__(self, process: multiprocessing.Process, retire_event):
+        self.process = process
+        self.retire_event = retire_event
+
+    @property
+    def name(self):
+        # Matches the name the worker claims tasks under
+        return f'{self.process.name}-{self.process.pid}'
+
+    @property
+    def retiring(self):
+        return self.retire_event.is_set()
+
 class TaskManager:
     def __init__(
             self,
@@ -113,99 +332,301 @@ class TaskManager:
             log_queue = None,
             stop_event = None
         ):
-        self.task_queue = task_queue if task_queue is not None else multiprocessing.Queue()
+        self.task_queue = task_queue if task_queue is not None else TaskQueue(
+            settings.task_queue_database_path,
+            visibility_timeout=settings.task_visibility_timeout,
+            max_attempts=settings.task_max_attempts,
+            retry_backoff=settings.task_retry_backoff,
+            history_size=settings.task_history_size
+        )
         self.workers = []
 
         self.recurring_tasks = recurring_tasks if recurring_tasks is not None else []
-        self.scheduler_thread = None
+        self.scheduler = None
 
         self._stop_event = stop_event if stop_event is not None else multiprocessing.Event()
         self.log_queue = log_queue if log_queue is not None else multiprocessing.Queue()
         self.log_file = log_file
         self.logger, self.queue_listener = setup_main_logger(self.log_queue, self.log_file)
 
-        # multiprocess Manager dict and lock for workers to use initializing the cache
+        # multiprocess Manager dict and lock for workers to use initializing the
+        # cache, or None with the SQLite cache
         self.cache_manager_dict = cache_manager_dict
         self.cache_manager_lock = cache_manager_lock
 
-        # Create a pipe so the worker processes can communicate with the main process
-        self.parent_conn, self.child_conn = multiprocessing.Pipe()
+        # Workers report completed tasks to the main process through a queue,
+        # which unlike a pipe is safe for several of them to write to
+        self.result_queue = multiprocessing.Queue()
 
-    def add_task(self, task: Callable, *args, **kwargs):
-        self.logger.info(f"Adding task {task.__name__}")
-        self.task_queue.put((task, args, kwargs))
-
-    def start(self, num_workers: int = 4):
-        self.logger.info(f"Starting {num_workers} workers")
-        for _ in range(num_workers):
-            process = multiprocessing.Process(
-                target=worker,
-                args=(
-                    self.task_queue,
-                    self._stop_event,
-                    self.log_queue,
-                    self.cache_manager_dict,
-                    self.cache_manager_lock,
-                    self.log_file,
-                    self.child_conn,
-                )
-            )
-            process.start()
-            self.workers.append(process)
+        # Sizing the worker pool
+        self.min_workers = settings.min_workers
+        self.max_workers = settings.max_workers
+        self.autoscaler_thread = None
+        self._idle_since = None
+        self._llm_processes = {}
 
-        # Start the scheduler thread
-        scheduler_thread = threading.Thread(
-            target=scheduler,
-            args=(self.task_queue, self._stop_event, self.log_queue, self.recurring_tasks)
+    def add_task(
+            self,
+            task: Callable,
+            *args,
+            max_attempts: Optional[int] = None,
+            timeout: Optional[float] = None,
+            dedupe: bool = False,
+            **kwargs
+        ):
+        """
+        Queue a task to run in a worker and return its id. Tasks must be
+        module-level functions with JSON-serializable arguments, see TaskQueue.
+
+        Tasks can be coroutine functions, which run on the worker's event loop
+        so one worker can have many of them waiting on the network at once.
+        Sync tasks run on the worker's thread pool.
+
+        An attempt which runs longer than timeout seconds is cancelled and
+        counts as failed. Async tasks are interrupted, sync tasks should call
+        check_cancelled() as they go. If the task is still running after
+        task_cancel_grace_period, its worker is killed and replaced.
+
+        With dedupe, a task already queued with the same arguments isn't
+        queued again, see TaskQueue.put().
+        """
+        self.logger.info(f"Adding task {task.__name__}")
+        return self.task_queue.put(
+            get_task_name(task),
+            args,
+            kwargs,
+            max_attempts=max_attempts,
+            timeout=timeout,
+            dedupe=dedupe
         )
-        scheduler_thread.start()
-        self.scheduler_thread = scheduler_thread
 
-        # Start the pipe watcher thread
-        watcher_thread = threading.Thread(target=self.watch_pipe)
+    def cancel_task(self, task_id: int):
+        """Cancel a queued or running task, see TaskQueue.cancel()."""
+        self.logger.info(f"Cancelling task {task_id}")
+        return self.task_queue.cancel(task_id)
+
+    def start(self, min_workers: Optional[int] = None, max_workers: Optional[int] = None):
+        """
+        Start the workers, the scheduler and the event bus. The worker pool
+        grows and shrinks between min_workers and max_workers, which default
+        to the settings.
+        """
+        if min_workers is not None:
+            self.min_workers = min_workers
+        if max_workers is not None:
+            self.max_workers = max(max_workers, self.min_workers)
+
+        # Pick up where the last run left off
+        self.task_queue.recover()
+
+        self.logger.info(f"Starting {self.min_workers} workers, scaling up to {self.max_workers}")
+        for _ in range(self.min_workers):
+            self._start_worker()
+
+        # Start the autoscaler thread
+        self.autoscaler_thread = threading.Thread(target=self.autoscale, daemon=True)
+        self.autoscaler_thread.start()
+
+        # Start the scheduler for the recurring tasks
+        self.scheduler = Scheduler(self.task_queue, self.recurring_tasks)
+        self.scheduler.start()
+
+        # Start the event bus and the watcher thread which feeds it
+        event_bus.start()
+        watcher_thread = threading.Thread(target=self.watch_results)
         watcher_thread.start()
         self.watcher_thread = watcher_thread
 
+    def wake_scheduler(self):
+        """Have the scheduler re-evaluate adaptive intervals now, like when the user becomes active."""
+        if self.scheduler:
+            self.scheduler.wake()
+
     def stop(self):
         self.logger.info("Stopping all workers")
         self._stop_event.set()
 
-        # Stop the scheduler thread
-        if self.scheduler_thread:
-            self.scheduler_thread.join()
+        # Stop the scheduler
+        if self.scheduler:
+            self.scheduler.stop()
 
-        # Stop the watcher thread
+        # Stop the watcher thread and the event bus
         if self.watcher_thread:
             self.watcher_thread.join()
+        event_bus.stop()
 
         # Stop all workers
         for worker in self.workers:
-            if isinstance(worker, multiprocessing.Process):
-                worker.terminate()
-                worker.join()
+            worker.process.terminate()
+            worker.process.join()
 
         # TODO: Couldn't get the queue listener to stop properly on Windows,
         # commenting out for now
         # self.queue_listener.stop()
 
-    def watch_pipe(self):
+    def _start_worker(self):
+        retire_event = multiprocessing.Event()
+        process = multiprocessing.Process(
+            target=worker,
+            args=(
+                self.task_queue,
+                self._stop_event,
+                retire_event,
+                self.log_queue,
+                self.cache_manager_dict,
+                self.cache_manager_lock,
+                self.log_file,
+                self.result_queue,
+            )
+        )
+        process.start()
+        self.workers.append(WorkerProcess(process, retire_event))
+
+    def autoscale(self):
+        """
+        Grow the worker pool when tasks are waiting and the machine has room
+        for another worker, and retire workers once the queue has been empty
+        for a while. Changes the pool by one worker per check, so a burst
+        doesn't overshoot.
+        """
+        while not self._stop_event.wait(settings.worker_autoscale_interval):
+            try:
+                self._autoscale_once()
+            except Exception as e:
+                self.logger.error(f"Error autoscaling workers: {e}", exc_info=True)
+
+    def _autoscale_once(self):
+        self._kill_overrunning_workers()
+        self._reap_workers()
+        self._release_waiting_tasks()
+
+        wait_times = self.task_queue.get_wait_times()
+        active_workers = [worker for worker in self.workers if not worker.retiring]
+
+        if wait_times:
+            self._idle_since = None
+            if len(active_workers) < self.max_workers and self._should_scale_up(wait_times, len(active_workers)):
+                self._start_worker()
+                self.logger.info(f"Scaled up to {len(active_workers) + 1} workers")
+            return
+
+        # Retire an idle worker once the queue has been empty for long enough
+        if self._idle_since is None:
+            self._idle_since = time.monotonic()
+        if len(active_workers) > self.min_workers and time.monotonic() - self._idle_since > settings.worker_idle_timeout:
+            busy_workers = self.task_queue.get_busy_workers()
+            idle_workers = [worker for worker in active_workers if worker.name not in busy_workers]
+            if idle_workers:
+                idle_workers[-1].retire_event.set()
+                self._idle_since = time.monotonic()
+                self.logger.info(f"Retiring idle worker {idle_workers[-1].name}, scaling down to {len(active_workers) - 1} workers")
+
+    def _release_waiting_tasks(self):
+        """
+        Release tasks waiting for resources which are ready or failed.
+        preparing() releases them as soon as it's done, so this catches tasks
+        which started waiting just after, and resources whose preparing task
+        died.
+        """
+        for resource in self.task_queue.get_waiting_resources():
+            if is_ready(resource) or is_failed(resource, self.task_queue):
+                self.task_queue.release_waiting(resource)
+
+    def _kill_overrunning_workers(self):
+        """
+        Kill workers whose tasks kept running past the grace period after
+        they timed out or were cancelled, like a sync task stuck on a wedged
+        llamafile. _reap_workers() replaces them.
+        """
+        workers_by_name = {worker.name: worker for worker in self.workers}
+        for task_id, worker_name, timed_out in self.task_queue.get_overrunning_tasks(settings.task_cancel_grace_period):
+            worker = workers_by_name.get(worker_name)
+            if worker is None or not worker.process.is_alive():
+                # Its lease will run out
+                continue
+
+            self.logger.error(f"Killing worker {worker_name}, task {task_id} didn't stop after it {'timed out' if timed_out else 'was cancelled'}")
+            worker.retire_event.set()
+            worker.process.kill()
+            worker.process.join()
+
+            if timed_out:
+                self.task_queue.fail(task_id, 'TimeoutError: Timed out, killed the worker running it')
+            else:
+                self.task_queue.mark_cancelled(task_id)
+
+            # The worker's other tasks didn't do anything wrong
+            self.task_queue.release_worker(worker_name)
+
+    def _reap_workers(self):
+        """Forget workers which exited, and replace any which died below the minimum."""
+        for worker in [worker for worker in self.workers if not worker.process.is_alive()]:
+            worker.process.join()
+            self.workers.remove(worker)
+            if not worker.retiring:
+                self.logger.error(f"Worker {worker.name} died with exit code {worker.process.exitcode}")
+
+        for _ in range(self.min_workers - len([worker for worker in self.workers if not worker.retiring])):
+            self._start_worker()
+
+    def _should_scale_up(self, wait_times: dict, num_workers: int):
+        # Scale up when there's more queued than the workers can claim at
+        # once, or a type of task has been waiting too long
+        queued = sum(count for _, count in wait_times.values())
+        task_name, (longest_wait, _) = max(wait_times.items(), key=lambda item: item[1][0])
+        if queued <= num_workers * settings.task_claim_batch_size and longest_wait < settings.worker_scale_up_wait:
+            return False
+
+        # But not if another worker would run the machine out of memory
+        available_memory = psutil.virtual_memory().available
+        if available_memory < settings.worker_min_available_memory:
+            self.logger.info(f"Not scaling up, only {available_memory // (1024 * 1024)} MiB of memory available")
+            return False
+
+        # Or if llamafile is already saturating the CPU, since most tasks
+        # would only end up waiting on it
+        llm_cpu_percent = self._get_llm_cpu_percent()
+        if llm_cpu_percent > settings.worker_max_llm_cpu_percent:
+            self.logger.info(f"Not scaling up, llamafile is using {llm_cpu_percent:.0f}% of the CPU")
+            return False
+
+        self.logger.info(f"Scaling up for {queued} queued tasks, {task_name} has waited {longest_wait:.0f}s")
+        return True
+
+    def _get_llm_cpu_percent(self):
+        """The share of the machine's CPU the llamafile servers are using."""
+        from core.cache import cache
+        state = cache.get('llm_service_state') or {}
+        pids = {model_state['pid'] for model_state in state.values() if model_state.get('pid')}
+
+        total_percent = 0
+        for pid in pids:
+            try:
+                # cpu_percent() measures since the last call, so keep the
+                # Process objects around between checks
+                if pid not in self._llm_processes:
+                    self._llm_processes[pid] = psutil.Process(pid)
+                total_percent += self._llm_processes[pid].cpu_percent()
+            except psutil.Error:
+                self._llm_processes.pop(pid, None)
+
+        return total_percent / (psutil.cpu_count() or 1)
+
+    def watch_results(self):
         while not self._stop_event.is_set():
-            if self.parent_conn.poll(1):  # Check if there is a message
-                task_name = self.parent_conn.recv()
-
-                # Use the event system to push a Mailbox state update after
-                # completing a process_inbox_message task or a execute_function_for_message
-                # task
-                if task_name in ("process_inbox_message", "execute_function_for_message"):
-                    self.logger.info('Pushing mailbox state to event system')
-                    # TODO: Should probably make this a Mailbox class method
-                    from emails.models import Mailbox
-                    with Session(db_engine) as session:
-                        mailbox = session.exec(select(Mailbox)).one()
-                        message = { "type": "mailbox", "messages": mailbox.get_messages() }
-                        asyncio.run(event_manager.notify(message))
+            # Block until a worker reports a completed task, waking up
+            # periodically to check the stop event
+            try:
+                kind, payload = self.result_queue.get(timeout=1)
+            except Empty:
+                continue
+
+            if kind == 'event':
+                event_bus.publish_event(payload)
             else:
-                time.sleep(0.1) # Avoid busy waiting
+                # Hand the result to the event bus, which coalesces the
+                # changes and pushes them on the server's event loop
+                event_bus.publish_task_result(*payload)
 
 task_manager = None
 
@@ -219,9 +640,10 @@ def initialize_task_manager(
         stop_event = None
     ):
     # If cache_manager_dict and cache_manager_lock are not provided, assume the
-    # cache has already been initialized in this process and use its values
-    from .cache import cache
-    if cache_manager_dict is None or cache_manager_lock is None:
+    # cache has already been initialized in this process and use its values.
+    # The SQLite cache doesn't need them, each process opens it itself.
+    from .cache import SharedCache, cache
+    if (cache_manager_dict is None or cache_manager_lock is None) and isinstance(cache, SharedCache):
         cache_manager_dict = cache.cache
         cache_manager_lock = cache.lock
 
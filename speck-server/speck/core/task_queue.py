@@ -0,0 +1,623 @@
+import importlib
+import json
+import logging
+import math
+import multiprocessing
+import random
+import sqlite3
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bump when the queue's tables change. Queued tasks are kept where possible,
+# see _create_tables().
+TASK_QUEUE_SCHEMA_VERSION = 4
+
+# Finished and cancelled tasks are pruned down to the history size every
+# this many completions
+PRUNE_INTERVAL = 100
+
+# Queued tasks a claim looks through for ones the worker has room for, when
+# it's limiting how many sync tasks it takes
+CLAIM_SCAN_SIZE = 100
+
+# Tasks which can be claimed: queued, available and not waiting on a
+# resource, or running with a lapsed lease, and not being cancelled. Takes
+# the current time twice.
+CLAIMABLE_CONDITION = (
+    "((status = 'queued' AND available_at <= ? AND waiting_on IS NULL) OR (status = 'running' AND lease_expires_at <= ?)) "
+    'AND cancel_requested_at IS NULL'
+)
+
+
+def get_task_name(task: Callable):
+    """The dotted path a task is stored under, like 'emails.tasks.sync_inbox'."""
+    return f'{task.__module__}.{task.__qualname__}'
+
+
+_resolved_tasks = {}
+
+def resolve_task(task_name: str):
+    """Import a task from its dotted path, once per process."""
+    if task_name not in _resolved_tasks:
+        module_name, function_name = task_name.rsplit('.', 1)
+        _resolved_tasks[task_name] = getattr(importlib.import_module(module_name), function_name)
+    return _resolved_tasks[task_name]
+
+
+def get_percentiles(values: List[float], percentiles=(50, 95, 99)):
+    """Nearest-rank percentiles, like {'p50': 1.2, ...}, or None for no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return {
+        f'p{percentile}': round(values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)], 3)
+        for percentile in percentiles
+    }
+
+
+class ClaimedTask(NamedTuple):
+    id: int
+    name: str
+    args: list
+    kwargs: dict
+    attempts: int
+    max_attempts: int
+    timeout: Optional[float]
+
+
+class TaskQueue:
+    """
+    Durable task queue in its own SQLite database, so queued work survives
+    restarts and crashes.
+
+    Workers claim batches of tasks, which leases them for the visibility
+    timeout. A worker keeps extending the leases while it's alive, so if it
+    dies its tasks become claimable again once their leases run out. Failed
+    tasks are retried with exponential backoff, and after max_attempts they
+    are dead-lettered: kept with their error, but never run again.
+
+    Tasks can have a timeout per attempt, and running tasks can be asked to
+    cancel. Either way the worker cancels the task cooperatively, and the
+    TaskManager kills workers which don't stop, see get_overrunning_tasks().
+
+    Tasks whose resources aren't ready yet wait in the queue without being
+    claimed until they are, see wait_for_resource().
+
+    Finished and cancelled tasks are kept with their timestamps, for the
+    latency stats, until there are more than history_size of them.
+
+    Tasks are stored by dotted path with JSON arguments, so they must be
+    module-level functions taking JSON-serializable arguments. Adding a task
+    which is already queued with the same arguments can return the queued
+    one instead, if asked, see put().
+
+    Picklable, so it can be handed to worker processes. Each process opens
+    its own connections.
+    """
+    def __init__(
+            self,
+            path: str,
+            visibility_timeout: float = 60,
+            max_attempts: int = 3,
+            retry_backoff: float = 5,
+            max_retry_backoff: float = 300,
+            history_size: int = 1000
+        ):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self.history_size = history_size
+        self._completions = 0
+
+        # Released whenever a task is added, so idle workers wake up right
+        # away instead of polling. A semaphore rather than an Event, since a
+        # worker killed while waiting on an Event leaves its next set() blocked
+        # forever.
+        self._task_added = multiprocessing.Semaphore(0)
+
+        self._local = threading.local()
+        self._create_tables()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_connection(self):
+        # sqlite3 connections can't be shared between threads, so each thread
+        # gets its own. Autocommit, with explicit transactions.
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = wal')
+            connection.execute('PRAGMA synchronous = normal')
+            self._local.connection = connection
+        return connection
+
+    def _create_tables(self):
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if connection.execute('PRAGMA user_version').fetchall()[0][0] == TASK_QUEUE_SCHEMA_VERSION:
+                return
+
+            # Tables from earlier versions are rebuilt, keeping their tasks
+            existing_columns = [row[1] for row in connection.execute('PRAGMA table_info(task)').fetchall()]
+            if existing_columns:
+                connection.execute('ALTER TABLE task RENAME TO old_task')
+                connection.execute('DROP INDEX IF EXISTS ix_task_status_available_at')
+                connection.execute('DROP INDEX IF EXISTS ix_task_status_lease_expires_at')
+                connection.execute('DROP INDEX IF EXISTS ix_task_name_status')
+                connection.execute('DROP INDEX IF EXISTS ix_task_status_id')
+
+            # AUTOINCREMENT, so the ids of removed tasks are never reused for
+            # new ones, since they're used to cancel tasks
+            connection.execute(
+                'CREATE TABLE task ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'name TEXT NOT NULL, '
+                'args TEXT NOT NULL, '
+                'kwargs TEXT NOT NULL, '
+                "status TEXT NOT NULL DEFAULT 'queued', "  # queued, running, finished, cancelled or dead
+                'attempts INTEGER NOT NULL DEFAULT 0, '
+                'max_attempts INTEGER NOT NULL, '
+                'timeout REAL, '  # Seconds an attempt may run for, or NULL for no limit
+                'available_at REAL NOT NULL, '  # When a queued task can next be claimed
+                'lease_expires_at REAL, '  # When a running task can be claimed again
+                'started_at REAL, '  # When the latest attempt started running, its timeout counts from here
+                'wait_time REAL, '  # Seconds the latest attempt waited to be claimed
+                'finished_at REAL, '  # When the task finished, was cancelled or dead-lettered
+                'cancel_requested_at REAL, '  # When cancelling a running task was requested
+                'waiting_on TEXT, '  # The resource a queued task is waiting for, see wait_for_resource()
+                'worker TEXT, '
+                'error TEXT, '
+                'created_at REAL NOT NULL'
+                ')'
+            )
+            connection.execute('CREATE INDEX ix_task_status_available_at ON task (status, available_at)')
+            connection.execute('CREATE INDEX ix_task_status_lease_expires_at ON task (status, lease_expires_at)')
+            connection.execute('CREATE INDEX ix_task_name_status ON task (name, status)')
+            connection.execute('CREATE INDEX ix_task_status_id ON task (status, id)')
+
+            if existing_columns:
+                columns = ', '.join(existing_columns)
+                connection.execute(f'INSERT INTO task ({columns}) SELECT {columns} FROM old_task')
+                connection.execute('DROP TABLE old_task')
+
+            connection.execute(f'PRAGMA user_version = {TASK_QUEUE_SCHEMA_VERSION}')
+
+    def put(
+            self,
+            task_name: str,
+            args: tuple = (),
+            kwargs: Optional[dict] = None,
+            max_attempts: Optional[int] = None,
+            timeout: Optional[float] = None,
+            dedupe: bool = False
+        ):
+        """
+        Queue a task by its dotted path and return its id. Each attempt may
+        run for timeout seconds, if given.
+
+        With dedupe, if the same task is already queued with the same
+        arguments, returns that one's id instead, and it keeps its own
+        max_attempts and timeout. It's for tasks queued over and over, like
+        recurring ones, which only need to run once however often they are.
+        """
+        encoded_args = json.dumps(list(args))
+        encoded_kwargs = json.dumps(kwargs or {}, sort_keys=True)
+
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            if dedupe:
+                rows = connection.execute(
+                    "SELECT id FROM task WHERE name = ? AND status = 'queued' AND args = ? AND kwargs = ?",
+                    (task_name, encoded_args, encoded_kwargs)
+                ).fetchall()
+                if rows:
+                    return rows[0][0]
+
+            now = time.time()
+            task_id = connection.execute(
+                'INSERT INTO task (name, args, kwargs, max_attempts, timeout, available_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (task_name, encoded_args, encoded_kwargs, max_attempts or self.max_attempts, timeout, now, now)
+            ).lastrowid
+
+        self._notify()
+        return task_id
+
+    def claim(
+            self,
+            worker: str,
+            limit: int = 1,
+            max_sync: Optional[int] = None,
+            is_async: Optional[Callable[[str], bool]] = None
+        ):
+        """
+        Atomically claim up to limit tasks which are queued and available, or
+        whose lease ran out, oldest first. With max_sync, at most that many
+        of them are sync tasks, so a worker only takes the sync tasks it has
+        threads free for and fills the rest with async ones.
+        """
+        now = time.time()
+        connection = self._get_connection()
+        scan_size = limit if max_sync is None else max(limit, CLAIM_SCAN_SIZE)
+
+        if max_sync is not None:
+            # Telling sync and async tasks apart can import their modules,
+            # which is slow the first time, so do it before taking the write
+            # lock rather than hold up every other worker. Tasks queued in
+            # between are left for the next claim.
+            task_names = connection.execute(
+                f'SELECT DISTINCT name FROM (SELECT name FROM task WHERE {CLAIMABLE_CONDITION} ORDER BY id LIMIT ?)',
+                (now, now, scan_size)
+            ).fetchall()
+            async_task_names = {name: is_async(name) for name, in task_names}
+
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+
+            # Cancel tasks being cancelled whose lease ran out, since the
+            # worker running them died
+            connection.execute(
+                "UPDATE task SET status = 'cancelled', finished_at = ? "
+                "WHERE status = 'running' AND lease_expires_at <= ? AND cancel_requested_at IS NOT NULL",
+                (now, now)
+            )
+
+            # Dead-letter tasks whose last attempt's lease ran out, since the
+            # worker running it died
+            connection.execute(
+                "UPDATE task SET status = 'dead', error = 'Worker died while running the task', finished_at = ? "
+                "WHERE status = 'running' AND lease_expires_at <= ? AND attempts >= max_attempts",
+                (now, now)
+            )
+
+            rows = connection.execute(
+                'SELECT id, name, args, kwargs, attempts, max_attempts, timeout, available_at FROM task '
+                f'WHERE {CLAIMABLE_CONDITION} ORDER BY id LIMIT ?',
+                (now, now, scan_size)
+            ).fetchall()
+
+            if max_sync is not None:
+                claimable_rows = []
+                for row in rows:
+                    if row[1] not in async_task_names:
+                        continue
+                    if not async_task_names[row[1]]:
+                        if max_sync <= 0:
+                            continue
+                        max_sync -= 1
+                    claimable_rows.append(row)
+                    if len(claimable_rows) == limit:
+                        break
+                rows = claimable_rows
+
+            connection.executemany(
+                "UPDATE task SET status = 'running', attempts = attempts + 1, lease_expires_at = ?, worker = ?, started_at = NULL, wait_time = ? "
+                'WHERE id = ?',
+                [
+                    (now + self.visibility_timeout, worker, now - available_at, task_id)
+                    for task_id, _, _, _, _, _, _, available_at in rows
+                ]
+            )
+
+        return [
+            ClaimedTask(
+                id=task_id,
+                name=name,
+                args=json.loads(args),
+                kwargs=json.loads(kwargs),
+                attempts=attempts + 1,
+                max_attempts=max_attempts,
+                timeout=timeout
+            )
+            for task_id, name, args, kwargs, attempts, max_attempts, timeout, _ in rows
+        ]
+
+    def start(self, task_id: int):
+        """Record that a claimed task started running, which starts its timeout."""
+        self._get_connection().execute(
+            "UPDATE task SET started_at = ? WHERE id = ? AND status = 'running'",
+            (time.time(), task_id)
+        )
+
+    def extend_leases(self, worker: str):
+        """Extend the leases on all of a worker's running tasks."""
+        self._get_connection().execute(
+            "UPDATE task SET lease_expires_at = ? WHERE worker = ? AND status = 'running'",
+            (time.time() + self.visibility_timeout, worker)
+        )
+
+    def complete(self, task_id: int):
+        self._get_connection().execute(
+            "UPDATE task SET status = 'finished', finished_at = ?, lease_expires_at = NULL WHERE id = ?",
+            (time.time(), task_id)
+        )
+
+        self._completions += 1
+        if self._completions % PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def prune(self):
+        """Delete the oldest finished and cancelled tasks beyond the history size."""
+        self._get_connection().execute(
+            "DELETE FROM task WHERE status IN ('finished', 'cancelled') AND id <= ("
+            "SELECT id FROM task WHERE status IN ('finished', 'cancelled') ORDER BY id DESC LIMIT 1 OFFSET ?"
+            ")",
+            (self.history_size,)
+        )
+
+    def fail(self, task_id: int, error: str):
+        """Retry a failed task after a backoff, or dead-letter it if it's out of attempts."""
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(
+                'SELECT attempts, max_attempts, cancel_requested_at FROM task WHERE id = ?', (task_id,)
+            ).fetchall()
+            if not rows:
+                return
+
+            attempts, max_attempts, cancel_requested_at = rows[0]
+            if cancel_requested_at is not None:
+                # It was being cancelled anyway
+                connection.execute(
+                    "UPDATE task SET status = 'cancelled', error = ?, finished_at = ?, lease_expires_at = NULL WHERE id = ?",
+                    (error, time.time(), task_id)
+                )
+                return
+
+            if attempts >= max_attempts:
+                logger.error(f"Task {task_id} failed {attempts} times, dead-lettering it")
+                connection.execute(
+                    "UPDATE task SET status = 'dead', error = ?, finished_at = ?, lease_expires_at = NULL WHERE id = ?",
+                    (error, time.time(), task_id)
+                )
+                return
+
+            # Exponential backoff with jitter, so retries of tasks which failed
+            # together don't all land at once
+            backoff = min(self.retry_backoff * 2 ** (attempts - 1), self.max_retry_backoff)
+            backoff *= random.uniform(0.8, 1.2)
+            connection.execute(
+                "UPDATE task SET status = 'queued', error = ?, available_at = ?, lease_expires_at = NULL, worker = NULL, started_at = NULL "
+                'WHERE id = ?',
+                (error, time.time() + backoff, task_id)
+            )
+
+    def release(self, task_ids: List[int]):
+        """
+        Put claimed tasks a worker didn't get to back in the queue, without
+        using up an attempt. Cancels those which were being cancelled.
+        """
+        self._get_connection().executemany(
+            "UPDATE task SET status = 'cancelled', finished_at = ?, lease_expires_at = NULL "
+            "WHERE id = ? AND status = 'running' AND cancel_requested_at IS NOT NULL",
+            [(time.time(), task_id) for task_id in task_ids]
+        )
+        self._get_connection().executemany(
+            "UPDATE task SET status = 'queued', attempts = attempts - 1, lease_expires_at = NULL, worker = NULL, started_at = NULL "
+            "WHERE id = ? AND status = 'running'",
+            [(task_id,) for task_id in task_ids]
+        )
+        self._notify()
+
+    def defer(self, task_id: int, delay: float):
+        """
+        Put a claimed task back in the queue for later, without using up an
+        attempt, like one whose resources aren't ready yet.
+        """
+        self._get_connection().execute(
+            "UPDATE task SET status = 'queued', attempts = attempts - 1, available_at = ?, lease_expires_at = NULL, worker = NULL, started_at = NULL "
+            "WHERE id = ? AND status = 'running'",
+            (time.time() + delay, task_id)
+        )
+
+    def wait_for_resource(self, task_id: int, resource: str):
+        """
+        Put a claimed task back in the queue until the resource it needs is
+        ready, without using up an attempt. Until release_waiting() is called
+        for the resource it can't be claimed, and doesn't count as waiting in
+        get_wait_times().
+        """
+        self._get_connection().execute(
+            "UPDATE task SET status = 'queued', attempts = attempts - 1, waiting_on = ?, lease_expires_at = NULL, worker = NULL, started_at = NULL "
+            "WHERE id = ? AND status = 'running'",
+            (resource, task_id)
+        )
+
+    def release_waiting(self, resource: str):
+        """Let the tasks waiting for a resource be claimed, now it's ready or couldn't be prepared."""
+        # They count as waiting to be claimed from now
+        cursor = self._get_connection().execute(
+            "UPDATE task SET waiting_on = NULL, available_at = ? WHERE status = 'queued' AND waiting_on = ?",
+            (time.time(), resource)
+        )
+        if cursor.rowcount:
+            logger.info(f"Released {cursor.rowcount} tasks waiting for {resource}")
+            self._notify()
+
+    def get_waiting_resources(self):
+        """The resources queued tasks are waiting for."""
+        return {
+            resource for resource, in self._get_connection().execute(
+                "SELECT DISTINCT waiting_on FROM task WHERE status = 'queued' AND waiting_on IS NOT NULL"
+            ).fetchall()
+        }
+
+    def release_worker(self, worker: str):
+        """Put all of a killed worker's running tasks back in the queue, without using up an attempt."""
+        task_ids = [
+            task_id for task_id, in self._get_connection().execute(
+                "SELECT id FROM task WHERE worker = ? AND status = 'running'", (worker,)
+            ).fetchall()
+        ]
+        self.release(task_ids)
+
+    def cancel(self, task_id: int):
+        """
+        Cancel a task. A queued task is removed right away and this returns
+        'cancelled'. A running task is asked to stop and this returns
+        'cancelling', its worker cancels it once it does. Returns None if the
+        task isn't queued or running.
+        """
+        connection = self._get_connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute("SELECT status FROM task WHERE id = ?", (task_id,)).fetchall()
+            if not rows or rows[0][0] not in ('queued', 'running'):
+                return None
+
+            if rows[0][0] == 'queued':
+                connection.execute(
+                    "UPDATE task SET status = 'cancelled', finished_at = ? WHERE id = ?", (time.time(), task_id)
+                )
+                return 'cancelled'
+
+            connection.execute(
+                'UPDATE task SET cancel_requested_at = coalesce(cancel_requested_at, ?) WHERE id = ?',
+                (time.time(), task_id)
+            )
+            return 'cancelling'
+
+    def mark_cancelled(self, task_id: int):
+        """Record that a running task stopped because it was cancelled."""
+        self._get_connection().execute(
+            "UPDATE task SET status = 'cancelled', finished_at = ?, lease_expires_at = NULL WHERE id = ?",
+            (time.time(), task_id)
+        )
+
+    def get_cancel_requests(self, worker: str):
+        """The ids of a worker's running tasks which were asked to cancel."""
+        return {
+            task_id for task_id, in self._get_connection().execute(
+                "SELECT id FROM task WHERE worker = ? AND status = 'running' AND cancel_requested_at IS NOT NULL",
+                (worker,)
+            ).fetchall()
+        }
+
+    def get_overrunning_tasks(self, grace_period: float):
+        """
+        Running tasks which are still running grace_period seconds after
+        their timeout passed or they were asked to cancel, as (id, worker,
+        timed_out) tuples.
+        """
+        now = time.time()
+        rows = self._get_connection().execute(
+            'SELECT id, worker, cancel_requested_at IS NULL FROM task '
+            "WHERE status = 'running' AND ("
+            '(cancel_requested_at IS NOT NULL AND cancel_requested_at + ? < ?) '
+            'OR (timeout IS NOT NULL AND started_at + timeout + ? < ?))',
+            (grace_period, now, grace_period, now)
+        ).fetchall()
+        return [(task_id, worker, bool(timed_out)) for task_id, worker, timed_out in rows]
+
+    def recover(self):
+        """
+        Requeue tasks which were running when the app last stopped, except
+        those which were being cancelled. Only call this on startup, before
+        any workers start.
+        """
+        self._get_connection().execute(
+            "UPDATE task SET status = 'cancelled', finished_at = ?, lease_expires_at = NULL "
+            "WHERE status = 'running' AND cancel_requested_at IS NOT NULL",
+            (time.time(),)
+        )
+        cursor = self._get_connection().execute(
+            "UPDATE task SET status = 'queued', available_at = ?, lease_expires_at = NULL, worker = NULL, started_at = NULL "
+            "WHERE status = 'running'",
+            (time.time(),)
+        )
+        queued = self._get_connection().execute("SELECT count(*) FROM task WHERE status = 'queued'").fetchall()[0][0]
+        logger.info(f"Recovered {cursor.rowcount} interrupted tasks, {queued} tasks queued")
+
+    def get_wait_times(self):
+        """
+        For each type of task waiting to be claimed, how long the oldest one
+        has been waiting in seconds and how many are waiting. Tasks waiting
+        for a resource aren't counted, since more workers wouldn't help them.
+        """
+        now = time.time()
+        rows = self._get_connection().execute(
+            "SELECT name, min(available_at), count(*) FROM task "
+            "WHERE status = 'queued' AND available_at <= ? AND waiting_on IS NULL GROUP BY name",
+            (now,)
+        ).fetchall()
+        return {name: (now - oldest_available_at, count) for name, oldest_available_at, count in rows}
+
+    def get_busy_workers(self):
+        """The workers which have claimed tasks."""
+        return {
+            worker for worker, in self._get_connection().execute(
+                "SELECT DISTINCT worker FROM task WHERE status = 'running'"
+            ).fetchall()
+        }
+
+    def get_task(self, task_id: int):
+        """A task's lifecycle, or None if there's no such task (any more)."""
+        cursor = self._get_connection().execute(
+            'SELECT id, name, status, attempts, max_attempts, timeout, worker, error, '
+            'created_at, started_at, finished_at, wait_time FROM task WHERE id = ?',
+            (task_id,)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        return dict(zip([column[0] for column in cursor.description], rows[0]))
+
+    def get_stats(self):
+        """
+        For each type of task, how many are in each status and the p50, p95
+        and p99 of the seconds they waited to be claimed and took to run,
+        over the tasks kept in the history.
+        """
+        connection = self._get_connection()
+        stats = {}
+        for name, status, count in connection.execute(
+            'SELECT name, status, count(*) FROM task GROUP BY name, status'
+        ).fetchall():
+            stats.setdefault(name, {'counts': {}})['counts'][status] = count
+
+        wait_times = {}
+        run_times = {}
+        for name, status, wait_time, run_time in connection.execute(
+            'SELECT name, status, wait_time, finished_at - started_at FROM task '
+            "WHERE status IN ('running', 'finished', 'dead') AND wait_time IS NOT NULL"
+        ).fetchall():
+            wait_times.setdefault(name, []).append(wait_time)
+            if status == 'finished':
+                run_times.setdefault(name, []).append(run_time)
+
+        for name, task_stats in stats.items():
+            task_stats['wait_time'] = get_percentiles(wait_times.get(name, []))
+            task_stats['run_time'] = get_percentiles(run_times.get(name, []))
+        return stats
+
+    def is_pending(self, task_id: int):
+        """Whether a task is still queued or running."""
+        return bool(self._get_connection().execute(
+            "SELECT 1 FROM task WHERE id = ? AND status IN ('queued', 'running')", (task_id,)
+        ).fetchall())
+
+    def _notify(self):
+        self._task_added.release()
+
+    def clear_wakeups(self):
+        """Forget tasks added so far, so wait() only wakes for new ones."""
+        while self._task_added.acquire(block=False):
+            pass
+
+    def wait(self, timeout: float):
+        """Wait until a task is added, or the timeout passes."""
+        return self._task_added.acquire(timeout=timeout)
@@ -1,33 +1,34 @@
-import os
+import asyncio
 import logging
-import subprocess
 
 from config import settings
 
+from .llm_service_manager import get_model_path
+from .readiness import preparing
 from .utils import download_file
 
 logger = logging.getLogger(__name__)
 
 
-def download_models():
+async def download_model(model_type: str):
     """
-    A task run on startup to download the model Llamafile will use. For now,
-    downloads just a single model for generating embeddings.
+    A task run on startup to download a model Llamafile will use, 'embedding'
+    or 'completion'. The download runs on a thread, so the models and the
+    browser prepare in parallel on one worker.
     """
-    embedding_model_url = 'https://huggingface.co/mixedbread-ai/mxbai-embed-large-v1/resolve/main/gguf/mxbai-embed-large-v1-f16.gguf?download=true'
-    embedding_model_output_path = os.path.join(settings.models_dir, 'mxbai-embed-large-v1-f16.gguf')
-    download_file(embedding_model_url, embedding_model_output_path)
+    url = getattr(settings, f'{model_type}_model_url')
+    sha256 = getattr(settings, f'{model_type}_model_sha256')
 
-    if settings.use_local_completions:
-        completion_model_url = 'https://huggingface.co/bartowski/gemma-2-9b-it-GGUF/resolve/main/gemma-2-9b-it-Q5_K_M.gguf?download=true'
-        completion_model_output_path = os.path.join(settings.models_dir, 'gemma-2-9b-it-Q5_K_M.gguf')
-        download_file(completion_model_url, completion_model_output_path)
+    with preparing(f'{model_type}_model'):
+        # to_thread() copies our context, so the download sees the task's
+        # cancellation token
+        await asyncio.to_thread(download_file, url, get_model_path(model_type), sha256=sha256)
 
-    logger.info('Model download complete')
+    logger.info(f'{model_type.capitalize()} model download complete')
 
-def install_browser():
+async def install_browser():
     """
-    A task run on startup to install the Playwright browser.
+    A task run on startup to install the Playwright browsers.
     """
     logger.info('Installing browser...')
 
@@ -36,24 +37,27 @@ def install_browser():
     from playwright._impl._driver import compute_driver_executable, get_driver_env
     driver_executable, driver_cli = compute_driver_executable()
 
-    try:
-        subprocess.run(
-            [
-                driver_executable,
-                driver_cli,
+    with preparing('browser'):
+        process = await asyncio.create_subprocess_exec(
+            driver_executable,
+            driver_cli,
             'install',
-                'chromium'
-                'firefox'
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-            env=get_driver_env().update({
+            'chromium',
+            'firefox',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={
+                **get_driver_env(),
                 'PLAYWRIGHT_BROWSERS_PATH': settings.playwright_browsers_dir
-            })
+            }
         )
-        logger.info(f'Browser installed successfully')
-    except subprocess.CalledProcessError as e:
-        logger.error(f'Failed to install browser: {e.stderr}')
+        try:
+            _, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+
+        if process.returncode != 0:
+            raise RuntimeError(f'Failed to install browser: {stderr.decode(errors="replace").strip()}')
 
     logger.info('Browser installed')
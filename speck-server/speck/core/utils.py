@@ -1,16 +1,22 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
 import logging
 import os
+import re
+import threading
+import time
 from typing import List, Optional
 
-from fireworks.client import Fireworks
 import httpx
 from pydantic import BaseModel, ValidationError
 from sqlite_vec import serialize_float32
 from sqlmodel import SQLModel, Session, select, text
 
-from config import db_engine, settings, template_env
+from config import db_engine, qualify_table, settings, template_env
 
+from .cancellation import check_cancelled
 from .llm_service_manager import use_inference_service
 from .pydantic_models_to_gbnf_grammar import generate_gbnf_grammar_and_documentation
 
@@ -40,6 +46,10 @@ def generate_completion_with_validation(
     """
     Uses Fireworks to evaluate a prompt and return a Pydantic model.
     """
+    # Imported here, since it's slow to import and only used with cloud
+    # completions
+    from fireworks.client import Fireworks
+
     fireworks = Fireworks() # TODO: Need to set FIREWORKS_API_KEY as an environment variable for now
     response = fireworks.completions.create(
         model="accounts/fireworks/models/llama-v3p1-70b-instruct",
@@ -102,6 +112,10 @@ def generate_local_completion_with_validation(
     try:
         with httpx.stream('POST', "http://localhost:17727/completion", json=data, timeout=180) as response:
             for text in response.iter_text():
+                # Stop generating if the task we're running in was cancelled
+                # or timed out
+                check_cancelled()
+
                 try:
                     data = json.loads(
                         text.strip('data :') # Strip out "data :" prefix
@@ -206,43 +220,274 @@ def generate_completion(
     return result
 
 
-def download_file(url, output_path, chunk_size=1024*1024):
+DOWNLOAD_CHUNK_ATTEMPTS = 5
+DOWNLOAD_PROGRESS_INTERVAL = 1  # Seconds between progress events
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+class DownloadProgress:
+    """
+    Counts a download's bytes across its connections, and reports them as
+    download_progress events and in the log at most once a second.
+    """
+    def __init__(self, name: str, total: Optional[int], downloaded: int = 0):
+        self.name = name
+        self.total = total
+        self.downloaded = downloaded
+        self._lock = threading.Lock()
+        self._reported_at = 0
+
+    def add(self, size: int):
+        with self._lock:
+            self.downloaded += size
+            if time.monotonic() - self._reported_at < DOWNLOAD_PROGRESS_INTERVAL:
+                return
+            self._reported_at = time.monotonic()
+        self.report()
+
+    def report(self, status: str = 'downloading'):
+        total = f" of {self.total / (1024 * 1024):.2f} MB" if self.total else ""
+        logger.info(f"Downloaded {self.downloaded / (1024 * 1024):.2f} MB{total} of {self.name}")
+
+        # Imported here, since the task manager imports the task modules
+        from core.task_manager import publish_event
+        publish_event({
+            "type": "download_progress",
+            "name": self.name,
+            "status": status,
+            "downloaded": self.downloaded,
+            "total": self.total,
+        })
+
+
+class DownloadManifest:
+    """
+    Records which chunks of a partial download are complete, in a JSON file
+    next to it, so an interrupted download resumes where it left off.
+    """
+    def __init__(self, path: str, url: str, size: int, chunk_size: int, sha256: Optional[str]):
+        self.path = path
+        self.header = {"url": url, "size": size, "chunk_size": chunk_size, "sha256": sha256}
+        self.completed = set()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Load the completed chunks, unless the manifest is for a different download."""
+        try:
+            with open(self.path) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return
+        if all(manifest.get(key) == value for key, value in self.header.items()):
+            self.completed = set(manifest["completed"])
+
+    def mark_completed(self, index: int):
+        with self._lock:
+            self.completed.add(index)
+            self._save()
+
+    def _save(self):
+        # Write then rename, so a crash never leaves a half-written manifest
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({**self.header, "completed": sorted(self.completed)}, file)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _probe_download(client: httpx.Client, url: str):
     """
-    Download a file from a URL in chunks and save it to the output path.
-    
-    Args:
-    - url (str): URL of the file to download.
-    - output_path (str): Local path to save the downloaded file.
-    - chunk_size (int): Size of each chunk to download. Default is 1MB.
+    Get a download's size, whether it supports ranged requests, and the
+    SHA-256 digest Hugging Face reports for LFS files, if any.
     """
+    response = client.head(url)
+    response.raise_for_status()
+
+    size = int(response.headers["content-length"]) if "content-length" in response.headers else None
+    accepts_ranges = response.headers.get("accept-ranges", "").lower() == "bytes"
+
+    # Hugging Face redirects LFS files to a CDN, and reports their digest
+    # on the redirect
+    sha256 = None
+    for headers in [r.headers for r in response.history] + [response.headers]:
+        etag = headers.get("x-linked-etag", "").strip('"').lower()
+        if re.fullmatch(r"[0-9a-f]{64}", etag):
+            sha256 = etag
+
+    return size, accepts_ranges, sha256
+
+
+def _download_chunk(client, url, part_path, start, end, progress):
+    """Download the bytes from start to end, inclusive, into the partial file."""
+    for attempt in range(1, DOWNLOAD_CHUNK_ATTEMPTS + 1):
+        written = 0
+        try:
+            with client.stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise ValueError(f"Server ignored the range request for bytes {start}-{end}")
+
+                with open(part_path, "r+b") as file:
+                    file.seek(start)
+                    for data in response.iter_bytes(DOWNLOAD_BLOCK_SIZE):
+                        check_cancelled()
+                        file.write(data)
+                        written += len(data)
+                        progress.add(len(data))
+
+            if written != end - start + 1:
+                raise httpx.ReadError(f"Got {written} bytes of {end - start + 1} for bytes {start}-{end}")
+            return
+        except httpx.HTTPError as e:
+            progress.add(-written)
+            if attempt == DOWNLOAD_CHUNK_ATTEMPTS:
+                raise
+            logger.warning(f"Error downloading bytes {start}-{end} of {progress.name}, retrying (attempt {attempt}): {e}")
+            time.sleep(2 ** attempt)
+
+
+def _download_ranges(client, url, part_path, size, chunk_size, connections, manifest, progress):
+    # Preallocate the partial file, so each connection can write its chunks
+    # in place
+    if not manifest.completed or not os.path.exists(part_path):
+        manifest.completed = set()
+        with open(part_path, "wb") as file:
+            file.truncate(size)
+
+    chunk_count = (size + chunk_size - 1) // chunk_size
+    missing = [index for index in range(chunk_count) if index not in manifest.completed]
+    progress.downloaded = sum(min(chunk_size, size - index * chunk_size) for index in manifest.completed)
+    if manifest.completed:
+        logger.info(f"Resuming {progress.name}, {len(missing)} of {chunk_count} chunks left")
+
+    def download(index):
+        start = index * chunk_size
+        _download_chunk(client, url, part_path, start, min(start + chunk_size, size) - 1, progress)
+        manifest.mark_completed(index)
+
+    # Carry the task's context into the threads, so they see its
+    # cancellation token
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        futures = [executor.submit(context.copy().run, download, index) for index in missing]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _download_stream(client, url, part_path, progress):
+    """Download over a single connection, for servers without ranged requests."""
+    progress.downloaded = 0
+    with client.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(part_path, "wb") as file:
+            for data in response.iter_bytes(DOWNLOAD_BLOCK_SIZE):
+                check_cancelled()
+                file.write(data)
+                progress.add(len(data))
+
+
+def _hash_file(path: str):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while data := file.read(DOWNLOAD_BLOCK_SIZE):
+            sha256.update(data)
+    return sha256.hexdigest()
+
+
+def _is_downloaded(output_path: str, size: Optional[int], sha256: Optional[str]):
+    """
+    Whether a file already at the output path is complete. With a pinned
+    sha256 digest it's hashed, since a file of the right size can still be
+    corrupt or an older version.
+    """
+    if size is not None and os.path.getsize(output_path) != size:
+        return False
+    if sha256 is not None:
+        actual_sha256 = _hash_file(output_path)
+        if actual_sha256 != sha256.lower():
+            logger.warning(f"{os.path.basename(output_path)} doesn't match its SHA-256 digest: expected {sha256.lower()}, got {actual_sha256}")
+            return False
+    return True
+
+
+def download_file(
+        url: str,
+        output_path: str,
+        sha256: Optional[str] = None,
+        connections: Optional[int] = None,
+        chunk_size: Optional[int] = None
+    ):
+    """
+    Download a file over several connections with ranged requests, verify
+    it and move it into place. Until then it's kept at output_path + ".part",
+    with a manifest of its completed chunks so an interrupted download
+    resumes with the ones it's missing.
+
+    The file is checked against the sha256 digest if given, or else the one
+    Hugging Face reports. Servers which don't support ranged requests are
+    downloaded from over a single connection, from the start.
+    """
+    connections = connections or settings.download_connections
+    chunk_size = chunk_size or settings.download_chunk_size
+    name = os.path.basename(output_path)
+    part_path = f"{output_path}.part"
+
     # Ensure the output directory exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    # Get the size of the file to be downloaded
-    with httpx.stream("GET", url, follow_redirects=True) as response:
-        file_size = int(response.headers.get('content-length', 0))
-        logger.info(f"File size: {file_size / (1024 * 1024):.2f} MB")
+    with httpx.Client(follow_redirects=True, timeout=httpx.Timeout(60, connect=30)) as client:
+        try:
+            size, accepts_ranges, reported_sha256 = _probe_download(client, url)
+        except httpx.HTTPError as e:
+            if os.path.exists(output_path) and _is_downloaded(output_path, None, sha256):
+                logger.warning(f"Couldn't check {name} against {url}, using the downloaded file: {e}")
+                return
+            raise
 
-        # Check if the file already exists and get its size
+        # Files are only ever moved into place once complete, except by
+        # older versions, which downloaded in place
         if os.path.exists(output_path):
-            downloaded_size = os.path.getsize(output_path)
-            if downloaded_size >= file_size:
-                logger.info("File already downloaded.")
+            if _is_downloaded(output_path, size, sha256):
+                logger.info(f"{name} already downloaded")
                 return
+            logger.info(f"{name} is incomplete or corrupt, downloading it again")
+            os.remove(output_path)
+
+        expected_sha256 = (sha256 or reported_sha256 or '').lower() or None
+        if expected_sha256 is None:
+            logger.warning(f"No SHA-256 digest for {name}, it won't be verified")
+
+        progress = DownloadProgress(name, size)
+        manifest = DownloadManifest(f"{output_path}.manifest.json", url, size, chunk_size, expected_sha256)
+        logger.info(f"Downloading {name} from {url}, {(size or 0) / (1024 * 1024):.2f} MB")
+
+        if size and accepts_ranges:
+            manifest.load()
+            _download_ranges(client, url, part_path, size, chunk_size, max(1, connections), manifest, progress)
         else:
-            downloaded_size = 0
+            _download_stream(client, url, part_path, progress)
 
-        # Download the file in chunks
-        headers = {"Range": f"bytes={downloaded_size}-"}
-        with httpx.stream("GET", url, headers=headers, follow_redirects=True) as response:
-            with open(output_path, "ab") as file:
-                for chunk in response.iter_bytes(chunk_size=chunk_size):
-                    if chunk:
-                        file.write(chunk)
-                        downloaded_size += len(chunk)
-                        logger.info(f"Downloaded {downloaded_size / (1024 * 1024):.2f} MB of {file_size / (1024 * 1024):.2f} MB")
+    progress.report(status='verifying')
+    if expected_sha256 is not None:
+        actual_sha256 = _hash_file(part_path)
+        if actual_sha256 != expected_sha256:
+            # Start over next time, since we can't tell which chunks are bad
+            os.remove(part_path)
+            manifest.remove()
+            progress.report(status='failed')
+            raise ValueError(f"{name} failed verification: expected SHA-256 {expected_sha256}, got {actual_sha256}")
 
-            logger.info(f"Downloaded {output_path}")
+    os.replace(part_path, output_path)
+    manifest.remove()
+    progress.report(status='complete')
+    logger.info(f"Downloaded {output_path}")
 
 
 def create_database_tables():
@@ -252,8 +497,8 @@ def create_database_tables():
     # Create the vec_messages table first if it doesn't exist
     with Session(db_engine) as session:
         session.exec(
-            text("""
-                CREATE VIRTUAL TABLE IF NOT EXISTS vec_message using vec0 (
+            text(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {qualify_table('vectors', 'vec_message')} using vec0 (
                     message_id TEXT PRIMARY KEY,
                     body_embedding FLOAT[1024]
                 )
@@ -261,10 +506,21 @@ def create_database_tables():
         )
 
     # Create the database tables
+    from core import blobs
     from emails import models as email_models
     from profiles import models as profile_models
     SQLModel.metadata.create_all(db_engine)
 
+    # Bring tables which already existed up to date
+    from core.migrations import migrate_database, migrate_database_layout
+    migrate_database()
+    migrate_database_layout()
+
+    # create_all skips tables which already exist, so add any indexes they're missing
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db_engine, checkfirst=True)
+
 def reset_database():
     """
     Resets the Speck database. Used during local development.
@@ -0,0 +1,208 @@
+import copy
+import email
+import email.policy
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
+import logging
+import os
+import re
+from typing import List, Optional
+
+import html2text
+from selectolax.lexbor import LexborHTMLParser
+
+from config import settings
+
+try:
+    from lxml import etree
+    from lxml import html as lxml_html
+except ImportError:
+    # lxml is optional, selectolax is faster and always installed
+    etree = None
+
+logger = logging.getLogger(__name__)
+
+# Elements whose contents aren't part of the message text
+SKIPPED_TAGS = ['head', 'script', 'style', 'noscript', 'template', 'title', 'svg']
+
+# Elements which start a new line of text
+BLOCK_TAGS = [
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer',
+    'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol',
+    'p', 'pre', 'section', 'table', 'td', 'th', 'tr', 'ul',
+]
+
+# Marks line breaks in the extracted text until whitespace is normalized
+LINE_BREAK = '\u2029'  # Unicode paragraph separator
+
+# Below this many messages, a process pool costs more than it saves
+POOL_MIN_MESSAGES = 4
+
+
+def _normalize_whitespace(text: str):
+    """Collapse whitespace like a browser would, keeping one line per block."""
+    text = re.sub(f'[^\\S{LINE_BREAK}]+', ' ', text)
+    lines = (line.strip() for line in text.split(LINE_BREAK))
+    return '\n'.join(line for line in lines if line)
+
+
+class Html2TextExtractor:
+    """
+    Converts HTML to Markdown with html2text, which is what Speck has always
+    used. Pure Python, so slow on the large HTML of marketing emails.
+    """
+    name = 'html2text'
+
+    def __init__(self):
+        self.converter = html2text.HTML2Text()
+        self.converter.ignore_images = True
+        self.converter.ignore_links = True
+
+        # HTML2Text carries parser state from one document to the next, so
+        # remember its state before any, to put back before each one
+        self.initial_state = dict(self.converter.__dict__)
+
+    def reset(self):
+        self.converter.__dict__.clear()
+        self.converter.__dict__.update({
+            key: copy.copy(value) if isinstance(value, (list, dict)) else value
+            for key, value in self.initial_state.items()
+        })
+
+    def extract(self, content: str):
+        self.reset()
+        return self.converter.handle(content)
+
+
+class SelectolaxExtractor:
+    """Extracts plain text with selectolax's lexbor parser, which is written in C."""
+    name = 'selectolax'
+
+    def extract(self, content: str):
+        tree = LexborHTMLParser(content)
+        tree.strip_tags(SKIPPED_TAGS)
+        for node in tree.css(','.join(BLOCK_TAGS)):
+            node.insert_before(LINE_BREAK)
+            node.insert_after(LINE_BREAK)
+
+        root = tree.body or tree.root
+        if root is None:
+            return ''
+        return _normalize_whitespace(root.text(deep=True, separator='', strip=False))
+
+
+class LxmlExtractor:
+    """Extracts plain text with lxml's libxml2 HTML parser."""
+    name = 'lxml'
+
+    def extract(self, content: str):
+        root = lxml_html.document_fromstring(content)
+        etree.strip_elements(root, etree.Comment, etree.ProcessingInstruction, *SKIPPED_TAGS, with_tail=False)
+
+        parts = []
+        block_tags = set(BLOCK_TAGS)
+        for event, element in etree.iterwalk(root, events=('start', 'end')):
+            if event == 'start':
+                if element.tag in block_tags:
+                    parts.append(LINE_BREAK)
+                if element.text:
+                    parts.append(element.text)
+            else:
+                if element.tag in block_tags:
+                    parts.append(LINE_BREAK)
+                if element.tail:
+                    parts.append(element.tail)
+
+        return _normalize_whitespace(''.join(parts))
+
+
+EXTRACTORS = {
+    'selectolax': (SelectolaxExtractor, True),
+    'lxml': (LxmlExtractor, etree is not None),
+    'html2text': (Html2TextExtractor, True),
+}
+
+_extractors = {}
+
+def get_extractor(name: str = 'auto'):
+    """
+    Get the named body extractor, reusing one instance per process. 'auto'
+    picks the fastest one installed, and a missing one falls back to html2text.
+    """
+    if name == 'auto':
+        name = next(name for name, (_, available) in EXTRACTORS.items() if available)
+
+    extractor_class, available = EXTRACTORS[name]
+    if not available:
+        logger.warning(f"The {name} body extractor isn't installed, using html2text")
+        return get_extractor('html2text')
+
+    if name not in _extractors:
+        _extractors[name] = extractor_class()
+    return _extractors[name]
+
+
+def extract_body(content: str, extractor_name: str = 'auto', max_html_chars: Optional[int] = None):
+    """Convert an HTML body to text, truncating pathologically large HTML first."""
+    if max_html_chars is not None and len(content) > max_html_chars:
+        logger.info(f"Truncating {len(content)} characters of HTML to {max_html_chars}")
+        content = content[:max_html_chars]
+
+    extractor = get_extractor(extractor_name)
+    try:
+        return extractor.extract(content)
+    except Exception as e:
+        if extractor.name == 'html2text':
+            raise
+        logger.warning(f"The {extractor.name} body extractor failed, using html2text: {e}")
+        return get_extractor('html2text').extract(content)
+
+
+def extract_body_from_raw(raw: bytes, extractor_name: str = 'auto', max_html_chars: Optional[int] = None):
+    """
+    Extract the text body of a raw RFC822 message, preferring its HTML part.
+    Returns None if the message doesn't have a body. Takes the settings as
+    arguments so it can run in a process pool.
+    """
+    email_message = email.message_from_bytes(raw, policy=email.policy.default)
+    body_part = email_message.get_body(preferencelist=('html', 'text'))
+    if body_part is None:
+        return None
+
+    content = body_part.get_content()
+    if body_part.get_content_type() != 'text/html':
+        # Plain text bodies don't need converting
+        return content
+    return extract_body(content, extractor_name, max_html_chars)
+
+
+_pool = None
+
+def _get_pool_size():
+    # A pool smaller than two processes only adds overhead
+    pool_size = min(settings.body_extraction_processes, os.cpu_count() or 1)
+    return pool_size if pool_size >= 2 else 0
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=_get_pool_size())
+    return _pool
+
+def extract_bodies(raws: List[bytes]):
+    """
+    Extract the bodies of several raw messages, in a process pool when there
+    are enough of them to be worth it. Returns None for those without a body.
+    """
+    arguments = (raws, repeat(settings.body_extractor), repeat(settings.body_max_html_chars))
+
+    if _get_pool_size() and len(raws) >= POOL_MIN_MESSAGES:
+        global _pool
+        try:
+            return list(_get_pool().map(extract_body_from_raw, *arguments))
+        except BrokenProcessPool as e:
+            logger.error(f"Body extraction pool broke, extracting in this process: {e}")
+            _pool = None
+
+    return list(map(extract_body_from_raw, *arguments))
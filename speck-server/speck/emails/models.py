@@ -1,24 +1,31 @@
 import base64
+from contextlib import nullcontext
 from datetime import datetime
 import enum
 import email
+import email.parser
+import email.policy
+import html
 import uuid
-import html2text
 import logging
 import pendulum
 from pydantic import BaseModel, Field, field_validator
+from sqlalchemy import Index, and_, exists, func, not_, or_
 from sqlalchemy.dialects.sqlite import JSON
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import declared_attr
 from sqlite_vec import serialize_float32
-from sqlmodel import Column, Enum, Field as SQLModelField, Session, SQLModel, Relationship, select, delete, text, bindparam, BLOB
+from sqlmodel import Column, Enum, Field as SQLModelField, Session, SQLModel, Relationship, select, delete, update, text, bindparam, BLOB
 from typing import List, Literal, Optional
 
-from config import db_engine, template_env
+from config import db_engine, qualify_table, settings, template_env
+from core.cancellation import check_cancelled
+from core.blobs import delete_unreferenced_blobs, get_blob, put_blob
 from core.utils import generate_completion, generate_embedding
 from core.task_manager import task_manager
 from library import speck_library, FunctionResult
 
+from .bodies import extract_bodies
 from .utils import get_gmail_api_client
 
 logger = logging.getLogger(__name__)
@@ -32,6 +39,11 @@ class Mailbox(SQLModel, table=True):
     last_history_id: int | None = None
     last_synced_at: datetime | None = None
 
+    # Bumped by database triggers whenever one of its messages is added,
+    # changed or deleted, in the same transaction, see
+    # core.migrations.add_mailbox_change_version
+    change_version: int = 0
+
     messages: list['Message'] = Relationship(back_populates='mailbox')
 
     created_at: datetime = SQLModelField(default_factory=datetime.now)
@@ -43,8 +55,12 @@ class Mailbox(SQLModel, table=True):
         Sync the Mailbox with the Gmail API.
 
         - Fetch all emails currently in the user's inbox and the latest 1000 non-inbox emails
-        - Create Message objects for new emails in the response
+        - Create Message objects for new emails in the response, fetching inbox
+          emails in full and the others as metadata and a snippet only
+        - Fetch emails we only have metadata for in full once they enter the inbox
         - Delete old Message objects for emails that no longer meet the criteria
+
+        Returns the thread ids whose mailbox state changed during the sync.
         """
         client = get_gmail_api_client()
 
@@ -54,7 +70,8 @@ class Mailbox(SQLModel, table=True):
 
         # First, get the message ids for messages in the user's inbox
         response = client.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=25).execute()
-        message_ids.update([message['id'] for message in response['messages']])
+        inbox_message_ids = {message['id'] for message in response['messages']}
+        message_ids.update(inbox_message_ids)
 
         # Next, fetch non-inbox messages until our message_ids set has 1000 items
         next_page_token = None
@@ -66,11 +83,26 @@ class Mailbox(SQLModel, table=True):
             next_page_token = response['nextPageToken']
             logging.info(f"Fetched {len(message_ids)} messages so far, next page token: {next_page_token}")
 
-        # Iterate over each message and fetch its details
+        # Iterate over each message and fetch its details. Only inbox messages
+        # are analyzed, so only they are fetched in full up front. The others
+        # are just embedded, which their metadata and snippet are enough for.
         new_inbox_message_ids = []
         new_non_inbox_message_ids = []
-        with session or Session(db_engine) as session:
+        fetched_in_full_thread_ids = []
+        # Don't expire the Mailbox on commit, so callers can still read its
+        # last_history_id once the session closes. A caller's session is
+        # theirs to close.
+        with nullcontext(session) if session is not None else Session(db_engine, expire_on_commit=False) as session:
+            # Messages to fetch in full after the loop, so their bodies can be
+            # extracted together
+            new_inbox_messages = []
+            entered_inbox_messages = []
+
             for message_id in message_ids:
+                # Give up if the sync task timed out, before the next request
+                # to Gmail. Nothing is committed until the end.
+                check_cancelled()
+
                 # If we have a Message record for this message_id, then we don't
                 # need to create a new one
                 try:
@@ -82,12 +114,26 @@ class Mailbox(SQLModel, table=True):
                     )
                     message = session.exec(statement).one()
 
-                    # If the message still needs to be processed, schedule it
+                    # If the message entered the inbox since we fetched its
+                    # metadata, fetch it in full now
+                    if message_id in inbox_message_ids and message.fetch_depth == 'metadata':
+                        logging.info(f"Message {message_id} entered the inbox, fetching it in full")
+                        entered_inbox_messages.append(message)
+
+                        # Its tasks are scheduled once it's fetched, since
+                        # until then it has its old labels, so looks processed,
+                        # and fetching it replaces its snippet's embedding
+                        continue
+
+                    # If the message still needs to be processed, schedule it,
+                    # unless it's still queued from the last sync
                     if not message.processed:
                         from .tasks import process_inbox_message
                         task_manager.add_task(
                             task=process_inbox_message,
-                            message_id=message_id
+                            message_id=message_id,
+                            timeout=settings.process_message_timeout,
+                            dedupe=True
                         )
 
                     # And if we haven't generated an embedding yet, schedule it
@@ -95,7 +141,9 @@ class Mailbox(SQLModel, table=True):
                         from .tasks import generate_embedding_for_message
                         task_manager.add_task(
                             task=generate_embedding_for_message,
-                            message_id=message_id
+                            message_id=message_id,
+                            timeout=settings.generate_embedding_timeout,
+                            dedupe=True
                         )
 
                     continue
@@ -105,64 +153,49 @@ class Mailbox(SQLModel, table=True):
                         mailbox_id=self.id,
                     )
 
-                # Get the raw data from Gmail for this message
-                logging.info(f"Fetching message {message_id} from Gmail")
-                response = client.users().messages().get(userId='me', id=message_id, format='raw').execute()
-
-                # Update the Mailbox's last_history_id
-                message_history_id = int(response['historyId'])
-                if self.last_history_id is None or message_history_id > self.last_history_id:
-                    self.last_history_id = message_history_id
-
-                # Convert the raw data into an Email object
-                message.raw = base64.urlsafe_b64decode(response['raw'])
-                email_message = email.message_from_bytes(
-                    message.raw,
-                    policy=email.policy.default
-                )
+                if message_id in inbox_message_ids:
+                    new_inbox_messages.append(message)
+                    continue
 
-                # Parse the recipients and the body
-                to_recipients = [recipient.strip() for recipient in email_message['To'].split(',')] if email_message['To'] else []
-                cc_recipients = [recipient.strip() for recipient in email_message['Cc'].split(',')] if email_message['Cc'] else []
-                bcc_recipients = [recipient.strip() for recipient in email_message['Bcc'].split(',')] if email_message['Bcc'] else []
-
-                # Parse the date into a datetime
-                received_at = pendulum.from_format(email_message['Date'], 'ddd, DD MMM YYYY HH:mm:ss Z')
-
-                # Update the fields on the Message
-                message.thread_id = response['threadId']
-                message.label_ids = response.get('labelIds', []) # It seems messages inserted in the user's inbox via the Gmail API don't have labelIds
-                message.from_ = email_message['From']
-                message.to = to_recipients
-                message.cc = cc_recipients
-                message.bcc = bcc_recipients
-                message.subject = email_message['Subject']
-                message.received_at = received_at
-
-                # Use html2text to process the body
-                text_maker = html2text.HTML2Text()
-                text_maker.ignore_images = True
-                text_maker.ignore_links = True
+                # Get the data from Gmail for this message
+                logging.info(f"Fetching message {message_id} metadata from Gmail")
+                response = message.fetch_metadata(client)
+                self._update_last_history_id(response)
+                session.add(message)
+                new_non_inbox_message_ids.append(message_id)
 
-                try:
-                    content = email_message.get_body(preferencelist=('html', 'text')).get_content()
-                except AttributeError:
-                    # TODO If the message doesn't have a body, like a calendar invitation, just ignore it for now
-                    logging.info(f"Message {message_id} doesn't have a body, skipping")
-                    continue
+            for message, response in self._fetch_in_full(client, session, entered_inbox_messages):
+                self._update_last_history_id(response)
+                fetched_in_full_thread_ids.append(message.thread_id)
 
-                message.body = text_maker.handle(content)
+            # Check the messages which entered the inbox now they're up to date
+            entered_inbox_unprocessed_ids = [message.id for message in entered_inbox_messages if not message.processed]
+            entered_inbox_unembedded_ids = [message.id for message in entered_inbox_messages if not message.embedding_generated]
 
-                session.add(message)
+            for message, response in self._fetch_in_full(client, session, new_inbox_messages):
+                self._update_last_history_id(response)
 
                 # Append the message to the appropriate list
                 if message.in_inbox:
-                    new_inbox_message_ids.append(message_id)
+                    new_inbox_message_ids.append(message.id)
                 else:
-                    new_non_inbox_message_ids.append(message_id)
+                    new_non_inbox_message_ids.append(message.id)
 
-            # Delete old Message objects for emails that are no longer in our set
+            logging.info(
+                f"Fetched {len(new_inbox_message_ids) + len(fetched_in_full_thread_ids)} messages in full "
+                f"and {len(new_non_inbox_message_ids)} as metadata only"
+            )
+
+            # Delete old Message objects for emails that are no longer in our set,
+            # remembering their threads so we can report them as changed
+            deleted_thread_ids = session.exec(
+                select(Message.thread_id).where(
+                    Message.mailbox_id == self.id,
+                    Message.id.not_in(message_ids)
+                )
+            ).all()
             session.exec(delete(Message).where(Message.id.not_in(message_ids)))
+            delete_unreferenced_blobs(session, [('message', 'raw_digest')])
 
             # Update the Mailbox's last_synced_at
             self.last_synced_at = last_synced_at
@@ -175,19 +208,26 @@ class Mailbox(SQLModel, table=True):
             # for all messages. It helps to schedule the tasks in this order so the
             # Llamafile service manager doesn't have to switch back and forth between
             # generating completions and generating embeddings.
-            for message_id in new_inbox_message_ids:
+            for message_id in new_inbox_message_ids + entered_inbox_unprocessed_ids:
                 from .tasks import process_inbox_message
                 task_manager.add_task(
                     task=process_inbox_message,
-                    message_id=message_id
+                    message_id=message_id,
+                    timeout=settings.process_message_timeout
                 )
-            for message_id in new_inbox_message_ids + new_non_inbox_message_ids:
+            new_message_ids = new_inbox_message_ids + new_non_inbox_message_ids
+            for message_id in new_message_ids + entered_inbox_unembedded_ids:
                 from .tasks import generate_embedding_for_message
                 task_manager.add_task(
                     task=generate_embedding_for_message,
-                    message_id=message_id
+                    message_id=message_id,
+                    timeout=settings.generate_embedding_timeout
                 )
 
+            new_thread_ids = session.exec(
+                select(Message.thread_id).where(Message.id.in_(new_message_ids))
+            ).all() + fetched_in_full_thread_ids
+
             # Also schedule a task to update the Profile if it's not complete
             from profiles.models import Profile
             profile = session.exec(select(Profile)).one() # TODO: Multiple profiles
@@ -197,6 +237,67 @@ class Mailbox(SQLModel, table=True):
                     task=update_profile
                 )
 
+        return list(set(new_thread_ids) | set(deleted_thread_ids))
+
+    def _update_last_history_id(self, response: dict):
+        """Advance the Mailbox's last_history_id past a fetched message."""
+        message_history_id = int(response['historyId'])
+        if self.last_history_id is None or message_history_id > self.last_history_id:
+            self.last_history_id = message_history_id
+
+    def _fetch_in_full(self, client, session: Session, messages: List['Message']):
+        """
+        Fetch messages from Gmail in full, extracting their bodies together so
+        it can happen in a process pool. Returns a (message, response) pair for
+        each message which has a body.
+        """
+        responses = []
+        for message in messages:
+            check_cancelled()
+            logging.info(f"Fetching message {message.id} from Gmail")
+            responses.append(message.get_raw_response(client))
+
+        raws = [base64.urlsafe_b64decode(response['raw']) for response in responses]
+        bodies = extract_bodies(raws)
+
+        fetched = []
+        for message, response, raw, body in zip(messages, responses, raws, bodies):
+            if body is None:
+                # TODO If the message doesn't have a body, like a calendar invitation, just ignore it for now
+                logging.info(f"Message {message.id} doesn't have a body, skipping")
+                continue
+
+            message.update_from_raw(session, response, raw, body)
+            session.add(message)
+            fetched.append((message, response))
+
+        return fetched
+
+    def fetch_full_messages(self, messages: List['Message']):
+        """
+        Fetch any of the given messages we only have metadata for in full,
+        for when something needs their whole body.
+        """
+        partial_messages = [message for message in messages if message.fetch_depth == 'metadata']
+        if not partial_messages:
+            return
+
+        client = get_gmail_api_client()
+        with Session(db_engine, expire_on_commit=False) as session:
+            fetched = self._fetch_in_full(client, session, partial_messages)
+
+            # This Mailbox may have been loaded before a sync moved the stored
+            # history id on, so only ever move it forward
+            if fetched:
+                history_id = max(int(response['historyId']) for message, response in fetched)
+                session.exec(
+                    update(Mailbox).where(
+                        Mailbox.id == self.id,
+                        or_(Mailbox.last_history_id.is_(None), Mailbox.last_history_id < history_id)
+                    ).values(last_history_id=history_id)
+                )
+            session.commit()
+
     def get_general_context(self):
         """Get the general context of the message."""
         return {
@@ -205,33 +306,65 @@ class Mailbox(SQLModel, table=True):
         }
 
     def get_messages(self):
-        """Get all the messages in the mailbox."""
+        """
+        Get all the messages in the mailbox, keyed by thread id. When a thread
+        has several messages, the most recently received one wins.
+        """
         with Session(db_engine) as session:
             messages = session.exec(
-                select(Message).where(Message.mailbox_id == self.id)
+                select(Message).where(
+                    Message.mailbox_id == self.id
+                ).order_by(Message.received_at)
             ).all()
 
         mailbox_data = {}
         for message in messages:
-            mailbox_data[message.thread_id] = {
-                'id': message.id,
-                'message_type': message.message_type,
-                'summary': message.summary,
-                'selected_functions': message.selected_functions,
-                'executed_functions': message.executed_functions,
-            }
+            mailbox_data[message.thread_id] = message.get_mailbox_entry()
         return mailbox_data
 
+    def get_thread_changes(self, thread_ids: List[str]):
+        """
+        Get the delta for a set of changed threads: an upsert with the thread's
+        latest message, or a delete if the thread no longer has any messages.
+        """
+        with Session(db_engine) as session:
+            messages = session.exec(
+                select(Message).where(
+                    Message.mailbox_id == self.id,
+                    Message.thread_id.in_(thread_ids)
+                ).order_by(Message.received_at)
+            ).all()
+
+        latest_messages = {message.thread_id: message for message in messages}
+
+        changes = []
+        for thread_id in thread_ids:
+            message = latest_messages.get(thread_id)
+            if message is None:
+                changes.append({'op': 'delete', 'thread_id': thread_id})
+            else:
+                changes.append({
+                    'op': 'upsert',
+                    'thread_id': thread_id,
+                    'message': message.get_mailbox_entry()
+                })
+        return changes
+
     def search_embeddings(self, query: str):
         """Search the mailbox's embeddings for a query."""
-        # Generate an embedding for the query
-        query_embedding = generate_embedding(query)
+        # Generate an embedding for the query, or reuse a cached one
+        from core.cache import cache
+        query_embedding = cache.namespace('query_embeddings').get_or_compute(
+            query,
+            lambda: generate_embedding(query),
+            ttl=24 * 60 * 60
+        )
         serialized_query_embedding = serialize_float32(query_embedding)
 
         # Run the query against the VecMessage table to find the 10 most similar messages
         with Session(db_engine) as session:
             results = session.exec(text(
-                'select * from vec_message where body_embedding match :query_embedding and k = 10'
+                f'select * from {qualify_table("vectors", "vec_message")} where body_embedding match :query_embedding and k = 10'
             ).bindparams(
                 query_embedding=serialized_query_embedding
             )).all()
@@ -341,13 +474,26 @@ class ExecutedFunction(BaseModel):
     status: Literal['pending', 'success', 'error'] = 'pending'
     result: FunctionResult | None = None
 
+# Headers we need when fetching just a message's metadata
+METADATA_HEADERS = ['From', 'To', 'Cc', 'Bcc', 'Subject', 'Date']
+
 class Message(SQLModel, table=True):
+    # Supports keyset pagination of a mailbox's messages, newest first
+    __table_args__ = (
+        Index('ix_message_mailbox_received_at_id', 'mailbox_id', 'received_at', 'id'),
+    )
+
     id: str | None = SQLModelField(default=None, primary_key=True)
 
     mailbox_id: int = SQLModelField(default=None, foreign_key='mailbox.id')
     mailbox: "Mailbox" = Relationship(back_populates='messages')
 
-    raw: str
+    # The raw RFC822 bytes live in the blob table, see get_raw()
+    raw_digest: str | None = None
+
+    # 'raw' once the whole message has been fetched, or 'metadata' if we only
+    # have its headers, and its snippet as the body
+    fetch_depth: str = SQLModelField(default='raw')
 
     thread_id: str
     label_ids: List[str] = SQLModelField(default_factory=list, sa_column=Column(JSON))
@@ -391,8 +537,119 @@ class Message(SQLModel, table=True):
 
         return self.message_type is not None and self.summary is not None and self.functions_analyzed
 
+    def get_raw_response(self, client):
+        """Fetch the whole message from Gmail, as a Gmail API response."""
+        return client.users().messages().get(
+            userId='me',
+            id=self.id,
+            format='raw',
+            fields='id,threadId,labelIds,historyId,raw'
+        ).execute()
+
+    def update_from_raw(self, session: Session, response: dict, raw: bytes, body: str):
+        """
+        Update the message from its Gmail API response, raw RFC822 bytes and
+        extracted body. See emails.bodies for the extraction.
+        """
+        # Only the headers are parsed here, the body was already extracted
+        headers = email.parser.BytesHeaderParser(policy=email.policy.default).parsebytes(raw)
+        self._set_headers(response, headers.get)
+        self.body = body
+
+        # Store the raw data in the blob table
+        self.raw_digest = put_blob(session, raw)
+
+        # If we'd embedded just the snippet, embed the whole body instead
+        if self.fetch_depth == 'metadata' and self.embedding_generated:
+            session.exec(delete(VecMessage).where(VecMessage.message_id == self.id))
+            self.embedding_generated = False
+        self.fetch_depth = 'raw'
+
+    def fetch_metadata(self, client):
+        """
+        Fetch just the message's headers and snippet from Gmail, which is much
+        cheaper than the whole message. Returns the API response.
+        """
+        response = client.users().messages().get(
+            userId='me',
+            id=self.id,
+            format='metadata',
+            metadataHeaders=METADATA_HEADERS,
+            fields='id,threadId,labelIds,historyId,snippet,payload/headers'
+        ).execute()
+
+        headers = {header['name'].lower(): header['value'] for header in response['payload']['headers']}
+        self._set_headers(response, lambda name: headers.get(name.lower()))
+
+        # Gmail HTML-escapes snippets
+        self.body = html.unescape(response.get('snippet', ''))
+        self.fetch_depth = 'metadata'
+
+        return response
+
+    def _set_headers(self, response: dict, get_header):
+        """Update the message's fields from a Gmail API response and its headers."""
+        # Parse the recipients
+        to_recipients = [recipient.strip() for recipient in get_header('To').split(',')] if get_header('To') else []
+        cc_recipients = [recipient.strip() for recipient in get_header('Cc').split(',')] if get_header('Cc') else []
+        bcc_recipients = [recipient.strip() for recipient in get_header('Bcc').split(',')] if get_header('Bcc') else []
+
+        # Parse the date into a datetime
+        received_at = pendulum.from_format(get_header('Date'), 'ddd, DD MMM YYYY HH:mm:ss Z')
+
+        # Update the fields on the Message
+        self.thread_id = response['threadId']
+        self.label_ids = response.get('labelIds', []) # It seems messages inserted in the user's inbox via the Gmail API don't have labelIds
+        self.from_ = get_header('From')
+        self.to = to_recipients
+        self.cc = cc_recipients
+        self.bcc = bcc_recipients
+        self.subject = get_header('Subject')
+        self.received_at = received_at
+
+    def get_raw(self):
+        """Load the message's raw RFC822 bytes, for when it needs re-parsing."""
+        if self.raw_digest is None:
+            return None
+        return get_blob(self.raw_digest)
+
+    @classmethod
+    def in_inbox_clause(cls):
+        """SQL equivalent of the in_inbox property."""
+        labels = func.json_each(cls.label_ids).table_valued('value')
+        return exists(select(labels.c.value).where(labels.c.value == 'INBOX'))
+
+    @classmethod
+    def processed_clause(cls):
+        """SQL equivalent of the processed property."""
+        return or_(
+            not_(cls.in_inbox_clause()),
+            and_(
+                cls.message_type.is_not(None),
+                cls.summary.is_not(None),
+                cls.functions_analyzed == True
+            )
+        )
+
+    def get_fields(self, fields: List[str]):
+        """The message's values for a list of field names, as served by the API."""
+        return {field: getattr(self, field) for field in fields}
+
+    def get_mailbox_entry(self):
+        """The message's state as pushed to the browser extension."""
+        return {
+            'id': self.id,
+            'message_type': self.message_type,
+            'summary': self.summary,
+            'selected_functions': self.selected_functions,
+            'executed_functions': self.executed_functions,
+        }
+
     def analyze_and_process(self):
         """Analyze a new message and process it."""
+        # Analysis reads the whole body, not just a snippet
+        self.mailbox.fetch_full_messages([self])
+
         self.set_type()
         self.generate_summary()
         self.select_functions()
@@ -501,32 +758,30 @@ class Message(SQLModel, table=True):
         """Generate an embedding for the message."""
         # Check if we already have an embedding
         with Session(db_engine) as session:
-            try:
-                session.exec(select(VecMessage).where(VecMessage.message_id == self.id)).one()
+            vec_message = session.exec(select(VecMessage).where(VecMessage.message_id == self.id)).first()
 
-                # If we do, return
-                return
-            except NoResultFound:
-                # If we don't, generate it
-                pass
+        # If we don't, generate it
+        if vec_message is None:
+            embedding = generate_embedding(self.body)
 
-        # Generate the embedding
-        embedding = generate_embedding(self.body)
+            # Convert the result to a BLOB
+            embedding_blob = serialize_float32(embedding)
 
-        # Convert the result to a BLOB
-        embedding_blob = serialize_float32(embedding)
+            # Save it as a new VecMessage object. This is its own transaction,
+            # so in the split database layout it only locks the vector database.
+            with Session(db_engine) as session:
+                vec_message = VecMessage(
+                    message_id=self.id,
+                    body_embedding=embedding_blob
+                )
+                session.add(vec_message)
+                session.commit()
 
-        # Save it as a new VecMessage object and set the embedding_generated flag
+        # Then set the embedding_generated flag in a short transaction on the
+        # main database
         with Session(db_engine) as session:
-            vec_message = VecMessage(
-                message_id=self.id,
-                body_embedding=embedding_blob
-            )
-            session.add(vec_message)
-
             self.embedding_generated = True
             session.add(self)
-
             session.commit()
 
 class VecMessage(SQLModel, table=True):
@@ -543,3 +798,5 @@ class VecMessage(SQLModel, table=True):
     @declared_attr
     def __tablename__(cls) -> str:
         return 'vec_message'
+
+    __table_args__ = {'schema': 'vectors'}
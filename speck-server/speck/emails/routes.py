@@ -1,21 +1,28 @@
 import base64
-from fastapi import APIRouter, Depends, HTTPException
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import RedirectResponse
 import hashlib
 import httpx
+import json
 import keyring
 import logging
 from pydantic import BaseModel
+from typing import Optional
 from urllib.parse import urlencode
 import secrets
+from sqlalchemy import tuple_
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import load_only
 from sqlmodel import select, Session
 
 from config import settings, get_db_session
+from core.event_manager import event_manager
 from core.task_manager import task_manager
 from profiles.models import Profile
 
-from .models import Mailbox
+from .models import Mailbox, Message, MessageType
+from .sync import get_sync_status
 from .utils import get_gmail_api_client
 
 logger = logging.getLogger(__name__)
@@ -106,8 +113,197 @@ async def receive_oauth_code(*, session: Session = Depends(get_db_session), code
     return {"status": "success"}
 
 
+@router.get('/sync')
+async def get_sync(*, session: Session = Depends(get_db_session)):
+    """How often the inbox is syncing right now, and why."""
+    try:
+        mailbox = session.exec(select(Mailbox)).one()
+    except NoResultFound:
+        raise HTTPException(status_code=404, detail="No mailbox found")
+
+    return {
+        **get_sync_status(),
+        'last_synced_at': mailbox.last_synced_at,
+    }
+
+
 @router.get('/test-sync-inbox')
 async def test_sync_inbox(*, session: Session = Depends(get_db_session)):
     mailbox = session.exec(select(Mailbox)).one()
     mailbox.sync_inbox(session=session)
-    return {"status": "success"}
\ No newline at end of file
+    return {"status": "success"}
+
+
+# Message fields the mailbox API can return, and the ones it returns by default
+MESSAGE_FIELDS = {
+    'id', 'thread_id', 'label_ids', 'from_', 'to', 'cc', 'bcc', 'subject',
+    'received_at', 'message_type', 'summary', 'processed', 'selected_functions',
+    'executed_functions',
+}
+DEFAULT_MESSAGE_FIELDS = [
+    'id', 'thread_id', 'received_at', 'message_type', 'summary',
+    'selected_functions', 'executed_functions',
+]
+
+# Computed fields, and the columns they need loaded
+COMPUTED_MESSAGE_FIELD_COLUMNS = {
+    'processed': ['label_ids', 'message_type', 'summary', 'functions_analyzed'],
+}
+
+
+def _parse_fields(fields: Optional[str]):
+    """Validate a comma-separated field selection."""
+    if not fields:
+        return DEFAULT_MESSAGE_FIELDS
+
+    selected_fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown_fields = set(selected_fields) - MESSAGE_FIELDS
+    if unknown_fields:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+    return selected_fields
+
+
+def _load_only_fields(fields):
+    """Only load the columns the selected fields need, plus the pagination key."""
+    columns = {'id', 'received_at'}
+    for field in fields:
+        columns.update(COMPUTED_MESSAGE_FIELD_COLUMNS.get(field, [field]))
+    return load_only(*[getattr(Message, column) for column in columns])
+
+
+def _encode_cursor(message: Message):
+    key = json.dumps([message.received_at.isoformat(), message.id])
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        # Cursors come from the client, so check it's the [received_at, id]
+        # pair we encoded before building a keyset from it
+        if not isinstance(key, list) or len(key) != 2 or not all(isinstance(value, str) for value in key):
+            raise ValueError(f"Not a cursor: {key!r}")
+        received_at, message_id = key
+        return datetime.fromisoformat(received_at), message_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _etag(request: Request, mailbox: Mailbox):
+    """
+    A weak ETag for a mailbox read. It changes whenever any of the mailbox's
+    messages do, since the database bumps its change_version as they're
+    written, and differs per query, since each query returns a different body.
+    """
+    query_hash = hashlib.sha1(f'{request.url.path}?{request.url.query}'.encode()).hexdigest()[:16]
+    return f'W/"{mailbox.id}.{mailbox.change_version}.{query_hash}"'
+
+
+def _not_modified(request: Request, etag: str):
+    """
+    Whether the request's If-None-Match header matches an ETag. The header
+    can list several tags or be *, and tags compare weakly, ignoring W/.
+    """
+    header = request.headers.get('if-none-match')
+    if header is None:
+        return False
+
+    tags = {tag.strip().removeprefix('W/') for tag in header.split(',')}
+    return '*' in tags or etag.removeprefix('W/') in tags
+
+
+def _get_mailbox(session: Session):
+    try:
+        # TODO: Enhance to support multiple mailboxes
+        return session.exec(select(Mailbox)).one()
+    except NoResultFound:
+        raise HTTPException(status_code=404, detail="Mailbox not found")
+
+
+@router.get('/mailbox/messages')
+async def list_mailbox_messages(
+        *,
+        session: Session = Depends(get_db_session),
+        request: Request,
+        response: Response,
+        limit: int = Query(default=50, ge=1, le=200),
+        cursor: Optional[str] = None,
+        fields: Optional[str] = None,
+        message_type: Optional[MessageType] = None,
+        processed: Optional[bool] = None
+    ):
+    """
+    Pages through the mailbox's messages, newest first. Pass the returned
+    next_cursor to get the following page.
+    """
+    mailbox = _get_mailbox(session)
+    etag = _etag(request, mailbox)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    selected_fields = _parse_fields(fields)
+
+    statement = select(Message).options(
+        _load_only_fields(selected_fields)
+    ).where(
+        Message.mailbox_id == mailbox.id
+    )
+    if message_type is not None:
+        statement = statement.where(Message.message_type == message_type)
+    if processed is not None:
+        statement = statement.where(
+            Message.processed_clause() if processed else ~Message.processed_clause()
+        )
+    if cursor is not None:
+        statement = statement.where(
+            tuple_(Message.received_at, Message.id) < tuple_(*_decode_cursor(cursor))
+        )
+
+    # Fetch one extra message to find out if there's another page
+    messages = session.exec(
+        statement.order_by(Message.received_at.desc(), Message.id.desc()).limit(limit + 1)
+    ).all()
+    next_cursor = _encode_cursor(messages[limit - 1]) if len(messages) > limit else None
+
+    response.headers['ETag'] = etag
+    return {
+        'version': event_manager.mailbox_version,
+        'messages': [message.get_fields(selected_fields) for message in messages[:limit]],
+        'next_cursor': next_cursor,
+    }
+
+
+@router.get('/threads/{thread_id}')
+async def get_thread(
+        *,
+        session: Session = Depends(get_db_session),
+        request: Request,
+        response: Response,
+        thread_id: str,
+        fields: Optional[str] = None
+    ):
+    """Returns the messages in a single thread, oldest first."""
+    mailbox = _get_mailbox(session)
+    etag = _etag(request, mailbox)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    selected_fields = _parse_fields(fields)
+
+    messages = session.exec(
+        select(Message).options(
+            _load_only_fields(selected_fields)
+        ).where(
+            Message.mailbox_id == mailbox.id,
+            Message.thread_id == thread_id
+        ).order_by(Message.received_at, Message.id)
+    ).all()
+    if not messages:
+        raise HTTPException(status_code=404, detail="Thread not found")
+
+    response.headers['ETag'] = etag
+    return {
+        'version': event_manager.mailbox_version,
+        'thread_id': thread_id,
+        'messages': [message.get_fields(selected_fields) for message in messages],
+    }
@@ -0,0 +1,89 @@
+import logging
+import time
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _get_sync_cache():
+    # The shared cache, since activity is recorded in the server processes
+    # and the interval policy runs in the scheduler
+    from core.cache import cache
+    return cache.namespace('sync')
+
+
+def record_user_activity():
+    """
+    Note that the user is active, like connecting the extension or running a
+    function, so the inbox syncs more often for a while.
+    """
+    _get_sync_cache().set('last_activity_at', time.time())
+
+    # Wake the scheduler, so a sync which backed off is brought forward now
+    # rather than at its next check
+    from core import task_manager as task_manager_module
+    if task_manager_module.task_manager is not None:
+        task_manager_module.task_manager.wake_scheduler()
+
+
+def record_client_connected():
+    """Count a connected extension. The user is active for as long as one is connected."""
+    # Pinned, since evicting the count would lose the connected clients and
+    # send it negative as they disconnect
+    _get_sync_cache().incr('connected_clients', pinned=True)
+    record_user_activity()
+
+
+def record_client_disconnected():
+    _get_sync_cache().update('connected_clients', lambda value: max(0, (value or 0) - 1), pinned=True)
+
+    # The active window runs on from when it disconnected
+    record_user_activity()
+
+
+def record_sync_result(changed_thread_count: int, history_id_moved: bool):
+    """Count consecutive syncs which found no changes, so quiet mailboxes sync less."""
+    sync_cache = _get_sync_cache()
+    if changed_thread_count or history_id_moved:
+        sync_cache.set('quiet_syncs', 0)
+    else:
+        sync_cache.incr('quiet_syncs')
+
+
+def get_sync_interval():
+    """
+    The scheduler's interval policy for sync_inbox. Syncs often while the
+    user is active, and backs off exponentially while syncs find nothing new.
+    Returns (seconds, reason).
+    """
+    sync_cache = _get_sync_cache()
+    last_activity_at = sync_cache.get('last_activity_at')
+    quiet_syncs = sync_cache.get('quiet_syncs')
+
+    if (sync_cache.get('connected_clients') or 0) > 0:
+        interval, reason = settings.sync_interval_active, 'the extension is connected'
+    elif last_activity_at is not None and time.time() - last_activity_at < settings.sync_active_window:
+        interval, reason = settings.sync_interval_active, 'the user is active'
+    elif quiet_syncs is None:
+        interval, reason = settings.sync_interval, "the inbox hasn't synced yet"
+    elif quiet_syncs == 0:
+        interval, reason = settings.sync_interval, 'the last sync found changes'
+    else:
+        interval = min(settings.sync_interval * 2 ** quiet_syncs, settings.sync_interval_max)
+        reason = f"the last {quiet_syncs} syncs found no changes"
+
+    sync_cache.set('interval', {'interval': interval, 'reason': reason})
+    return interval, reason
+
+
+def get_sync_status():
+    """The current sync interval and why, as last decided by the scheduler."""
+    sync_cache = _get_sync_cache()
+    status = sync_cache.get('interval') or {'interval': None, 'reason': None}
+    return {
+        **status,
+        'last_activity_at': sync_cache.get('last_activity_at'),
+        'connected_clients': sync_cache.get('connected_clients') or 0,
+        'quiet_syncs': sync_cache.get('quiet_syncs') or 0,
+    }
@@ -1,20 +1,22 @@
 import logging
-import pendulum
 from sqlalchemy.exc import NoResultFound
 from sqlmodel import Session, select
 from typing import Any, Dict, List, Optional
 
 from config import db_engine
+from core.readiness import requires
 from library import speck_library
 
 from .models import Mailbox, Message, SelectedFunctionArgument
+from .sync import record_sync_result
 
 logger = logging.getLogger(__name__)
 
 
 def sync_inbox():
     """
-    Sync the local Mailbox with the user's Gmail inbox.
+    Sync the local Mailbox with the user's Gmail inbox. Returns the thread ids
+    which changed.
     """
     with Session(db_engine) as session:
         try:
@@ -24,16 +26,18 @@ def sync_inbox():
             # If we didn't find a Mailbox, then do nothing
             return
 
-    # If we last synced less than 30 seconds ago, skip this sync
-    if mailbox.last_synced_at and (pendulum.now('utc') - pendulum.instance(mailbox.last_synced_at)).in_seconds() < 30:
-        logger.info("Skipping inbox sync because it was last synced less than 30 seconds ago")
-        return
+    # How often we sync adapts to how much the mailbox is changing, see
+    # emails.sync.get_sync_interval()
+    last_history_id = mailbox.last_history_id
+    changed_thread_ids = mailbox.sync_inbox()
+    record_sync_result(len(changed_thread_ids), mailbox.last_history_id != last_history_id)
 
-    mailbox.sync_inbox()
+    return changed_thread_ids
 
+@requires('completion_model')
 def process_inbox_message(message_id: int):
     """
-    Process a new message.
+    Process a new message. Returns the thread ids which changed.
     """
     with Session(db_engine) as session:
         try:
@@ -49,6 +53,9 @@ def process_inbox_message(message_id: int):
         session.add(message)
         session.commit()
 
+        return [message.thread_id]
+
+@requires('embedding_model')
 def generate_embedding_for_message(message_id: int):
     """
     Generate an embedding for a given message.
@@ -58,12 +65,14 @@ def generate_embedding_for_message(message_id: int):
 
     message.generate_embedding()
 
+@requires('browser')
 def execute_function_for_message(
         thread_id: str,
         function_name: str
     ):
     """
-    Execute a Speck Function based on a message.
+    Execute a Speck Function based on a message. Returns the thread ids which
+    changed.
     """
     with Session(db_engine) as session:
         try:
@@ -78,3 +87,5 @@ def execute_function_for_message(
     with Session(db_engine) as session:
         session.add(message)
         session.commit()
+
+    return [thread_id]
@@ -1,5 +1,3 @@
-import googleapiclient.discovery
-import google.oauth2.credentials
 import keyring
 
 from config import settings
@@ -7,6 +5,8 @@ from config import settings
 
 def _get_user_credentials():
     """Get the stored user credentials from the keyring library."""
+    import google.oauth2.credentials
+
     access_token = keyring.get_password(settings.app_name, 'google_oauth_access_token')
     refresh_token = keyring.get_password(settings.app_name, 'google_oauth_refresh_token')
 
@@ -28,6 +28,10 @@ def get_gmail_api_client():
     Get the Gmail API client and make one API request to
     refresh the access token.
     """
+    # Imported here, since the Google API client is slow to import and only
+    # needed once we talk to Gmail
+    import googleapiclient.discovery
+
     credentials = _get_user_credentials()
     client = googleapiclient.discovery.build('gmail', 'v1', credentials=credentials, cache_discovery=False)
 
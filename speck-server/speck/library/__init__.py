@@ -1,7 +1,15 @@
 from datetime import datetime
-from typing import Any, List, Optional, get_type_hints, Callable, Dict
+import inspect
+import time
+from typing import Any, List, Literal, Optional, get_type_hints, Callable, Dict
 import pendulum
-from pydantic import BaseModel, Field, model_validator
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
+
+from config import settings
+from core.cancellation import TaskCancelled
+
+from .browser_pool import BrowserPool
+from .execution import EXECUTION_PROFILES, ExecutionProfile, FunctionRun, StepTiming, current_run, step
 
 
 class SpeckFunction(BaseModel):
@@ -10,6 +18,12 @@ class SpeckFunction(BaseModel):
     func: Callable
     parameters: List[dict] = Field(default_factory=list)
 
+    # Functions which take a page argument run in the library's browser
+    # pool, in a persistent context for their site which keeps its logins
+    site: Optional[str] = None
+    browser_type: Literal['firefox', 'chromium'] = 'firefox'
+    execution_profile: Optional[ExecutionProfile] = None  # Defaults to the function_execution_profile setting
+
     @model_validator(mode='after')
     def set_description(cls, values):
         if not values.description:
@@ -20,28 +34,76 @@ class SpeckFunction(BaseModel):
     def set_parameters(cls, values):
         func = values.func
         if func:
+            # The page comes from the browser pool, not the LLM
             values.parameters = [
                 {'name': k, 'type': str(v)} for k, v in get_type_hints(func).items()
+                if k not in ('page', 'return')
             ]
         return values
 
+    @property
+    def uses_browser(self):
+        return 'page' in inspect.signature(self.func).parameters
+
 
 class FunctionResult(BaseModel):
     success: bool
     success_message: Optional[str] = None
     error_message: Optional[str] = None
     executed_at: datetime = Field(default_factory=lambda: pendulum.now('utc'))
+    duration: Optional[float] = None  # Seconds
+    steps: List[StepTiming] = Field(default_factory=list)  # Timings of the steps the function marked with step()
+    trace_path: Optional[str] = None
 
 
 class SpeckLibrary(BaseModel):
     functions: Dict[str, SpeckFunction]
 
-    def execute_function(self, function_name: str, arguments: Dict[str, Any]) -> FunctionResult:
+    # Started when a function first needs a browser, in each worker
+    _browser_pool: BrowserPool = PrivateAttr(default_factory=BrowserPool)
+
+    def execute_function(
+            self,
+            function_name: str,
+            arguments: Dict[str, Any],
+            profile: Optional[ExecutionProfile] = None
+        ) -> FunctionResult:
+        """
+        Run a function, recording how long it and each of its steps took.
+        Browser functions run as the profile says, or else the function's own
+        profile or the function_execution_profile setting.
+        """
+        function = self.functions[function_name]
+        profile = profile or function.execution_profile or EXECUTION_PROFILES[settings.function_execution_profile]
+
+        run = FunctionRun()
+        run_token = current_run.set(run)
+        started_at = time.perf_counter()
         try:
-            success_message = self.functions[function_name].func(**arguments)
-            return FunctionResult(success=True, success_message=success_message)
+            if function.uses_browser:
+                success_message = self._browser_pool.run(
+                    function.site or function_name,
+                    function.browser_type,
+                    profile,
+                    function.func,
+                    **arguments
+                )
+            else:
+                success_message = function.func(**arguments)
+            result = FunctionResult(success=True, success_message=success_message)
+        except TaskCancelled:
+            # Let the worker mark the task cancelled or timed out, rather
+            # than record a failed run
+            raise
         except Exception as e:
-            return FunctionResult(success=False, error_message=str(e))
+            result = FunctionResult(success=False, error_message=str(e))
+        finally:
+            current_run.reset(run_token)
+
+        result.duration = time.perf_counter() - started_at
+        result.steps = run.steps
+        result.trace_path = run.trace_path
+        return result
 
 # TODO: Add a decorator to the SpeckFunction class to make it easy to add a function to the library
 from . import usps_hold_mail
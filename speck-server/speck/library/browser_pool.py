@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import itertools
+import logging
+from multiprocessing.util import Finalize
+import os
+import re
+import threading
+import time
+from typing import Callable
+
+from config import settings
+
+from .execution import ExecutionProfile, block_resources, current_run, step
+
+logger = logging.getLogger(__name__)
+
+
+def get_safe_name(site: str):
+    """A site's name, made safe to use in file names."""
+    return re.sub(r'[^\w.-]', '_', site)
+
+
+class PooledContext:
+    """A site's persistent browser context, and when a function last used it."""
+    def __init__(self, context, launch_options: dict):
+        self.context = context
+        self.launch_options = launch_options
+        self.closed = False
+        self.last_used_at = time.monotonic()
+        context.on('close', lambda _: setattr(self, 'closed', True))
+
+
+class BrowserPool:
+    """
+    Keeps browsers open between function runs, a persistent context per site
+    whose cookies and storage live in browser_profiles_dir. So functions skip
+    browser startup, and start logged in to sites they've logged in to before.
+
+    Playwright's sync API only works on the thread which started it, so the
+    pool runs functions on a browser thread of its own. Up to
+    browser_pool_size sites stay open per worker, closing the least recently
+    used past that and any unused for browser_idle_timeout.
+    """
+    def __init__(self):
+        self._contexts = OrderedDict()  # Keyed by (browser type, site), least recently used first
+        self._playwright = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._trace_ids = itertools.count()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='browser')
+            self._stop_event.clear()
+            threading.Thread(target=self._evict_periodically, args=(self._executor,), daemon=True).start()
+
+            # Close the browsers when the worker exits, so the profiles are
+            # saved. Workers exit without running atexit handlers.
+            Finalize(self, self.close, exitpriority=10)
+
+    def run(self, site: str, browser_type: str, profile: ExecutionProfile, func: Callable, **kwargs):
+        """
+        Run a function on the browser thread, passing it a new page in the
+        site's context, set up as the execution profile says.
+        """
+        self._start()
+
+        # Copy our context to the browser thread, so the function sees the
+        # task's cancellation token and records its steps in our run
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, self._run, site, browser_type, profile, func, kwargs)
+        return future.result()
+
+    def _run(self, site, browser_type, profile, func, kwargs):
+        pooled_context = self._get_context(site, browser_type, profile)
+        page = pooled_context.context.new_page()
+        block_resources(page, profile)
+
+        run = current_run.get()
+        tracing = pooled_context.context.tracing if profile.trace else None
+        if tracing is not None:
+            tracing.start(name=site, screenshots=False, snapshots=False)
+            if run is not None:
+                run.tracing = tracing
+
+        try:
+            return func(page=page, **kwargs)
+        finally:
+            if tracing is not None and not pooled_context.closed:
+                trace_path = self._get_trace_path(site)
+                tracing.stop(path=trace_path)
+                if run is not None:
+                    run.tracing = None
+                    run.trace_path = trace_path
+            if not pooled_context.closed:
+                page.close()
+            pooled_context.last_used_at = time.monotonic()
+
+    def _get_trace_path(self, site):
+        os.makedirs(settings.function_traces_dir, exist_ok=True)
+
+        # Keep only the most recent traces
+        traces = sorted(
+            (entry for entry in os.scandir(settings.function_traces_dir) if entry.name.endswith('.zip')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in traces[:max(0, len(traces) - settings.function_traces_kept + 1)]:
+            os.remove(entry.path)
+
+        return os.path.join(settings.function_traces_dir, f"{get_safe_name(site)}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(self._trace_ids)}.zip")
+
+    def _get_context(self, site, browser_type, profile):
+        key = (browser_type, site)
+        launch_options = {'headless': profile.headless, 'slow_mo': profile.slow_mo}
+        pooled_context = self._contexts.get(key)
+        if pooled_context is not None and not pooled_context.closed:
+            if pooled_context.launch_options == launch_options:
+                self._contexts.move_to_end(key)
+                return pooled_context
+
+            # The site's profile can only be open in one browser at a time
+            self._close_context(key, pooled_context)
+
+        # Make room for the site, closing the least recently used
+        self._contexts.pop(key, None)
+        while len(self._contexts) >= max(1, settings.browser_pool_size):
+            self._close_context(*self._contexts.popitem(last=False))
+
+        if self._playwright is None:
+            # Imported here, so importing the library stays cheap
+            from playwright.sync_api import sync_playwright
+            self._playwright = sync_playwright().start()
+
+        logger.info(f"Launching {browser_type} for {site}")
+        profile_dir = os.path.join(settings.browser_profiles_dir, browser_type, get_safe_name(site))
+        os.makedirs(profile_dir, exist_ok=True)
+        with step('Launch browser'):
+            context = getattr(self._playwright, browser_type).launch_persistent_context(profile_dir, **launch_options)
+
+        # Persistent contexts open with a blank page, but every run gets a
+        # page of its own
+        for page in context.pages:
+            page.close()
+
+        pooled_context = PooledContext(context, launch_options)
+        self._contexts[key] = pooled_context
+        return pooled_context
+
+    def _close_context(self, key, pooled_context):
+        browser_type, site = key
+        logger.info(f"Closing {browser_type} for {site}")
+        if not pooled_context.closed:
+            try:
+                pooled_context.context.close()
+            except Exception as e:
+                logger.warning(f"Error closing {browser_type} for {site}: {e}")
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key, pooled_context in list(self._contexts.items()):
+            if pooled_context.closed or now - pooled_context.last_used_at > settings.browser_idle_timeout:
+                self._close_context(key, self._contexts.pop(key))
+
+    def _evict_periodically(self, executor):
+        # Eviction runs on the browser thread too, between functions
+        while not self._stop_event.wait(timeout=min(60, settings.browser_idle_timeout)):
+            try:
+                executor.submit(self._evict_idle)
+            except RuntimeError:
+                # The pool was closed
+                return
+
+    def _close_all(self):
+        while self._contexts:
+            self._close_context(*self._contexts.popitem(last=False))
+        if self._playwright is not None:
+            self._playwright.stop()
+            self._playwright = None
+
+    def close(self):
+        """Close every browser, waiting for a running function to finish first."""
+        self._stop_event.set()
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.submit(self._close_all).result()
+            executor.shutdown()
@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+import contextvars
+import time
+from typing import List, Optional
+from urllib.parse import urlparse
+
+from pydantic import BaseModel, Field
+
+# Analytics, ad and session recording hosts, blocked with their subdomains
+TRACKER_DOMAINS = [
+    'doubleclick.net',
+    'google-analytics.com',
+    'googleadservices.com',
+    'googlesyndication.com',
+    'googletagmanager.com',
+    'facebook.net',
+    'connect.facebook.com',
+    'hotjar.com',
+    'segment.io',
+    'segment.com',
+    'newrelic.com',
+    'nr-data.net',
+    'quantserve.com',
+    'scorecardresearch.com',
+    'adobedtm.com',
+    'demdex.net',
+    'omtrdc.net',
+    'fullstory.com',
+    'mouseflow.com',
+    'clarity.ms',
+]
+
+
+class ExecutionProfile(BaseModel):
+    """How a function's browser runs."""
+    headless: bool = True
+    slow_mo: float = 0  # Milliseconds to slow each browser action by
+    blocked_resource_types: List[str] = Field(default_factory=lambda: ['image', 'font', 'media'])
+    blocked_domains: List[str] = Field(default_factory=lambda: list(TRACKER_DOMAINS))
+    trace: bool = True  # Save a Playwright trace of each run, with the steps grouped
+
+
+EXECUTION_PROFILES = {
+    # Fast and quiet, for functions run on the user's behalf
+    'production': ExecutionProfile(),
+    # A visible, slowed down browser which loads everything, for demos and
+    # developing functions
+    'demo': ExecutionProfile(
+        headless=False,
+        slow_mo=1500,
+        blocked_resource_types=[],
+        blocked_domains=[],
+        trace=False
+    ),
+}
+
+
+class StepTiming(BaseModel):
+    name: str
+    duration: float  # Seconds
+
+
+class FunctionRun:
+    """What's recorded while a function runs: its step timings and trace."""
+    def __init__(self):
+        self.steps: List[StepTiming] = []
+        self.trace_path: Optional[str] = None
+        self.tracing = None  # The browser context's tracing, while it's recording
+
+
+# The function run in progress in this context. The browser pool copies it
+# to its browser thread, so steps are recorded wherever the function runs.
+current_run = contextvars.ContextVar('current_run', default=None)
+
+@contextmanager
+def step(name: str):
+    """
+    Time a step of a function, like logging in, recording it in the
+    FunctionResult and grouping the step's actions in the trace.
+    """
+    run = current_run.get()
+    tracing = run.tracing if run is not None else None
+    # Trace groups are only in newer versions of Playwright
+    grouped = tracing is not None and hasattr(tracing, 'group')
+    if grouped:
+        tracing.group(name)
+
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        if run is not None:
+            run.steps.append(StepTiming(name=name, duration=time.perf_counter() - started_at))
+        if grouped:
+            tracing.group_end()
+
+
+def _is_blocked_domain(host: str, blocked_domains: set):
+    # Check the host and each domain it's under, so ads.example.com matches
+    # example.com
+    parts = host.split('.')
+    return any('.'.join(parts[i:]) in blocked_domains for i in range(len(parts) - 1))
+
+
+def block_resources(page, profile: ExecutionProfile):
+    """Abort the page's requests for the profile's blocked resource types and domains."""
+    blocked_resource_types = set(profile.blocked_resource_types)
+    blocked_domains = set(profile.blocked_domains)
+    if not blocked_resource_types and not blocked_domains:
+        return
+
+    def handle(route):
+        request = route.request
+        if (
+            request.resource_type in blocked_resource_types
+            or _is_blocked_domain(urlparse(request.url).hostname or '', blocked_domains)
+        ):
+            route.abort()
+        else:
+            route.continue_()
+
+    page.route('**/*', handle)
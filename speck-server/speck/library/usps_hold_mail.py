@@ -1,12 +1,10 @@
-import datetime
-from playwright.sync_api import sync_playwright
-
-from . import SpeckFunction
+from . import EXECUTION_PROFILES, SpeckFunction, step
 
 NAME = "USPS hold mail"
 
 
 def usps_hold_mail(
+        page,
         start_date: str,
         end_date: str
 ):
@@ -109,45 +107,45 @@ def usps_hold_mail(
         </example>
     </example-usage>
     """
-    with sync_playwright() as playwright:
-        browser = playwright.firefox.launch(
-            headless=False,
-            slow_mo=1500 # For demo purposes
-        )
-        context = browser.new_context()
-        page = context.new_page()
-
-        # Open the hold mail page on usps.com, which will redirect us to log in
+    # Open the hold mail page on usps.com, which redirects us to log in
+    # unless the browser pool's usps.com profile is still logged in
+    with step('Open hold mail page'):
         page.goto("https://holdmail.usps.com/holdmail")
 
-        # Log in
-        page.get_by_label("* Username").click()
-        page.get_by_label("* Username").fill("<your username>")
-        page.get_by_label("* Password").click()
-        page.get_by_label("* Password").fill("<your password>")
-        page.get_by_role("button", name="Sign In").click()
-
-        # Click "Check availability" on the hold mail page
+    # Log in
+    if page.get_by_role("button", name="Sign In").is_visible():
+        with step('Log in'):
+            page.get_by_label("* Username").click()
+            page.get_by_label("* Username").fill("<your username>")
+            page.get_by_label("* Password").click()
+            page.get_by_label("* Password").fill("<your password>")
+            page.get_by_role("button", name="Sign In").click()
+
+    # Click "Check availability" on the hold mail page
+    with step('Check availability'):
         page.get_by_role("button", name="Check Availability").click()
 
-        # Select the start and end dates
+    # Select the start and end dates
+    with step('Fill in dates'):
         page.locator("#start-date").fill(start_date)
         page.locator("#end-date").fill(end_date)
 
-        # Click "Schedule Hold Mail"
-        # (uncomment to actually schedule the mail hold)
+    # Click "Schedule Hold Mail"
+    # (uncomment to actually schedule the mail hold)
+    with step('Schedule hold mail'):
         page.get_by_role("button", name="Schedule Hold Mail").click()
 
         confirmation_span = page.get_by_text('Your Confirmation Number').first
         confirmation_number = confirmation_span.text_content().split(':')[1].strip()
 
-        # Return a success message
-        return f"Hold mail scheduled successfully starting {start_date} and ending {end_date} with confirmation number {confirmation_number}"
+    # Return a success message
+    return f"Hold mail scheduled successfully starting {start_date} and ending {end_date} with confirmation number {confirmation_number}"
 
 
 usps_hold_mail_function = SpeckFunction(
     name=NAME,
-    func=usps_hold_mail
+    func=usps_hold_mail,
+    site='usps.com'
 )
 
 
@@ -156,7 +154,9 @@ if __name__ == '__main__':
     # TODO: Only importing to get the Playwright environment variable set
     from config import settings
 
-    usps_hold_mail(
-        start_date=datetime.date(2024, 8, 25),
-        end_date=datetime.date(2024, 8, 30)
-    )
+    from . import speck_library
+    print(speck_library.execute_function(
+        'usps_hold_mail',
+        {'start_date': '08/25/2024', 'end_date': '08/30/2024'},
+        profile=EXECUTION_PROFILES['demo']
+    ))
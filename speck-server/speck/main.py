@@ -32,59 +32,287 @@ def reset():
     click.echo("Database reset")
 
 
+@cli.command()
+@click.argument('corpus_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--repeat', default=3, help='Times to convert the corpus with each extractor')
+def benchmark_bodies(corpus_dir, repeat):
+    """
+    Benchmarks the email body extractors on a directory of .eml and .html
+    files, like a corpus of marketing emails.
+    """
+    import statistics
+    import time
+    from config import settings
+    from emails.bodies import EXTRACTORS, extract_body, extract_body_from_raw
+
+    documents = []
+    for name in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, name)
+        if name.endswith('.eml'):
+            with open(path, 'rb') as f:
+                documents.append(('eml', f.read()))
+        elif name.endswith('.html'):
+            with open(path, encoding='utf-8', errors='replace') as f:
+                documents.append(('html', f.read()))
+
+    if not documents:
+        raise click.ClickException(f"No .eml or .html files in {corpus_dir}")
+    click.echo(f"{len(documents)} documents, {sum(len(document) for _, document in documents) / 1024:.0f} KiB")
+
+    for extractor_name, (_, available) in EXTRACTORS.items():
+        if not available:
+            click.echo(f"{extractor_name:>10}: not installed")
+            continue
+
+        timings = []
+        output_chars = 0
+        for _ in range(repeat):
+            output_chars = 0
+            for kind, document in documents:
+                started_at = time.perf_counter()
+                if kind == 'eml':
+                    body = extract_body_from_raw(document, extractor_name, settings.body_max_html_chars)
+                else:
+                    body = extract_body(document, extractor_name, settings.body_max_html_chars)
+                timings.append(time.perf_counter() - started_at)
+                output_chars += len(body or '')
+
+        click.echo(
+            f"{extractor_name:>10}: {sum(timings) / repeat * 1000:8.1f} ms per corpus, "
+            f"median {statistics.median(timings) * 1000:.2f} ms, "
+            f"p95 {statistics.quantiles(timings, n=20)[-1] * 1000:.2f} ms per document, "
+            f"{output_chars / 1024:.0f} KiB of text"
+        )
+
+
+@cli.command()
+@click.option('--operations', default=5000, help='Operations of each kind per backend')
+def benchmark_cache(operations):
+    """
+    Benchmarks the cache backends: the SQLite cache against the old
+    multiprocessing Manager cache.
+    """
+    import tempfile
+    import time
+    from multiprocessing import Manager
+    from core.cache import SharedCache, SQLiteCache
+
+    manager = Manager()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        backends = {
+            'manager': SharedCache(manager.dict(), manager.Lock()),
+            'sqlite': SQLiteCache(os.path.join(temp_dir, 'cache.db')),
+        }
+        state = {"embedding": {"pid": 1234, "usage_count": 1}, "completion": {"pid": None, "usage_count": 0}}
+
+        for backend_name, backend in backends.items():
+            backend.set('llm_service_state', state)
+            for operation_name, operation in [
+                ('get', lambda: backend.get('llm_service_state')),
+                ('set', lambda: backend.set('last_task', 'sync_inbox')),
+                ('incr', lambda: backend.incr('counter')),
+            ]:
+                started_at = time.perf_counter()
+                for _ in range(operations):
+                    operation()
+                elapsed = time.perf_counter() - started_at
+                click.echo(f"{backend_name:>8} {operation_name:>5}: {elapsed / operations * 1e6:7.1f} us per operation")
+
+    manager.shutdown()
+
+
+def report_worker_started(started_at, results):
+    # Import what a worker does before running its first tasks
+    import time
+    import emails.tasks
+    import profiles.tasks
+    import core.tasks
+    import psutil
+    memory = psutil.Process().memory_full_info()
+    results.put((time.time() - started_at, memory.rss, memory.uss))
+
+
+@cli.command()
+@click.option('--workers', default=4, help='Workers to start with each start method')
+def benchmark_worker_start(workers):
+    """
+    Benchmarks starting worker processes with spawn and forkserver: how long
+    until they've imported the task modules, and their memory. The first
+    forkserver worker includes starting the forkserver.
+    """
+    import time
+    from core.task_manager import FORKSERVER_PRELOAD
+
+    for start_method in ['spawn', 'forkserver']:
+        context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            context.set_forkserver_preload(FORKSERVER_PRELOAD)
+
+        results = context.Queue()
+        startup_times = []
+        for _ in range(workers):
+            process = context.Process(target=report_worker_started, args=(time.time(), results))
+            process.start()
+            startup_time, rss, uss = results.get()
+            process.join()
+            startup_times.append(startup_time)
+            click.echo(
+                f"{start_method:>10}: started in {startup_time:5.2f}s, "
+                f"RSS {rss / 1024 / 1024:6.1f} MiB, USS {uss / 1024 / 1024:6.1f} MiB"
+            )
+
+        steady_times = sorted(startup_times[1:] or startup_times)
+        click.echo(f"{start_method:>10}: median start after the first {steady_times[len(steady_times) // 2]:.2f}s")
+
+
+def measure_import_time(module, env=None):
+    """
+    Import a module in a fresh interpreter with -X importtime. Returns the
+    total seconds, not counting interpreter startup, and each import as
+    (self us, cumulative us, indented module name).
+    """
+    import subprocess
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    # Lines look like "import time: <self us> | <cumulative us> | <indented module>"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imports.append((int(self_us), int(cumulative_us), name.strip()))
+
+    return sum(self_us for self_us, _, _ in imports) / 1e6, imports
+
+
+@cli.command()
+@click.option('--module', 'modules', multiple=True, default=['server', 'emails.tasks'], help='Modules to import, by default the API server and the worker tasks')
+@click.option('--repeat', default=3, help='Times to import each module, keeping the fastest')
+@click.option('--top', default=10, help='Slowest packages and modules to show')
+@click.option('--budget', type=float, default=None, help='Exit non-zero if importing a module takes longer than this many seconds')
+def profile_startup(modules, repeat, top, budget):
+    """
+    Profiles importing the API server and the worker tasks in a fresh
+    interpreter with -X importtime, breaking the time down by package and
+    module. With --budget, fails when a module is over it, for CI. See also
+    tests/test_startup.py.
+    """
+    from collections import defaultdict
+    from config import settings
+
+    if settings.packaged:
+        raise click.ClickException("Profiling startup needs a Python interpreter, run it from source")
+
+    over_budget = []
+    for module in modules:
+        fastest = None
+        for _ in range(repeat):
+            try:
+                total, imports = measure_import_time(module)
+            except RuntimeError as e:
+                raise click.ClickException(str(e))
+
+            if fastest is None or total < fastest[0]:
+                fastest = (total, imports)
+
+        total, imports = fastest
+        click.echo(f"{module}: {total:.3f}s to import {len(imports)} modules")
+
+        package_times = defaultdict(int)
+        for self_us, _, name in imports:
+            package_times[name.split('.')[0]] += self_us
+        click.echo("  Slowest packages:")
+        for package, self_us in sorted(package_times.items(), key=lambda item: item[1], reverse=True)[:top]:
+            click.echo(f"    {self_us / 1e6:7.3f}s  {package}")
+
+        click.echo("  Slowest modules, not counting their imports:")
+        for self_us, _, name in sorted(imports, reverse=True)[:top]:
+            click.echo(f"    {self_us / 1e6:7.3f}s  {name}")
+
+        if budget is not None and total > budget:
+            over_budget.append(module)
+
+    if over_budget:
+        click.echo(f"Over the {budget:.3f}s budget: {', '.join(over_budget)}", err=True)
+        sys.exit(1)
+
+
 @cli.command()
 def start():
     """
-    Starts the Speck server and worker, plus schedules tasks to download
-    the Playwright browser and the LLM models.
+    Starts the Speck server and worker, plus schedules tasks to install the
+    Playwright browser and download the LLM models.
     """
     # Create the database tables
     from core.utils import create_database_tables
     create_database_tables()
 
-    # Start the task manager
-    task_manager.start(
-        num_workers=1
-    )
-
-    # Schedule a task to install the Playwright browser
-    from core.tasks import install_browser
-    task_manager.add_task(
-        task=install_browser
-    )
+    # Start the task manager, which sizes its worker pool to the workload
+    task_manager.start()
 
-    # Schedule a task to set up the LLM server
-    from core.tasks import download_models
-    task_manager.add_task(
-        task=download_models
-    )
+    # Schedule tasks to prepare the Playwright browser and the LLM models,
+    # which run in parallel. Tasks which need them wait until they're ready.
+    from core.readiness import get_required_resources
+    from core.tasks import download_model, install_browser
+    task_manager.add_task(task=install_browser)
+    task_manager.add_task(task=download_model, model_type='embedding')
+    if 'completion_model' in get_required_resources():
+        task_manager.add_task(task=download_model, model_type='completion')
 
     # Register signal handlers
     signal.signal(signal.SIGINT, handle_exit)
     signal.signal(signal.SIGTERM, handle_exit)
 
     # Start the FastAPI server
-    from server import app
     import uvicorn
-    uvicorn.run(app, host="127.0.0.1", port=17725)
+    if settings.server_workers > 1:
+        # Relay worker events to every server process through the event broker
+        from core.event_bus import event_bus
+        from core.pubsub import EventBroker
+        broker = EventBroker(
+            add_task=task_manager.add_task,
+            epoch=event_bus.epoch,
+            get_version=lambda: event_bus.version,
+            wake_scheduler=task_manager.wake_scheduler
+        )
+        broker.start()
+        event_bus.subscribe(broker.publish)
+
+        uvicorn.run("server:app", host="127.0.0.1", port=17725, workers=settings.server_workers)
+    else:
+        from server import app
+        uvicorn.run(app, host="127.0.0.1", port=17725)
 
 if __name__ == "__main__":
-    # Must be imported and set first, for PyInstaller
+    # Must be called first, for PyInstaller
     # https://pyinstaller.org/en/stable/common-issues-and-pitfalls.html#multi-processing
     multiprocessing.freeze_support()
-    multiprocessing.set_start_method('spawn')
-
-    # Create a multiprocessing Manager to use for the cache and task manager
-    from multiprocessing import Manager
-    manager = Manager()
-
-    # Initialize the cache
-    from core.cache import initialize_cache
-    initialize_cache(manager=manager)
 
     # Import and initialize the settings
     from config import settings
 
+    # Set how worker processes start, before any do
+    from core.task_manager import configure_start_method
+    configure_start_method()
+
+    # Initialize the cache, which starts empty on every run. Only the manager
+    # backend needs a multiprocessing Manager.
+    from core.cache import initialize_cache
+    if settings.cache_backend == 'manager':
+        from multiprocessing import Manager
+        initialize_cache(manager=Manager())
+    else:
+        initialize_cache().clear()
+
     # Initialize the task manager
     from core.task_manager import initialize_task_manager
     task_manager = initialize_task_manager(
@@ -61,6 +61,7 @@ class Profile(SQLModel, table=True):
             messages = session.exec(
                 select(Message).where(Message.mailbox_id == self.mailbox_id).order_by(Message.received_at.desc()).limit(10)
             ).all()
+        self.mailbox.fetch_full_messages(messages)
 
         class FullName(BaseModel):
             full_name: str = Field(max_length=80)
@@ -88,6 +89,7 @@ class Profile(SQLModel, table=True):
         
         # Get the 10 messages from the user's mailbox which are 'order confirmation' messages
         order_confirmation_messages = self.mailbox.search_embeddings('order confirmation')
+        self.mailbox.fetch_full_messages(order_confirmation_messages)
 
         class PrimaryAddress(BaseModel):
             primary_address: str = Field(max_length=160)
@@ -116,6 +118,7 @@ class Profile(SQLModel, table=True):
         
         # Get the 10 messages from the user's mailbox which are 'banking' messages
         banking_messages = self.mailbox.search_embeddings('banking')
+        self.mailbox.fetch_full_messages(banking_messages)
 
         class FinancialInstitutions(BaseModel):
             financial_institutions: List[str] = Field(max_length=80)
@@ -4,9 +4,11 @@ from sqlalchemy.exc import NoResultFound
 from sqlmodel import Session, select
 
 from config import db_engine
+from core.readiness import requires
 from .models import Profile
 
 
+@requires('completion_model')
 def update_profile():
     """
     Update a Profile, determining its attributes.
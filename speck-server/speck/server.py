@@ -1,12 +1,30 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from playwright.async_api import async_playwright
+
+# When uvicorn runs several server processes, connect this one to the event
+# broker before the routes bind the task manager
+from core.pubsub import initialize_server_process
+subscriber = initialize_server_process()
 
 from core import routes as core_routes
 from emails import routes as email_routes
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Deliver worker events on the server's event loop, either straight from
+    # the event bus or relayed by the event broker
+    if subscriber is not None:
+        subscriber.start(asyncio.get_running_loop())
+    else:
+        from core.event_bus import event_bus
+        event_bus.attach(asyncio.get_running_loop())
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
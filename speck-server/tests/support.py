@@ -0,0 +1,139 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+# Import before anything from the app. config creates its data directories
+# and databases on import, so point it at a scratch directory rather than
+# the user's.
+os.environ['APP_DATA_DIR'] = tempfile.mkdtemp(prefix='speck-tests-')
+atexit.register(shutil.rmtree, os.environ['APP_DATA_DIR'], ignore_errors=True)
+
+SPECK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'speck')
+if SPECK_DIR not in sys.path:
+    sys.path.insert(0, SPECK_DIR)
+
+
+class FakeClock:
+    """
+    Stands in for the time module in a module under test, so tests can move
+    time forward rather than sleep. Only time() is faked.
+    """
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        import time
+        return getattr(time, name)
+
+
+class FakeRequest:
+    def __init__(self, url: str, resource_type: str):
+        self.url = url
+        self.resource_type = resource_type
+
+
+class FakeRoute:
+    """A routed request, which records whether it was aborted or continued."""
+    def __init__(self, url: str, resource_type: str = 'document'):
+        self.request = FakeRequest(url, resource_type)
+        self.outcome = None
+
+    def abort(self):
+        self.outcome = 'aborted'
+
+    def continue_(self):
+        self.outcome = 'continued'
+
+
+class FakePage:
+    def __init__(self):
+        self.closed = False
+        self.route_handlers = []
+
+    def route(self, pattern: str, handler):
+        self.route_handlers.append((pattern, handler))
+
+    def request(self, url: str, resource_type: str = 'document'):
+        """Make a request through the page's routes, returning how it went."""
+        route = FakeRoute(url, resource_type)
+        if not self.route_handlers:
+            return 'continued'
+        self.route_handlers[-1][1](route)
+        return route.outcome
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTracing:
+    """Records what a context's tracing is asked to do."""
+    def __init__(self):
+        self.calls = []
+
+    def start(self, **kwargs):
+        self.calls.append(('start',))
+
+    def group(self, name: str):
+        self.calls.append(('group', name))
+
+    def group_end(self):
+        self.calls.append(('group_end',))
+
+    def stop(self, path: str):
+        self.calls.append(('stop',))
+        with open(path, 'wb'):
+            pass
+
+
+class FakeContext:
+    """Stands in for a Playwright persistent browser context."""
+    def __init__(self, profile_dir: str, options: dict):
+        self.profile_dir = profile_dir
+        self.options = options
+        self.pages = [FakePage()]  # The blank page it opens with
+        self.tracing = FakeTracing()
+        self.closed = False
+        self.close_handlers = []
+
+    def on(self, event: str, handler):
+        if event == 'close':
+            self.close_handlers.append(handler)
+
+    def new_page(self):
+        page = FakePage()
+        self.pages.append(page)
+        return page
+
+    def close(self):
+        self.closed = True
+        for handler in self.close_handlers:
+            handler(self)
+
+
+class FakeBrowserType:
+    def __init__(self):
+        self.contexts = []
+
+    def launch_persistent_context(self, profile_dir: str, **options):
+        context = FakeContext(profile_dir, options)
+        self.contexts.append(context)
+        return context
+
+
+class FakePlaywright:
+    """Stands in for a started sync_playwright(), recording the contexts it launches."""
+    def __init__(self):
+        self.firefox = FakeBrowserType()
+        self.chromium = FakeBrowserType()
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
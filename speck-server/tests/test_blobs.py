@@ -0,0 +1,45 @@
+import unittest
+import zlib
+
+import support
+from sqlmodel import Session, delete
+
+from config import db_engine
+from core.blobs import Blob, get_blob, put_blob
+from core.utils import create_database_tables
+
+RAW_MESSAGE = b'Subject: Hello\r\n\r\n' + b'<p>Hello there</p>\r\n' * 100
+
+
+class BlobTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_database_tables()
+
+    def setUp(self):
+        with Session(db_engine) as session:
+            session.exec(delete(Blob))
+            session.commit()
+
+    def test_blobs_are_stored_once_with_zstd(self):
+        with Session(db_engine) as session:
+            digest = put_blob(session, RAW_MESSAGE)
+            self.assertEqual(put_blob(session, RAW_MESSAGE), digest)
+            session.commit()
+
+            blob = session.get(Blob, digest)
+            self.assertEqual((blob.codec, blob.size), ('zstd', len(RAW_MESSAGE)))
+            self.assertLess(len(blob.data), len(RAW_MESSAGE))
+
+        self.assertEqual(get_blob(digest), RAW_MESSAGE)
+
+    def test_reads_zlib_blobs_stored_before_zstd(self):
+        with Session(db_engine) as session:
+            session.add(Blob(digest='legacy', codec='zlib', size=len(RAW_MESSAGE), data=zlib.compress(RAW_MESSAGE)))
+            session.commit()
+
+        self.assertEqual(get_blob('legacy'), RAW_MESSAGE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+
+import support
+from emails.bodies import Html2TextExtractor, extract_body, get_extractor
+
+# Leaves a style element open, which would hide the next document from
+# HTML2Text if it weren't reset
+UNCLOSED_HTML = '<html><head><style>p { color: red; }'
+HTML = '<html><head><style>p { color: red; }</style></head><body><p>Hello <b>there</b></p><div>Second<br>line</div></body></html>'
+
+
+class ExtractBodyTest(unittest.TestCase):
+    def test_auto_uses_selectolax(self):
+        self.assertEqual(get_extractor().name, 'selectolax')
+        self.assertEqual(extract_body(HTML), 'Hello there\nSecond\nline')
+
+    def test_html2text_converter_is_reset_between_documents(self):
+        extractor = Html2TextExtractor()
+        converter = extractor.converter
+        expected = Html2TextExtractor().extract(HTML)
+
+        extractor.extract(UNCLOSED_HTML)
+        self.assertEqual(extractor.extract(HTML), expected)
+        self.assertIs(extractor.converter, converter)
+
+
+if __name__ == '__main__':
+    unittest.main()
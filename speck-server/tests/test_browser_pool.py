@@ -0,0 +1,139 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+from config import settings
+from library import browser_pool as browser_pool_module
+from library.browser_pool import BrowserPool
+from library.execution import EXECUTION_PROFILES, ExecutionProfile
+
+PROFILE = ExecutionProfile(trace=False)
+
+
+def get_page(page):
+    return page
+
+
+class BrowserPoolTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        for name, value in [
+            ('browser_profiles_dir', os.path.join(directory.name, 'browser_profiles')),
+            ('function_traces_dir', os.path.join(directory.name, 'traces')),
+            ('browser_pool_size', 2),
+            ('browser_idle_timeout', 600),
+        ]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # The pool times idleness with monotonic()
+        self.clock = support.FakeClock()
+        self.clock.monotonic = self.clock.time
+        patcher = mock.patch.object(browser_pool_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.playwright = support.FakePlaywright()
+        self.browser_pool = BrowserPool()
+        self.browser_pool._playwright = self.playwright
+        self.addCleanup(self.browser_pool.close)
+
+    def run_function(self, site, browser_type='firefox', profile=PROFILE):
+        return self.browser_pool.run(site, browser_type, profile, get_page)
+
+    def get_open_sites(self):
+        return [site for _, site in self.browser_pool._contexts]
+
+    def test_reuses_each_sites_persistent_context(self):
+        first_page = self.run_function('usps.com')
+        second_page = self.run_function('usps.com')
+
+        # One browser, launched on the site's own profile
+        [context] = self.playwright.firefox.contexts
+        self.assertEqual(context.profile_dir, os.path.join(self.directory, 'browser_profiles', 'firefox', 'usps.com'))
+        self.assertEqual(context.options, {'headless': True, 'slow_mo': 0})
+
+        # Each run gets a new page, closed afterwards, and the blank page
+        # the context opened with is closed too
+        self.assertIsNot(first_page, second_page)
+        self.assertEqual(context.pages, [context.pages[0], first_page, second_page])
+        self.assertTrue(all(page.closed for page in context.pages))
+        self.assertFalse(context.closed)
+
+    def test_keeps_browser_types_and_sites_apart(self):
+        self.run_function('usps.com')
+        self.run_function('usps.com', browser_type='chromium')
+        self.run_function('Example Site/Login')
+
+        self.assertEqual(len(self.playwright.firefox.contexts), 2)
+        self.assertEqual(len(self.playwright.chromium.contexts), 1)
+        self.assertEqual(os.path.basename(self.playwright.firefox.contexts[1].profile_dir), 'Example_Site_Login')
+
+    def test_relaunches_for_different_launch_options(self):
+        self.run_function('usps.com')
+        self.run_function('usps.com', profile=EXECUTION_PROFILES['demo'])
+
+        first_context, second_context = self.playwright.firefox.contexts
+        self.assertTrue(first_context.closed)
+        self.assertEqual(second_context.options, {'headless': False, 'slow_mo': 1500})
+
+    def test_relaunches_contexts_which_were_closed(self):
+        self.run_function('usps.com')
+        self.playwright.firefox.contexts[0].close()
+        self.run_function('usps.com')
+
+        self.assertEqual(len(self.playwright.firefox.contexts), 2)
+        self.assertEqual(self.get_open_sites(), ['usps.com'])
+
+    def test_closes_the_least_recently_used_past_the_pool_size(self):
+        for site in ['a.com', 'b.com', 'a.com', 'c.com']:
+            self.run_function(site)
+
+        a_context, b_context, c_context = self.playwright.firefox.contexts
+        self.assertEqual(self.get_open_sites(), ['a.com', 'c.com'])
+        self.assertEqual([a_context.closed, b_context.closed, c_context.closed], [False, True, False])
+
+    def test_closes_contexts_left_idle(self):
+        self.run_function('a.com')
+        self.clock.advance(500)
+        self.run_function('b.com')
+
+        self.clock.advance(101)
+        self.browser_pool._evict_idle()
+        self.assertEqual(self.get_open_sites(), ['b.com'])
+        self.assertTrue(self.playwright.firefox.contexts[0].closed)
+
+        # Until it's used again
+        self.run_function('a.com')
+        self.assertEqual(len(self.playwright.firefox.contexts), 3)
+
+    def test_close_closes_every_browser(self):
+        self.run_function('a.com')
+        self.run_function('b.com')
+        self.browser_pool.close()
+
+        self.assertTrue(all(context.closed for context in self.playwright.firefox.contexts))
+        self.assertTrue(self.playwright.stopped)
+        self.assertEqual(self.get_open_sites(), [])
+
+    def test_traces_runs_if_the_profile_says_to(self):
+        for _ in range(3):
+            self.run_function('usps.com', profile=ExecutionProfile(trace=True))
+
+        # Only the most recent traces are kept
+        with mock.patch.object(settings, 'function_traces_kept', 2):
+            self.run_function('usps.com', profile=ExecutionProfile(trace=True))
+        self.assertEqual(len(os.listdir(settings.function_traces_dir)), 2)
+
+        tracing = self.playwright.firefox.contexts[0].tracing
+        self.assertEqual(tracing.calls, [('start',), ('stop',)] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import support
+from core import cache as cache_module
+from core.cache import ACCESS_TIME_RESOLUTION, SQLiteCache
+
+
+class SQLiteCacheTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.db')
+
+        self.clock = support.FakeClock()
+        patcher = mock.patch.object(cache_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = SQLiteCache(self.path)
+
+    def test_set_get_and_delete(self):
+        self.cache.set('key', {'value': [1, 2]})
+        self.assertEqual(self.cache.get('key'), {'value': [1, 2]})
+
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+        with self.assertRaises(KeyError):
+            self.cache.delete('key')
+
+    def test_entries_expire(self):
+        self.cache.set('key', 'value', ttl=10)
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get('key'), 'value')
+        self.clock.advance(2)
+        self.assertIsNone(self.cache.get('key'))
+
+        # An expired key can be added again
+        self.assertTrue(self.cache.add('key', 'new value'))
+        self.assertFalse(self.cache.add('key', 'newer value'))
+        self.assertEqual(self.cache.get('key'), 'new value')
+
+    def test_processes_share_entries(self):
+        # Each process opens the database itself
+        self.cache.set('key', 'value')
+        self.assertEqual(SQLiteCache(self.path).get('key'), 'value')
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = SQLiteCache(self.path, max_bytes=3500)
+        value = 'x' * 1000
+        for key in ('a', 'b', 'c'):
+            cache.set(key, value)
+            self.clock.advance(ACCESS_TIME_RESOLUTION + 1)
+
+        # Reading a refreshes it, so b is now the least recently used
+        cache.get('a')
+        cache.set('d', value)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(key) is not None for key in ('a', 'c', 'd')], [True, True, True])
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_evicts_expired_entries_first(self):
+        cache = SQLiteCache(self.path, max_bytes=3500)
+        value = 'x' * 1000
+        cache.set('a', value)
+        cache.set('b', value, ttl=5)
+        cache.set('c', value)
+        self.clock.advance(10)
+
+        cache.set('d', value)
+        self.assertEqual([cache.get(key) is not None for key in ('a', 'c', 'd')], [True, True, True])
+
+    def test_never_evicts_pinned_entries(self):
+        cache = SQLiteCache(self.path, max_bytes=3500)
+        value = 'x' * 1000
+        cache.set('pinned', value, pinned=True)
+        cache.incr('pinned_count', pinned=True)
+        for i in range(10):
+            self.clock.advance(ACCESS_TIME_RESOLUTION + 1)
+            cache.set(f'key{i}', value)
+
+        self.assertEqual(cache.get('pinned'), value)
+        self.assertEqual(cache.get('pinned_count'), 1)
+
+    def test_incr_is_atomic_across_threads(self):
+        def increment():
+            for _ in range(50):
+                self.cache.incr('count')
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.cache.get('count'), 400)
+
+    def test_get_or_compute_computes_once(self):
+        computations = []
+
+        def compute():
+            computations.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache.get_or_compute('key', compute)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(computations), 1)
+        self.assertEqual(results, ['value'] * 8)
+
+    def test_get_or_compute_takes_over_from_a_dead_computation(self):
+        # A lock left behind by a process which died while computing
+        self.cache.add('key#computing', 12345, ttl=60)
+        self.clock.advance(61)
+
+        self.assertEqual(self.cache.get_or_compute('key', lambda: 'value'), 'value')
+
+    def test_namespaces(self):
+        sync = self.cache.namespace('sync')
+        sync.set('interval', 60)
+        self.cache.namespace('readiness').set('browser', 'ready')
+
+        self.assertEqual(self.cache.get('sync:interval'), 60)
+        sync.clear()
+        self.assertIsNone(sync.get('interval'))
+        self.assertEqual(self.cache.namespace('readiness').get('browser'), 'ready')
+
+
+if __name__ == '__main__':
+    unittest.main()
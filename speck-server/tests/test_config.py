@@ -0,0 +1,49 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+import config
+
+
+class DatabaseLayoutTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        patcher = mock.patch.dict(config.DATABASE_SCHEMAS, {
+            'blobs': os.path.join(directory.name, 'blobs.db'),
+            'vectors': os.path.join(directory.name, 'vectors.db'),
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, database_layout):
+        connection = sqlite3.connect(os.path.join(self.directory, 'speck.db'))
+        self.addCleanup(connection.close)
+        with mock.patch.object(config.settings, 'database_layout', database_layout):
+            config.on_connect(connection, None)
+        return connection
+
+    def test_single_layout_keeps_sqlites_defaults(self):
+        connection = self.connect('single')
+
+        self.assertEqual([row[1] for row in connection.execute('PRAGMA database_list')], ['main'])
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+        self.assertEqual(connection.execute('PRAGMA cache_size').fetchone()[0], -2000)
+
+    def test_split_layout_attaches_databases_with_their_own_pragmas(self):
+        connection = self.connect('split')
+
+        self.assertEqual([row[1] for row in connection.execute('PRAGMA database_list')], ['main', 'blobs', 'vectors'])
+        for schema, cache_size in (('main', -32000), ('blobs', -2000), ('vectors', -16000)):
+            with self.subTest(schema=schema):
+                self.assertEqual(connection.execute(f'PRAGMA {schema}.journal_mode').fetchone()[0], 'wal')
+                self.assertEqual(connection.execute(f'PRAGMA {schema}.cache_size').fetchone()[0], cache_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
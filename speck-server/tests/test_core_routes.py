@@ -0,0 +1,62 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+import support
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from core import routes
+
+
+class WebsocketTest(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(routes.router)
+        self.client = TestClient(app)
+
+        # Accept the socket, but don't send it any events
+        self.task_added = threading.Event()
+        self.task_manager = mock.Mock()
+        self.task_manager.add_task.side_effect = lambda **kwargs: self.task_added.set()
+        self.calls = []
+        patchers = [
+            mock.patch.object(routes.event_manager, 'connect'),
+            mock.patch.object(routes.event_manager, 'disconnect'),
+            mock.patch.object(routes, 'task_manager', self.task_manager),
+        ] + [
+            mock.patch.object(routes, name, side_effect=lambda name=name: self.calls.append((name, self.on_event_loop())))
+            for name in ('record_client_connected', 'record_client_disconnected', 'record_user_activity')
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def on_event_loop(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        return True
+
+    def test_records_the_client_off_the_event_loop(self):
+        with self.client.websocket_connect('/ws') as websocket:
+            websocket.send_json({'action': 'execute_function', 'args': {'thread_id': 'thread-1', 'function_name': 'usps_hold_mail'}})
+            self.assertTrue(self.task_added.wait(5))
+
+        # Closing the test client's socket cancels the endpoint, which still
+        # records the disconnect
+        routes.event_manager.disconnect.assert_called_once()
+        self.assertEqual(self.calls, [
+            ('record_client_connected', False),
+            ('record_user_activity', False),
+            ('record_client_disconnected', False),
+        ])
+
+        _, kwargs = self.task_manager.add_task.call_args
+        self.assertEqual((kwargs['thread_id'], kwargs['max_attempts']), ('thread-1', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
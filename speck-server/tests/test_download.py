@@ -0,0 +1,123 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import support
+from core import utils
+from core.event_bus import event_bus
+
+CHUNK_SIZE = 1024
+CONTENT = os.urandom(CHUNK_SIZE * 4 + 100)
+CONTENT_SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    """Serves CONTENT, honouring single Range headers like Hugging Face's CDN."""
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(CONTENT)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        self.server.ranges.append(range_header)
+        if range_header is None:
+            start, end = 0, len(CONTENT) - 1
+            self.send_response(200)
+        else:
+            start, end = (int(position) for position in range_header.removeprefix('bytes=').split('-'))
+            end = min(end, len(CONTENT) - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(CONTENT)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(CONTENT[start:end + 1])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DownloadFileTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        self.server.ranges = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/model.gguf'
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.output_path = os.path.join(directory.name, 'models', 'model.gguf')
+
+        # Capture the progress events rather than publishing them
+        self.events = []
+        patcher = mock.patch.object(event_bus, 'subscribers', [self.events.append])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def download(self, sha256=CONTENT_SHA256):
+        utils.download_file(self.url, self.output_path, sha256=sha256, connections=2, chunk_size=CHUNK_SIZE)
+
+    def test_downloads_in_chunks_and_renames_into_place(self):
+        replace = mock.Mock(wraps=os.replace)
+        with mock.patch.object(utils.os, 'replace', replace):
+            self.download()
+
+        with open(self.output_path, 'rb') as file:
+            self.assertEqual(file.read(), CONTENT)
+        self.assertEqual(len(self.server.ranges), 5)
+
+        # The file only appears once it's complete and verified
+        replace.assert_called_with(f'{self.output_path}.part', self.output_path)
+        self.assertFalse(os.path.exists(f'{self.output_path}.part'))
+        self.assertFalse(os.path.exists(f'{self.output_path}.manifest.json'))
+        self.assertEqual(self.events[-1]['status'], 'complete')
+        self.assertEqual(self.events[-1]['downloaded'], len(CONTENT))
+
+    def test_resumes_from_a_partial_download(self):
+        # An interrupted download, with chunks 0 and 2 of 5 complete
+        os.makedirs(os.path.dirname(self.output_path))
+        with open(f'{self.output_path}.part', 'wb') as file:
+            file.write(CONTENT[:CHUNK_SIZE])
+            file.write(bytes(CHUNK_SIZE))
+            file.write(CONTENT[2 * CHUNK_SIZE:3 * CHUNK_SIZE])
+            file.truncate(len(CONTENT))
+        with open(f'{self.output_path}.manifest.json', 'w') as file:
+            json.dump({
+                'url': self.url,
+                'size': len(CONTENT),
+                'chunk_size': CHUNK_SIZE,
+                'sha256': CONTENT_SHA256,
+                'completed': [0, 2],
+            }, file)
+
+        self.download()
+
+        with open(self.output_path, 'rb') as file:
+            self.assertEqual(file.read(), CONTENT)
+        self.assertCountEqual(self.server.ranges, [
+            f'bytes={CHUNK_SIZE}-{2 * CHUNK_SIZE - 1}',
+            f'bytes={3 * CHUNK_SIZE}-{4 * CHUNK_SIZE - 1}',
+            f'bytes={4 * CHUNK_SIZE}-{len(CONTENT) - 1}',
+        ])
+
+    def test_digest_mismatch_leaves_no_file(self):
+        with self.assertRaises(ValueError):
+            self.download(sha256='0' * 64)
+
+        # It starts over next time, since we can't tell which chunks are bad
+        self.assertFalse(os.path.exists(self.output_path))
+        self.assertFalse(os.path.exists(f'{self.output_path}.part'))
+        self.assertFalse(os.path.exists(f'{self.output_path}.manifest.json'))
+        self.assertEqual(self.events[-1]['status'], 'failed')
+
+
+if __name__ == '__main__':
+    unittest.main()
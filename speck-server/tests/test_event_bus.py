@@ -0,0 +1,147 @@
+import asyncio
+from datetime import datetime, timedelta
+import threading
+import time
+import unittest
+from unittest import mock
+
+import support
+from sqlmodel import Session, delete, select
+
+from config import db_engine, settings
+from core import event_manager as event_manager_module
+from core.event_bus import EventBus
+from core.event_manager import EventManager
+from core.utils import create_database_tables
+from emails.models import Mailbox, Message
+
+
+class EventBusTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_database_tables()
+
+    def setUp(self):
+        with Session(db_engine) as session:
+            session.exec(delete(Message))
+            session.exec(delete(Mailbox))
+            session.add(Mailbox(email_address='me@example.com'))
+            session.commit()
+
+        self.event_bus = EventBus()
+        self.events = []
+        self.event_bus.subscribe(self.events.append)
+
+    def start_dispatching(self, coalesce_delay, coalesce_max_delay):
+        """Start the dispatcher with the given delays, recording the thread ids of each flush."""
+        for name, value in [('event_coalesce_delay', coalesce_delay), ('event_coalesce_max_delay', coalesce_max_delay)]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.flushes = []
+        self.flushed = threading.Event()
+        def flush(thread_ids):
+            self.flushes.append(sorted(thread_ids))
+            self.flushed.set()
+        patcher = mock.patch.object(self.event_bus, '_flush', side_effect=flush)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.event_bus.start()
+        self.addCleanup(self.event_bus.stop)
+
+    def test_coalesces_bursts_of_task_results(self):
+        self.start_dispatching(coalesce_delay=0.2, coalesce_max_delay=5)
+
+        # Only mailbox tasks which changed something count
+        self.event_bus.publish_task_result('process_inbox_message', ['thread-1'])
+        self.event_bus.publish_task_result('generate_embedding_for_message', ['thread-2'])
+        time.sleep(0.05)
+        self.event_bus.publish_task_result('process_inbox_message', [])
+        self.event_bus.publish_task_result('sync_inbox', ['thread-1', 'thread-3'])
+
+        self.assertTrue(self.flushed.wait(5))
+        self.assertEqual(self.flushes, [['thread-1', 'thread-3']])
+
+    def test_steady_results_are_flushed_by_the_max_delay(self):
+        self.start_dispatching(coalesce_delay=0.2, coalesce_max_delay=0.3)
+
+        # Never quiet for the coalesce delay
+        for i in range(12):
+            self.event_bus.publish_task_result('process_inbox_message', [f'thread-{i}'])
+            time.sleep(0.05)
+        self.assertTrue(self.flushed.wait(5))
+
+        self.assertGreaterEqual(len(self.flushes), 2)
+
+    def test_flush_versions_each_delta(self):
+        self.event_bus._flush(['thread-1'])
+        self.event_bus._flush(['thread-2', 'thread-3'])
+
+        self.assertEqual([(event['type'], event['epoch'], event['version']) for event in self.events], [
+            ('mailbox_delta', self.event_bus.epoch, 1),
+            ('mailbox_delta', self.event_bus.epoch, 2),
+        ])
+        self.assertEqual(self.events[1]['changes'], [
+            {'op': 'delete', 'thread_id': 'thread-2'},
+            {'op': 'delete', 'thread_id': 'thread-3'},
+        ])
+
+    def test_flush_sends_each_changed_threads_latest_message(self):
+        with Session(db_engine) as session:
+            mailbox_id = session.exec(select(Mailbox)).one().id
+            received_at = datetime(2024, 5, 1, 12, 0)
+            for i in range(2):
+                session.add(Message(
+                    id=f'message-{i}',
+                    mailbox_id=mailbox_id,
+                    thread_id='thread-1',
+                    from_='sender@example.com',
+                    subject=f'Message {i}',
+                    received_at=received_at + timedelta(minutes=i),
+                    body='Hello',
+                    summary=f'Summary {i}'
+                ))
+            session.commit()
+
+        # A thread without messages any more, like one whose only message
+        # left the inbox, is deleted
+        self.event_bus._flush(['thread-1', 'thread-2'])
+
+        changes = self.events[0]['changes']
+        self.assertEqual([(change['op'], change['thread_id']) for change in changes], [('upsert', 'thread-1'), ('delete', 'thread-2')])
+        self.assertEqual((changes[0]['message']['id'], changes[0]['message']['summary']), ('message-1', 'Summary 1'))
+
+    def test_flush_delivers_to_the_server_loop(self):
+        event_manager = EventManager()
+        patcher = mock.patch.object(event_manager_module, 'event_manager', event_manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+        self.event_bus._flush(['thread-1'])
+        self.event_bus.attach(loop)
+        self.event_bus._flush(['thread-2'])
+
+        # The server adopts the bus's epoch and version when it attaches, so
+        # clients see an unbroken run of versions
+        self.assertEqual(event_manager.mailbox_epoch, self.event_bus.epoch)
+        self.assertEqual(event_manager.mailbox_version, 2)
+        self.assertEqual([event['version'] for event in event_manager.change_log], [2])
+        self.assertEqual(event_manager.get_changes_since(self.event_bus.epoch, 1), [self.events[1]])
+
+    def test_flush_drops_changes_nobody_is_listening_for(self):
+        self.event_bus.subscribers.clear()
+        self.event_bus._flush(['thread-1'])
+        self.assertEqual(self.event_bus.version, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import support
+from config import settings
+from core.event_manager import EventManager
+
+
+class FakeWebSocket:
+    """Records what's sent to it. A blocked socket holds up its writer, like a slow client."""
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.close_code = None
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_text(self, text):
+        await self.unblocked.wait()
+        self.sent.append(json.loads(text))
+
+    async def close(self, code=1000):
+        await self.unblocked.wait()
+        self.close_code = code
+
+
+class EventManagerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        for name, value in [
+            ('event_send_queue_size', 3),
+            ('mailbox_change_log_size', 5),
+            ('event_slow_consumer_policy', 'snapshot'),
+        ]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.event_manager = EventManager()
+
+        # Snapshots are of the mailbox at the version they were taken
+        async def get_mailbox_snapshot_event():
+            return self.event_manager.get_mailbox_snapshot({})
+        self.event_manager.get_mailbox_snapshot_event = get_mailbox_snapshot_event
+
+    async def connect(self, websocket, **kwargs):
+        await self.event_manager.connect(websocket, **kwargs)
+        self.addAsyncCleanup(self.disconnect, websocket)
+
+    async def disconnect(self, websocket):
+        websocket.unblocked.set()
+        self.event_manager.disconnect(websocket)
+        await asyncio.sleep(0)
+
+    async def publish_deltas(self, count):
+        """Publish deltas one at a time, like the event bus, letting the writers run in between."""
+        for _ in range(count):
+            version = self.event_manager.mailbox_version + 1
+            await self.event_manager.publish_mailbox_delta({
+                'type': 'mailbox_delta',
+                'epoch': self.event_manager.mailbox_epoch,
+                'version': version,
+                'changes': [{'op': 'delete', 'thread_id': f'thread-{version}'}],
+            })
+            await self.drain()
+
+    async def drain(self):
+        """Let the writers send everything they can."""
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    def received(self, websocket):
+        return [(event['type'], event['version']) for event in websocket.sent]
+
+    async def test_new_clients_get_a_snapshot_then_deltas(self):
+        await self.publish_deltas(2)
+        websocket = FakeWebSocket()
+        await self.connect(websocket)
+        await self.drain()
+        await self.publish_deltas(1)
+
+        self.assertEqual(self.received(websocket), [('mailbox', 2), ('mailbox_delta', 3)])
+
+    async def test_reconnecting_clients_get_the_deltas_they_missed(self):
+        await self.publish_deltas(4)
+        websocket = FakeWebSocket()
+        await self.connect(websocket, epoch=self.event_manager.mailbox_epoch, version=2)
+        await self.drain()
+
+        self.assertEqual(self.received(websocket), [('mailbox_delta', 3), ('mailbox_delta', 4)])
+
+    async def test_reconnecting_clients_get_a_snapshot_past_the_change_log(self):
+        await self.publish_deltas(8)
+        epoch = self.event_manager.mailbox_epoch
+
+        for kwargs in [
+            # The change log only goes back to version 4
+            {'epoch': epoch, 'version': 2},
+            # More deltas than fit in its send queue
+            {'epoch': epoch, 'version': 4},
+            # From before the server restarted
+            {'epoch': 'old-epoch', 'version': 8},
+        ]:
+            with self.subTest(**kwargs):
+                websocket = FakeWebSocket()
+                await self.connect(websocket, **kwargs)
+                await self.drain()
+                self.assertEqual(self.received(websocket), [('mailbox', 8)])
+
+    async def test_slow_clients_get_a_snapshot_instead_of_their_backlog(self):
+        slow_websocket = FakeWebSocket(blocked=True)
+        websocket = FakeWebSocket()
+        await self.connect(slow_websocket, epoch=self.event_manager.mailbox_epoch, version=0)
+        await self.connect(websocket, epoch=self.event_manager.mailbox_epoch, version=0)
+
+        # The slow client's writer is stuck sending the first delta, and its
+        # queue of three overflows on the fifth
+        await self.publish_deltas(5)
+        slow_websocket.unblocked.set()
+        await self.drain()
+
+        self.assertEqual(self.received(slow_websocket), [('mailbox_delta', 1), ('mailbox', 5)])
+        self.assertEqual(self.received(websocket), [('mailbox_delta', version) for version in range(1, 6)])
+
+    async def test_slow_clients_can_be_disconnected_instead(self):
+        slow_websocket = FakeWebSocket(blocked=True)
+        websocket = FakeWebSocket()
+        with mock.patch.object(settings, 'event_slow_consumer_policy', 'disconnect'):
+            await self.connect(slow_websocket, epoch=self.event_manager.mailbox_epoch, version=0)
+            await self.connect(websocket, epoch=self.event_manager.mailbox_epoch, version=0)
+
+            await self.publish_deltas(5)
+
+        # It's closed with Try Again Later, keeping the closing task until
+        # it's done
+        self.assertEqual(len(self.event_manager.connections), 1)
+        self.assertEqual(len(self.event_manager.closing_tasks), 1)
+        slow_websocket.unblocked.set()
+        await self.drain()
+        self.assertEqual(slow_websocket.close_code, 1013)
+        self.assertEqual(self.event_manager.closing_tasks, set())
+
+        # The other client didn't miss anything, and the slow one can catch
+        # up from the change log when it reconnects
+        self.assertEqual(self.received(websocket), [('mailbox_delta', version) for version in range(1, 6)])
+        self.assertEqual(
+            [event['version'] for event in self.event_manager.get_changes_since(self.event_manager.mailbox_epoch, 1)],
+            [2, 3, 4, 5]
+        )
+
+    async def test_requested_snapshots_follow_pending_events(self):
+        websocket = FakeWebSocket(blocked=True)
+        await self.connect(websocket, epoch=self.event_manager.mailbox_epoch, version=0)
+        await self.publish_deltas(2)
+        self.event_manager.request_snapshot(websocket)
+        websocket.unblocked.set()
+        await self.drain()
+
+        self.assertEqual(self.received(websocket), [('mailbox_delta', 1), ('mailbox_delta', 2), ('mailbox', 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+from config import settings
+from library import SpeckFunction, SpeckLibrary
+from library import execution as execution_module
+from library.execution import EXECUTION_PROFILES, FunctionRun, block_resources, current_run, step
+
+
+class BlockResourcesTest(unittest.TestCase):
+    def test_blocks_the_profiles_resource_types_and_domains(self):
+        page = support.FakePage()
+        block_resources(page, EXECUTION_PROFILES['production'])
+
+        for url, resource_type, outcome in [
+            ('https://www.usps.com/', 'document', 'continued'),
+            ('https://www.usps.com/logo.png', 'image', 'aborted'),
+            ('https://www.usps.com/font.woff2', 'font', 'aborted'),
+            ('https://www.usps.com/app.js', 'script', 'continued'),
+            # Tracker domains and their subdomains, but not lookalikes
+            ('https://www.google-analytics.com/collect', 'xhr', 'aborted'),
+            ('https://googletagmanager.com/gtm.js', 'script', 'aborted'),
+            ('https://notdoubleclick.net/', 'script', 'continued'),
+        ]:
+            with self.subTest(url=url):
+                self.assertEqual(page.request(url, resource_type), outcome)
+
+    def test_doesnt_route_when_nothing_is_blocked(self):
+        page = support.FakePage()
+        block_resources(page, EXECUTION_PROFILES['demo'])
+        self.assertEqual(page.route_handlers, [])
+
+
+class StepTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = support.FakeClock()
+        self.clock.perf_counter = self.clock.time
+        patcher = mock.patch.object(execution_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.run = FunctionRun()
+        token = current_run.set(self.run)
+        self.addCleanup(current_run.reset, token)
+
+    def test_records_each_steps_timing(self):
+        with step('Log in'):
+            self.clock.advance(2)
+        with self.assertRaises(ValueError):
+            with step('Submit'):
+                self.clock.advance(0.5)
+                raise ValueError("Form rejected")
+
+        self.assertEqual([(timing.name, timing.duration) for timing in self.run.steps], [('Log in', 2), ('Submit', 0.5)])
+
+    def test_groups_steps_in_the_trace(self):
+        self.run.tracing = support.FakeTracing()
+        with step('Log in'):
+            pass
+        self.assertEqual(self.run.tracing.calls, [('group', 'Log in'), ('group_end',)])
+
+    def test_does_nothing_outside_a_function_run(self):
+        current_run.set(None)
+        with step('Log in'):
+            pass
+        self.assertEqual(self.run.steps, [])
+
+
+class ExecuteFunctionTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for name, value in [
+            ('browser_profiles_dir', os.path.join(directory.name, 'browser_profiles')),
+            ('function_traces_dir', os.path.join(directory.name, 'traces')),
+            ('function_execution_profile', 'production'),
+        ]:
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.clock = support.FakeClock()
+        self.clock.perf_counter = self.clock.time
+        patcher = mock.patch.object(execution_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.pages = []
+        def hold_mail(page, start_date: str):
+            """Hold the user's mail."""
+            self.pages.append(page)
+            with step('Log in'):
+                self.clock.advance(3)
+            if start_date == 'never':
+                raise ValueError("No such date")
+            return f"Holding mail from {start_date}"
+
+        self.library = SpeckLibrary(functions={'hold_mail': SpeckFunction(name='hold_mail', func=hold_mail, site='usps.com')})
+        self.playwright = support.FakePlaywright()
+        self.library._browser_pool._playwright = self.playwright
+        self.addCleanup(self.library._browser_pool.close)
+
+    def test_records_the_steps_and_trace_of_browser_functions(self):
+        result = self.library.execute_function('hold_mail', {'start_date': '2024-05-01'})
+
+        self.assertTrue(result.success)
+        self.assertEqual(result.success_message, "Holding mail from 2024-05-01")
+        self.assertEqual([(timing.name, timing.duration) for timing in result.steps], [('Launch browser', 0), ('Log in', 3)])
+
+        # The page is set up as the profile says, and the steps are grouped
+        # in the run's trace
+        self.assertEqual(self.pages[0].request('https://www.usps.com/logo.png', 'image'), 'aborted')
+        [context] = self.playwright.firefox.contexts
+        self.assertEqual(context.tracing.calls, [('start',), ('group', 'Log in'), ('group_end',), ('stop',)])
+        self.assertTrue(os.path.exists(result.trace_path))
+
+    def test_records_the_steps_of_failed_runs(self):
+        result = self.library.execute_function('hold_mail', {'start_date': 'never'}, profile=EXECUTION_PROFILES['demo'])
+
+        self.assertFalse(result.success)
+        self.assertEqual(result.error_message, "No such date")
+        self.assertEqual([timing.name for timing in result.steps], ['Launch browser', 'Log in'])
+        self.assertIsNone(result.trace_path)
+        self.assertEqual(self.pages[0].route_handlers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import base64
+from datetime import datetime, timedelta
+import json
+import unittest
+
+import support
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlmodel import Session, delete
+
+from config import db_engine
+from core.utils import create_database_tables
+from emails import routes
+from emails.models import Mailbox, Message
+
+
+class MailboxRoutesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_database_tables()
+
+        app = FastAPI()
+        app.include_router(routes.router)
+        cls.client = TestClient(app)
+
+    def setUp(self):
+        with Session(db_engine) as session:
+            session.exec(delete(Message))
+            session.exec(delete(Mailbox))
+            mailbox = Mailbox(email_address='me@example.com')
+            session.add(mailbox)
+            session.commit()
+
+            # Two messages received at the same time, which the cursor tells
+            # apart by id
+            received_at = datetime(2024, 5, 1, 12, 0)
+            for i, minutes in enumerate([0, 10, 10, 20, 30]):
+                session.add(Message(
+                    id=f'message-{i}',
+                    mailbox_id=mailbox.id,
+                    thread_id=f'thread-{i % 2}',
+                    from_='sender@example.com',
+                    subject=f'Message {i}',
+                    received_at=received_at + timedelta(minutes=minutes),
+                    body='Hello'
+                ))
+            session.commit()
+
+    def update_message(self, message_id):
+        with Session(db_engine) as session:
+            message = session.get(Message, message_id)
+            message.summary = 'Says hello'
+            session.add(message)
+            session.commit()
+
+    def list_messages(self, headers=None, **params):
+        return self.client.get('/mailbox/messages', params={'fields': 'id', **params}, headers=headers)
+
+    def test_pages_through_messages_newest_first(self):
+        message_ids = []
+        cursor = None
+        while True:
+            response = self.list_messages(limit=2, **({'cursor': cursor} if cursor else {}))
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            message_ids += [message['id'] for message in page['messages']]
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+
+        self.assertEqual(message_ids, ['message-4', 'message-3', 'message-2', 'message-1', 'message-0'])
+
+    def test_rejects_invalid_cursors(self):
+        encode = lambda value: base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+        for cursor in ('not a cursor', encode(5), encode(None), encode(['2024-05-01T12:00:00']), encode([1, 2])):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.list_messages(cursor=cursor).status_code, 400)
+
+    def test_unchanged_reads_are_not_modified(self):
+        response = self.list_messages()
+        etag = response.headers['ETag']
+
+        response = self.list_messages(headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # A different query has a different ETag
+        self.assertEqual(self.list_messages(limit=1, headers={'If-None-Match': etag}).status_code, 200)
+
+        # And so does every read once a message changes, whether or not its
+        # event has been published yet
+        self.update_message('message-3')
+        self.assertEqual(self.list_messages(headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_if_none_match_lists_and_wildcards(self):
+        etag = self.list_messages().headers['ETag']
+        strong_etag = etag.removeprefix('W/')
+
+        for header in (f'"other", {etag}', f'{strong_etag}', f'W/"other" ,{strong_etag}', '*'):
+            with self.subTest(header=header):
+                self.assertEqual(self.list_messages(headers={'If-None-Match': header}).status_code, 304)
+        self.assertEqual(self.list_messages(headers={'If-None-Match': '"other", W/"another"'}).status_code, 200)
+
+    def test_thread(self):
+        response = self.client.get('/threads/thread-0', params={'fields': 'id'})
+        self.assertEqual([message['id'] for message in response.json()['messages']], ['message-0', 'message-2', 'message-4'])
+
+        etag = response.headers['ETag']
+        response = self.client.get('/threads/thread-0', params={'fields': 'id'}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.update_message('message-2')
+        response = self.client.get('/threads/thread-0', params={'fields': 'id'}, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.client.get('/threads/missing').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
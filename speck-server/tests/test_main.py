@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+from click.testing import CliRunner
+
+import main
+from config import settings
+
+
+class CommandsTest(unittest.TestCase):
+    """The commands run without the setup under __main__, like from CliRunner."""
+    def setUp(self):
+        self.runner = CliRunner()
+
+    def test_benchmark_bodies(self):
+        with tempfile.TemporaryDirectory() as corpus_dir:
+            for name in ('message-1.html', 'message-2.html'):
+                with open(os.path.join(corpus_dir, name), 'w') as f:
+                    f.write('<p>Hello there</p>')
+            result = self.runner.invoke(main.cli, ['benchmark-bodies', corpus_dir, '--repeat', '1'])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('2 documents', result.output)
+        self.assertIn('html2text:', result.output)
+
+    def test_profile_startup_needs_an_interpreter(self):
+        with mock.patch.object(settings, 'packaged', True):
+            result = self.runner.invoke(main.cli, ['profile-startup'])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('needs a Python interpreter', result.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
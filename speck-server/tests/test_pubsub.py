@@ -0,0 +1,148 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+import support
+from core import pubsub
+from core.event_manager import EventManager
+from core.pubsub import BrokerTaskManager, EventBroker, EventSubscriber
+
+
+def sync_inbox():
+    pass
+
+
+class ThreadEventManager(threading.local):
+    """
+    Stands in for the event manager, forwarding to the one set on the
+    current thread, so each subscriber's reader thread feeds its own.
+    """
+    event_manager = None
+
+    def __getattr__(self, name):
+        return getattr(self.event_manager, name)
+
+
+class EventBrokerTest(unittest.TestCase):
+    def setUp(self):
+        # The broker tells the server processes where to find it through the
+        # environment, so keep it from leaking into other tests
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Each subscriber feeds an event manager on its own loop, like the
+        # server processes do
+        self.thread_event_manager = ThreadEventManager()
+        patcher = mock.patch.object(pubsub, 'event_manager', self.thread_event_manager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.version = 3
+        self.add_task = mock.Mock()
+        self.broker = EventBroker(add_task=self.add_task, epoch='epoch-1', get_version=lambda: self.version)
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+
+    def subscribe(self):
+        """Start a subscriber and the event manager it feeds. Returns both."""
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        self.addCleanup(loop.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(loop.call_soon_threadsafe, loop.stop)
+
+        event_manager = EventManager()
+        subscriber = EventSubscriber.from_environment()
+        self.addCleanup(subscriber.connection.close)
+
+        original_read = subscriber._read
+        def read():
+            self.thread_event_manager.event_manager = event_manager
+            original_read()
+        subscriber._read = read
+
+        subscriber.start(loop)
+        self.wait_for(lambda: event_manager.mailbox_epoch == 'epoch-1')
+        return subscriber, event_manager
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+
+    def drop_connections(self):
+        """
+        Drop the broker's connections, like when its process dies. Closing a
+        connection doesn't wake the threads reading it, shutting down its
+        socket does.
+        """
+        for connection in list(self.broker._subscribers):
+            with socket.socket(fileno=os.dup(connection.fileno())) as connection_socket:
+                connection_socket.shutdown(socket.SHUT_RDWR)
+
+    def publish_delta(self):
+        self.version += 1
+        self.broker.publish({'type': 'mailbox_delta', 'epoch': 'epoch-1', 'version': self.version, 'changes': []})
+
+    def test_fans_out_deltas_to_every_subscriber(self):
+        subscribers = [self.subscribe() for _ in range(2)]
+
+        # Each starts where the event stream was when it subscribed
+        for _, event_manager in subscribers:
+            self.assertEqual(event_manager.mailbox_version, 3)
+
+        self.publish_delta()
+        self.publish_delta()
+        for _, event_manager in subscribers:
+            self.wait_for(lambda: event_manager.mailbox_version == 5)
+            self.assertEqual([event['version'] for event in event_manager.change_log], [4, 5])
+
+    def test_subscribers_submit_tasks_through_the_broker(self):
+        subscriber, _ = self.subscribe()
+        BrokerTaskManager(subscriber).add_task(sync_inbox, timeout=600)
+
+        self.wait_for(lambda: self.add_task.called)
+        self.add_task.assert_called_once_with(sync_inbox, timeout=600)
+
+    def test_subscribers_reconnect_and_start_over_from_the_new_hello(self):
+        subscriber, event_manager = self.subscribe()
+        self.publish_delta()
+        self.wait_for(lambda: event_manager.mailbox_version == 4)
+
+        # The connection drops, and deltas published before the subscriber
+        # reconnects are lost to it
+        self.drop_connections()
+        self.wait_for(lambda: not self.broker._subscribers)
+        self.publish_delta()
+        self.wait_for(lambda: len(self.broker._subscribers) == 1)
+
+        # It resets to the version in the new hello, so its clients get a
+        # snapshot rather than miss delta 5, then follows the stream again
+        self.wait_for(lambda: event_manager.mailbox_version == 5)
+        self.assertEqual(list(event_manager.change_log), [])
+        self.publish_delta()
+        self.wait_for(lambda: event_manager.mailbox_version == 6)
+
+    def test_subscribers_stop_their_process_if_the_broker_is_gone(self):
+        subscriber, _ = self.subscribe()
+        with (
+            mock.patch.object(pubsub, 'RECONNECT_ATTEMPTS', 1),
+            mock.patch.object(pubsub.os, 'kill') as kill,
+        ):
+            self.drop_connections()
+            self.broker.stop()
+            self.wait_for(lambda: kill.called)
+
+        kill.assert_called_once_with(os.getpid(), pubsub.signal.SIGTERM)
+
+
+if __name__ == '__main__':
+    unittest.main()
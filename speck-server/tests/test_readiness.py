@@ -0,0 +1,93 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+from core import cache as cache_module
+from core import task_queue as task_queue_module
+from core.cache import SQLiteCache
+from core.cancellation import CancellationToken, TaskCancelled, current_token
+from core.readiness import get_resource_status, is_failed, preparing
+from core.task_queue import TaskQueue
+
+
+class PreparingTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        patcher = mock.patch.object(cache_module, 'cache', SQLiteCache(os.path.join(directory.name, 'cache.db')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.clock = support.FakeClock()
+        patcher = mock.patch.object(task_queue_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.queue = TaskQueue(os.path.join(directory.name, 'tasks.db'), visibility_timeout=60, max_attempts=2)
+        self.task_id = self.queue.put('core.tasks.install_browser', (), {})
+
+    def claim(self):
+        """Claim the task preparing the browser, once its backoff has passed, and set its token."""
+        self.clock.advance(1000)
+        claimed_task, = self.queue.claim('worker-1')
+        token = CancellationToken(claimed_task.id, final_attempt=claimed_task.attempts >= claimed_task.max_attempts)
+        self.addCleanup(current_token.reset, current_token.set(token))
+        return claimed_task
+
+    def prepare(self, error=None):
+        """Run an attempt at the task preparing the browser, which raises error if given."""
+        claimed_task = self.claim()
+        try:
+            with preparing('browser'):
+                if error is not None:
+                    raise error
+        except BaseException as e:
+            self.queue.fail(claimed_task.id, str(e))
+        else:
+            self.queue.complete(claimed_task.id)
+
+    def test_stays_preparing_while_the_task_is_retried(self):
+        self.prepare(RuntimeError('Network is unreachable'))
+        status = get_resource_status('browser')
+        self.assertEqual(status['status'], 'preparing')
+        self.assertEqual(status['error'], 'RuntimeError: Network is unreachable')
+        self.assertFalse(is_failed('browser', self.queue))
+
+        self.prepare()
+        self.assertEqual(get_resource_status('browser')['status'], 'ready')
+
+    def test_fails_on_the_last_attempt(self):
+        self.prepare(RuntimeError('Network is unreachable'))
+        self.prepare(RuntimeError('Network is unreachable'))
+
+        self.assertEqual(get_resource_status('browser')['status'], 'failed')
+        self.assertTrue(is_failed('browser', self.queue))
+
+    def test_cancelled_tasks_fail_right_away(self):
+        with mock.patch.object(CancellationToken, 'cancelled', True):
+            self.prepare(TaskCancelled('Cancelled'))
+        self.assertEqual(get_resource_status('browser')['status'], 'failed')
+
+    def test_fails_once_its_task_stops_without_finishing(self):
+        self.prepare(RuntimeError('Network is unreachable'))
+
+        # The worker running the last attempt dies while preparing it, so
+        # the block doesn't exit until the test is over
+        self.claim()
+        last_attempt = preparing('browser')
+        last_attempt.__enter__()
+        self.addCleanup(last_attempt.__exit__, None, None, None)
+        self.assertFalse(is_failed('browser', self.queue))
+
+        # Its task is dead-lettered once its lease runs out
+        self.clock.advance(60)
+        self.queue.claim('worker-2')
+        self.assertTrue(is_failed('browser', self.queue))
+        self.assertEqual(get_resource_status('browser')['status'], 'failed')
+
+
+if __name__ == '__main__':
+    unittest.main()
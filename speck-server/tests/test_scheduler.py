@@ -0,0 +1,157 @@
+from datetime import datetime
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import support
+from config import RecurringTask, settings
+from core import cache as cache_module
+from core.cache import SQLiteCache
+from core.scheduler import CronSchedule, ScheduledTask, Scheduler
+from core.task_queue import TaskQueue
+from emails import sync
+
+
+# Tasks and interval policies for the scheduler to resolve by dotted path
+def recurring_task():
+    pass
+
+def every_ten_seconds():
+    return 10, 'testing'
+
+def failing_policy():
+    raise RuntimeError('no interval')
+
+
+class CronScheduleTest(unittest.TestCase):
+    def test_steps(self):
+        cron = CronSchedule('*/15 * * * *')
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 1, 10, 7, 30)), datetime(2024, 5, 1, 10, 15))
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 1, 10, 45)), datetime(2024, 5, 1, 11, 0))
+
+    def test_skips_to_matching_days(self):
+        # 9am on weekdays, from a Friday afternoon
+        cron = CronSchedule('0 9 * * 1-5')
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 3, 14, 0)), datetime(2024, 5, 6, 9, 0))
+
+        # Across the end of a year
+        cron = CronSchedule('30 6 1 1 *')
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 3)), datetime(2025, 1, 1, 6, 30))
+
+    def test_either_day_field_matches_when_both_are_restricted(self):
+        # The 13th, or any Friday, like cron
+        cron = CronSchedule('0 0 13 * 5')
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 1)), datetime(2024, 5, 3))
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 10, 1)), datetime(2024, 5, 13))
+
+    def test_seven_is_sunday(self):
+        cron = CronSchedule('0 12 * * 7')
+        self.assertEqual(cron.get_next_run(datetime(2024, 5, 1)), datetime(2024, 5, 5, 12, 0))
+
+    def test_invalid_expressions(self):
+        for expression in ('* * * *', '60 * * * *', '* 5-2 * * *', '0 0 31 2 *'):
+            with self.subTest(expression=expression), self.assertRaises(ValueError):
+                CronSchedule(expression).get_next_run(datetime(2024, 5, 1))
+
+
+class ScheduledTaskTest(unittest.TestCase):
+    def scheduled_task(self, **kwargs):
+        return ScheduledTask(RecurringTask(task=f'{__name__}.recurring_task', **kwargs))
+
+    def test_fixed_interval(self):
+        scheduled_task = self.scheduled_task(interval=60)
+        self.assertEqual(scheduled_task.update_interval(), 60)
+        self.assertEqual(scheduled_task.reason, 'fixed interval')
+
+    def test_cron(self):
+        scheduled_task = self.scheduled_task(cron='* * * * *')
+        self.assertTrue(0 < scheduled_task.update_interval() <= 60)
+
+    def test_interval_policy(self):
+        scheduled_task = self.scheduled_task(interval=60, interval_policy=f'{__name__}.every_ten_seconds')
+        self.assertEqual((scheduled_task.update_interval(), scheduled_task.reason), (10, 'testing'))
+
+    def test_failing_interval_policy_falls_back_to_the_interval(self):
+        scheduled_task = self.scheduled_task(interval=60, interval_policy=f'{__name__}.failing_policy')
+        with self.assertLogs('core.scheduler', 'ERROR'):
+            self.assertEqual((scheduled_task.update_interval(), scheduled_task.reason), (60, 'interval policy failed'))
+
+    def test_needs_a_schedule(self):
+        with self.assertRaises(ValueError):
+            self.scheduled_task()
+
+
+class SyncIntervalPolicyTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        patcher = mock.patch.object(cache_module, 'cache', SQLiteCache(os.path.join(directory.name, 'cache.db')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_backs_off_while_syncs_find_nothing(self):
+        self.assertEqual(sync.get_sync_interval(), (settings.sync_interval, "the inbox hasn't synced yet"))
+
+        intervals = []
+        for _ in range(6):
+            sync.record_sync_result(changed_thread_count=0, history_id_moved=False)
+            intervals.append(sync.get_sync_interval()[0])
+        self.assertEqual(intervals, [
+            min(settings.sync_interval * 2 ** quiet_syncs, settings.sync_interval_max) for quiet_syncs in range(1, 7)
+        ])
+
+        # Any change starts over
+        sync.record_sync_result(changed_thread_count=0, history_id_moved=True)
+        self.assertEqual(sync.get_sync_interval(), (settings.sync_interval, 'the last sync found changes'))
+
+    def test_syncs_often_while_the_user_is_active(self):
+        sync.record_sync_result(changed_thread_count=0, history_id_moved=False)
+        sync.record_user_activity()
+        self.assertEqual(sync.get_sync_interval(), (settings.sync_interval_active, 'the user is active'))
+
+    def test_syncs_often_while_the_extension_is_connected(self):
+        sync.record_client_connected()
+        sync.record_client_connected()
+        sync.record_client_disconnected()
+        self.assertEqual(sync.get_sync_interval(), (settings.sync_interval_active, 'the extension is connected'))
+
+        # Disconnecting more often than connecting doesn't go below none
+        for _ in range(3):
+            sync.record_client_disconnected()
+        self.assertEqual(sync.get_sync_status()['connected_clients'], 0)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.queue = TaskQueue(os.path.join(directory.name, 'tasks.db'))
+
+    def test_queues_due_tasks_and_skips_them_while_they_run(self):
+        scheduler = Scheduler(
+            self.queue,
+            [RecurringTask(task=f'{__name__}.recurring_task', interval=0.05)],
+            initial_delay=0
+        )
+        scheduler.start()
+        self.addCleanup(scheduler.stop)
+
+        # The first run is still queued, so later ones are skipped
+        time.sleep(0.3)
+        claimed_tasks = self.queue.claim('worker-1', limit=10)
+        self.assertEqual([claimed_task.name for claimed_task in claimed_tasks], [f'{__name__}.recurring_task'])
+
+        # Once it finishes, the next run is queued
+        self.queue.complete(claimed_tasks[0].id)
+        time.sleep(0.3)
+        self.assertEqual(len(self.queue.claim('worker-1', limit=10)), 1)
+
+        scheduled_task, = scheduler.scheduled_tasks
+        self.assertEqual((scheduled_task.interval, scheduled_task.reason), (0.05, 'fixed interval'))
+
+
+if __name__ == '__main__':
+    unittest.main()
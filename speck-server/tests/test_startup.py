@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import support
+from main import measure_import_time
+
+# Importing the API server and the worker tasks is on the critical path of
+# starting the app and every worker, so these heavy packages are imported
+# lazily, where they're used. Importing one at module level fails this.
+DEFERRED_PACKAGES = ['playwright', 'fireworks', 'googleapiclient']
+STARTUP_MODULES = ['server', 'emails.tasks']
+
+# Seconds importing each module may take in a fresh interpreter, about 1.5x
+# what they take on a development machine. Timings depend on the machine, so
+# by default they're scaled up by 3, which only catches something like a
+# heavy package imported at startup. Set SPECK_IMPORT_BUDGET_SCALE to 1 for
+# the tight budgets, or higher on slow machines.
+IMPORT_BUDGETS = {
+    'server': 1.25,
+    'emails.tasks': 0.75,
+}
+BUDGET_SCALE = float(os.environ.get('SPECK_IMPORT_BUDGET_SCALE', 3))
+
+REPEAT = 3
+
+
+def _run_in_fresh_interpreter(code, data_dir):
+    # Keep the imports from creating a data directory for the user
+    return subprocess.run(
+        [sys.executable, '-c', code],
+        capture_output=True,
+        text=True,
+        cwd=support.SPECK_DIR,
+        env=dict(os.environ, APP_DATA_DIR=data_dir)
+    )
+
+
+class StartupImportsTest(unittest.TestCase):
+    def test_heavy_packages_are_not_imported_at_startup(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            for module in STARTUP_MODULES:
+                with self.subTest(module=module):
+                    result = _run_in_fresh_interpreter(
+                        f"import sys; import {module}\n"
+                        f"imported = [package for package in {DEFERRED_PACKAGES!r} if package in sys.modules]\n"
+                        f"assert not imported, f'importing {module} imported {{imported}}'",
+                        data_dir
+                    )
+                    self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+
+
+class ImportTimeTest(unittest.TestCase):
+    def test_imports_within_budget(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            # Keep the imports from creating a data directory for the user
+            env = dict(os.environ, APP_DATA_DIR=data_dir)
+
+            for module, budget in IMPORT_BUDGETS.items():
+                budget *= BUDGET_SCALE
+                with self.subTest(module=module):
+                    # The fastest of a few, since the first warms the disk cache
+                    total, imports = min(
+                        (measure_import_time(module, env=env) for _ in range(REPEAT)),
+                        key=lambda measurement: measurement[0]
+                    )
+                    slowest = ', '.join(
+                        f"{name.strip()} {self_us / 1e6:.3f}s"
+                        for self_us, _, name in sorted(imports, reverse=True)[:5]
+                    )
+                    self.assertLessEqual(
+                        total,
+                        budget,
+                        f"Importing {module} took {total:.3f}s, over its {budget:.3f}s budget. "
+                        f"The slowest modules were {slowest}. Run `python main.py profile-startup` for more."
+                    )
+
+
+if __name__ == '__main__':
+    unittest.main()
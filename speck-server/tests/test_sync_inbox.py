@@ -0,0 +1,155 @@
+import base64
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+from sqlmodel import Session, delete, select
+
+from config import db_engine
+from core import cache as cache_module
+from core.cache import SQLiteCache
+from core.utils import create_database_tables
+from emails import models, sync, tasks
+from emails.models import Mailbox, Message
+from profiles.models import Profile
+
+
+RAW_MESSAGE = (
+    'From: sender@example.com\r\n'
+    'To: me@example.com\r\n'
+    'Subject: Hello\r\n'
+    'Date: Wed, 01 May 2024 12:00:00 +0000\r\n'
+    'MIME-Version: 1.0\r\n'
+    'Content-Type: text/html\r\n'
+    '\r\n'
+    '<p>Hello there</p>\r\n'
+).encode()
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeGmailClient:
+    """
+    Stands in for the Gmail API client, serving a fixed mailbox. Messages are
+    (id, thread_id, history_id, label_ids) tuples.
+    """
+    def __init__(self, messages, page_size=2):
+        self.mailbox = {message[0]: message for message in messages}
+        self.page_size = page_size
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, labelIds=None, maxResults=None, pageToken=None):
+        message_ids = [
+            message_id for message_id, _, _, label_ids in self.mailbox.values()
+            if not labelIds or set(labelIds) <= set(label_ids)
+        ]
+        start = int(pageToken or 0)
+        response = {'messages': [{'id': message_id} for message_id in message_ids[start:start + self.page_size]]}
+        if start + self.page_size < len(message_ids):
+            response['nextPageToken'] = str(start + self.page_size)
+        return FakeRequest(response)
+
+    def get(self, userId, id, format, fields, metadataHeaders=None):
+        message_id, thread_id, history_id, label_ids = self.mailbox[id]
+        response = {'id': message_id, 'threadId': thread_id, 'historyId': str(history_id), 'labelIds': label_ids}
+        if format == 'raw':
+            response['raw'] = base64.urlsafe_b64encode(RAW_MESSAGE).decode()
+        else:
+            response['snippet'] = 'Hello there'
+            response['payload'] = {'headers': [
+                {'name': 'From', 'value': 'sender@example.com'},
+                {'name': 'Subject', 'value': 'Hello'},
+                {'name': 'Date', 'value': 'Wed, 01 May 2024 12:00:00 +0000'},
+            ]}
+        return FakeRequest(response)
+
+
+class SyncInboxTaskTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        create_database_tables()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        patcher = mock.patch.object(cache_module, 'cache', SQLiteCache(os.path.join(directory.name, 'cache.db')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Scheduled tasks aren't run
+        patcher = mock.patch.object(models, 'task_manager')
+        self.task_manager = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with Session(db_engine) as session:
+            session.exec(delete(Profile))
+            session.exec(delete(Message))
+            session.exec(delete(Mailbox))
+            mailbox = Mailbox(email_address='me@example.com')
+            session.add(mailbox)
+            session.commit()
+            session.add(Profile(mailbox_id=mailbox.id))
+            session.commit()
+
+    def sync_inbox(self, client):
+        with mock.patch.object(models, 'get_gmail_api_client', return_value=client):
+            return tasks.sync_inbox()
+
+    def test_syncs_and_records_the_result(self):
+        client = FakeGmailClient([
+            ('inbox-1', 'thread-1', 10, ['INBOX']),
+            ('archived-1', 'thread-2', 11, []),
+            ('archived-2', 'thread-3', 9, []),
+        ])
+
+        changed_thread_ids = self.sync_inbox(client)
+
+        self.assertEqual(set(changed_thread_ids), {'thread-1', 'thread-2', 'thread-3'})
+        with Session(db_engine) as session:
+            self.assertEqual(session.exec(select(Mailbox)).one().last_history_id, 11)
+            fetch_depths = {message.id: message.fetch_depth for message in session.exec(select(Message))}
+        self.assertEqual(fetch_depths, {'inbox-1': 'raw', 'archived-1': 'metadata', 'archived-2': 'metadata'})
+        self.assertEqual(sync.get_sync_status()['quiet_syncs'], 0)
+
+        # A sync which finds nothing new counts towards backing off
+        self.assertEqual(self.sync_inbox(client), [])
+        self.assertEqual(sync.get_sync_status()['quiet_syncs'], 1)
+        self.assertEqual(sync.get_sync_interval()[1], 'the last 1 syncs found no changes')
+
+    def test_leaves_the_callers_session_open(self):
+        client = FakeGmailClient([('inbox-1', 'thread-1', 10, ['INBOX'])])
+
+        with Session(db_engine) as session:
+            mailbox = session.exec(select(Mailbox)).one()
+            with mock.patch.object(models, 'get_gmail_api_client', return_value=client):
+                mailbox.sync_inbox(session=session)
+
+            self.assertIn(mailbox, session)
+            self.assertEqual(mailbox.last_history_id, 10)
+
+    def test_does_nothing_without_a_mailbox(self):
+        with Session(db_engine) as session:
+            session.exec(delete(Profile))
+            session.exec(delete(Mailbox))
+            session.commit()
+
+        self.assertIsNone(self.sync_inbox(FakeGmailClient([])))
+        self.assertEqual(sync.get_sync_status()['quiet_syncs'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,349 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import support
+from config import settings
+from core import cache as cache_module
+from core import task_manager as task_manager_module
+from core import task_queue as task_queue_module
+from core.cache import SQLiteCache
+from core.readiness import set_resource_status
+from core.task_manager import TaskManager, WorkerProcess, run_tasks
+from core.task_queue import TaskQueue, get_task_name
+
+# Lets the tests hold the worker's only sync thread
+sync_thread_held = threading.Event()
+release_sync_thread = threading.Event()
+
+
+def hold_sync_thread():
+    sync_thread_held.set()
+    release_sync_thread.wait(5)
+    return 'held'
+
+
+def sync_task(value):
+    return value
+
+
+async def async_task(value):
+    await asyncio.sleep(0.01)
+    return value
+
+
+class FakeProcess:
+    """Stands in for a worker's multiprocessing.Process."""
+    def __init__(self, pid):
+        self.name = 'Process'
+        self.pid = pid
+        self.exitcode = None
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def kill(self):
+        self.alive = False
+        self.exitcode = -9
+
+    def join(self):
+        pass
+
+
+class AutoscaleTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        patcher = mock.patch.object(cache_module, 'cache', SQLiteCache(os.path.join(directory.name, 'cache.db')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.clock = support.FakeClock()
+        for module in (task_queue_module, task_manager_module):
+            patcher = mock.patch.object(module, 'time', self.clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # The autoscaler times idleness with monotonic()
+        self.clock.monotonic = self.clock.time
+
+        # Plenty of memory, unless a test says otherwise
+        patcher = mock.patch.object(task_manager_module, 'psutil')
+        self.psutil = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.psutil.virtual_memory.return_value.available = 8 * 1024 * 1024 * 1024
+        self.psutil.cpu_count.return_value = 4
+
+        self.queue = TaskQueue(os.path.join(directory.name, 'tasks.db'))
+        self.task_manager = TaskManager(None, None, task_queue=self.queue)
+        self.task_manager.min_workers = 1
+        self.task_manager.max_workers = 4
+
+        # Workers are fake processes, which the tests claim tasks for
+        self.pids = iter(range(1000, 2000))
+        patcher = mock.patch.object(self.task_manager, '_start_worker', side_effect=self.start_worker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.start_worker()
+
+    def start_worker(self):
+        worker = WorkerProcess(FakeProcess(next(self.pids)), threading.Event())
+        self.task_manager.workers.append(worker)
+        return worker
+
+    def active_workers(self):
+        return [worker for worker in self.task_manager.workers if not worker.retiring]
+
+    def test_tasks_waiting_for_a_resource_dont_scale_up(self):
+        preparing_id = self.queue.put('core.tasks.download_model', kwargs={'model_type': 'embedding'})
+        set_resource_status('embedding_model', 'preparing', task_id=preparing_id)
+
+        # The first worker claims a backlog of embedding tasks, and puts
+        # them back to wait for the model
+        worker_name = self.task_manager.workers[0].name
+        task_ids = [self.queue.put('emails.tasks.generate_embedding_for_message', (i,)) for i in range(100)]
+        self.queue.claim(worker_name)
+        for claimed_task in self.queue.claim(worker_name, limit=100):
+            self.queue.wait_for_resource(claimed_task.id, 'embedding_model')
+
+        for _ in range(5):
+            self.clock.advance(60)
+            self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 1)
+
+        # Once it's ready, they're released and the pool grows to run them
+        self.queue.complete(preparing_id)
+        set_resource_status('embedding_model', 'ready', task_id=preparing_id)
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 2)
+        self.assertEqual(self.queue.get_wait_times()['emails.tasks.generate_embedding_for_message'][1], len(task_ids))
+
+    def test_tasks_waiting_for_a_resource_whose_task_died_are_released(self):
+        preparing_id = self.queue.put('core.tasks.install_browser')
+        set_resource_status('browser', 'preparing', task_id=preparing_id)
+        task_id = self.queue.put('emails.tasks.execute_function_for_message', ('thread-1', 'usps_hold_mail'))
+        self.queue.claim('worker-1', limit=2)
+        self.queue.wait_for_resource(task_id, 'browser')
+
+        # Its task is gone without marking the resource ready or failed
+        self.queue.cancel(preparing_id)
+        self.queue.mark_cancelled(preparing_id)
+        self.task_manager._autoscale_once()
+
+        self.assertEqual(self.queue.get_waiting_resources(), set())
+        self.assertIn('emails.tasks.execute_function_for_message', self.queue.get_wait_times())
+
+
+    def test_scales_up_for_a_backlog(self):
+        for i in range(5):
+            self.queue.put('emails.tasks.process_inbox_message', (f'message-{i}',))
+
+        # More than one worker claims at once
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 2)
+
+        # Two can claim them all at once, until they've waited too long
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 2)
+        self.clock.advance(10)
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 3)
+
+        # But no further than the maximum
+        for _ in range(3):
+            self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 4)
+
+    def test_doesnt_scale_up_when_memory_is_low(self):
+        self.psutil.virtual_memory.return_value.available = 512 * 1024 * 1024
+        for i in range(20):
+            self.queue.put('emails.tasks.process_inbox_message', (f'message-{i}',))
+
+        self.clock.advance(60)
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 1)
+
+        # It does once there's room again
+        self.psutil.virtual_memory.return_value.available = 8 * 1024 * 1024 * 1024
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 2)
+
+    def test_retires_idle_workers_after_the_idle_timeout(self):
+        self.start_worker()
+        self.start_worker()
+        workers = list(self.task_manager.workers)
+
+        # The last worker is busy with a task, and the queue's empty
+        self.queue.put('emails.tasks.process_inbox_message', ('message-1',))
+        self.queue.claim(workers[2].name)
+
+        self.task_manager._autoscale_once()
+        self.clock.advance(30)
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 3)
+
+        # One idle worker is retired per idle timeout, leaving the busy one
+        self.clock.advance(31)
+        self.task_manager._autoscale_once()
+        self.assertEqual([worker.retiring for worker in workers], [False, True, False])
+        self.task_manager._autoscale_once()
+        self.assertEqual(len(self.active_workers()), 2)
+
+        # And never below the minimum
+        for _ in range(3):
+            self.clock.advance(61)
+            self.task_manager._autoscale_once()
+        self.assertEqual([worker.retiring for worker in workers], [True, True, False])
+
+    def test_replaces_workers_which_died(self):
+        worker = self.task_manager.workers[0]
+        worker.process.kill()
+
+        self.task_manager._autoscale_once()
+        self.assertNotIn(worker, self.task_manager.workers)
+        self.assertEqual(len(self.active_workers()), 1)
+
+
+    def claim_and_start(self, timeout, max_attempts=3):
+        """Have the worker claim a task with a timeout, and another task, and start the first."""
+        worker = self.task_manager.workers[0]
+        task_id = self.queue.put('emails.tasks.sync_inbox', timeout=timeout, max_attempts=max_attempts)
+        other_id = self.queue.put('emails.tasks.process_inbox_message', ('message-1',))
+        self.queue.claim(worker.name, limit=2)
+        self.queue.start(task_id)
+        return worker, task_id, other_id
+
+    def test_kills_workers_whose_task_overran_its_timeout(self):
+        worker, task_id, other_id = self.claim_and_start(timeout=30)
+
+        # It's given the grace period to stop by itself
+        self.clock.advance(30 + settings.task_cancel_grace_period)
+        self.task_manager._autoscale_once()
+        self.assertTrue(worker.process.is_alive())
+
+        self.clock.advance(1)
+        self.task_manager._autoscale_once()
+        self.assertFalse(worker.process.is_alive())
+        self.assertNotIn(worker, self.task_manager.workers)
+        self.assertGreaterEqual(len(self.active_workers()), 1)
+
+        # The task is retried, and the worker's other task goes back in the
+        # queue without using up an attempt
+        task = self.queue.get_task(task_id)
+        self.assertEqual((task['status'], task['attempts']), ('queued', 1))
+        self.assertIn('Timed out', task['error'])
+        other_task = self.queue.get_task(other_id)
+        self.assertEqual((other_task['status'], other_task['attempts'], other_task['worker']), ('queued', 0, None))
+
+    def test_dead_letters_tasks_which_overran_their_last_attempt(self):
+        worker, task_id, other_id = self.claim_and_start(timeout=30, max_attempts=1)
+
+        self.clock.advance(31 + settings.task_cancel_grace_period)
+        self.task_manager._autoscale_once()
+
+        self.assertFalse(worker.process.is_alive())
+        self.assertEqual(self.queue.get_task(task_id)['status'], 'dead')
+        self.assertEqual(self.queue.get_task(other_id)['status'], 'queued')
+
+    def test_kills_workers_whose_task_ignored_being_cancelled(self):
+        worker, task_id, other_id = self.claim_and_start(timeout=None)
+        self.assertEqual(self.queue.cancel(task_id), 'cancelling')
+
+        self.clock.advance(settings.task_cancel_grace_period + 1)
+        self.task_manager._autoscale_once()
+
+        self.assertFalse(worker.process.is_alive())
+        self.assertEqual(self.queue.get_task(task_id)['status'], 'cancelled')
+        self.assertEqual(self.queue.get_task(other_id)['status'], 'queued')
+
+class RunTasksTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = SQLiteCache(os.path.join(directory.name, 'cache.db'))
+        self.queue = TaskQueue(os.path.join(directory.name, 'tasks.db'))
+
+        patcher = mock.patch.object(settings, 'worker_sync_threads', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        sync_thread_held.clear()
+        release_sync_thread.clear()
+        self.addCleanup(release_sync_thread.set)
+
+        self.sync_executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(self.sync_executor.shutdown)
+        self.result_queue = queue.Queue()
+        self.retire_event = threading.Event()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.01)
+
+    def start_worker(self):
+        """Run a worker on its own thread until the test retires it."""
+        thread = threading.Thread(target=asyncio.run, args=(run_tasks(
+            self.queue, 'worker-1', threading.Event(), self.retire_event,
+            self.cache, self.sync_executor, self.result_queue, logging.getLogger(__name__)
+        ),))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.retire_event.set)
+        return thread
+
+    def get_status(self, task_id):
+        return self.queue.get_task(task_id)['status']
+
+    def get_results(self):
+        results = []
+        while not self.result_queue.empty():
+            _, (_, result) = self.result_queue.get()
+            results.append(result)
+        return sorted(results)
+
+    def test_runs_async_tasks_while_sync_tasks_wait_for_a_thread(self):
+        held_id = self.queue.put(get_task_name(hold_sync_thread))
+        sync_ids = [self.queue.put(get_task_name(sync_task), (f'sync-{i}',)) for i in range(2)]
+        async_ids = [self.queue.put(get_task_name(async_task), (f'async-{i}',)) for i in range(3)]
+        self.start_worker()
+
+        # With its sync thread held, the async tasks still run, and the
+        # sync tasks stay in the queue for workers with a free thread
+        self.assertTrue(sync_thread_held.wait(5))
+        self.wait_for(lambda: all(self.get_status(task_id) == 'finished' for task_id in async_ids))
+        self.assertEqual([self.get_status(task_id) for task_id in sync_ids], ['queued', 'queued'])
+        self.assertEqual(self.get_status(held_id), 'running')
+
+        # Then the sync tasks run one at a time on the freed thread
+        release_sync_thread.set()
+        self.wait_for(lambda: all(self.get_status(task_id) == 'finished' for task_id in [held_id] + sync_ids))
+        self.assertEqual(self.get_results(), ['async-0', 'async-1', 'async-2', 'held', 'sync-0', 'sync-1'])
+
+    def test_retired_workers_finish_their_running_tasks(self):
+        held_id = self.queue.put(get_task_name(hold_sync_thread))
+        thread = self.start_worker()
+        self.assertTrue(sync_thread_held.wait(5))
+
+        # It doesn't claim anything new once it's retiring
+        self.retire_event.set()
+        queued_id = self.queue.put(get_task_name(async_task), ('async',))
+        release_sync_thread.set()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.get_status(held_id), 'finished')
+        self.assertEqual(self.get_status(queued_id), 'queued')
+
+if __name__ == '__main__':
+    unittest.main()
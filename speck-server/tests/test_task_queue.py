@@ -0,0 +1,211 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import support
+from core import task_queue as task_queue_module
+from core.task_queue import TaskQueue
+
+
+class TaskQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.clock = support.FakeClock()
+        patcher = mock.patch.object(task_queue_module, 'time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.queue = TaskQueue(
+            os.path.join(directory.name, 'tasks.db'),
+            visibility_timeout=60,
+            max_attempts=3,
+            retry_backoff=5,
+            max_retry_backoff=300
+        )
+
+    def claim_ids(self, worker='worker-1', **kwargs):
+        return [claimed_task.id for claimed_task in self.queue.claim(worker, **kwargs)]
+
+    def test_put_deduplicates_queued_tasks_if_asked(self):
+        task_id = self.queue.put('tasks.sync', (1,), {'full': True}, dedupe=True)
+        self.assertEqual(self.queue.put('tasks.sync', (1,), {'full': True}, dedupe=True), task_id)
+        self.assertNotEqual(self.queue.put('tasks.sync', (2,), {'full': True}, dedupe=True), task_id)
+
+        # Once it's running, the same task can be queued again
+        self.claim_ids(limit=2)
+        self.assertNotEqual(self.queue.put('tasks.sync', (1,), {'full': True}, dedupe=True), task_id)
+
+    def test_put_queues_duplicates_with_their_own_limits(self):
+        task_id = self.queue.put('tasks.sync', (1,))
+        duplicate_id = self.queue.put('tasks.sync', (1,), max_attempts=1, timeout=10)
+
+        self.assertNotEqual(duplicate_id, task_id)
+        claimed_tasks = {claimed_task.id: claimed_task for claimed_task in self.queue.claim('worker-1', limit=2)}
+        self.assertEqual((claimed_tasks[task_id].max_attempts, claimed_tasks[task_id].timeout), (3, None))
+        self.assertEqual((claimed_tasks[duplicate_id].max_attempts, claimed_tasks[duplicate_id].timeout), (1, 10))
+
+    def test_claim_leases_tasks_until_they_run_out(self):
+        task_id = self.queue.put('tasks.sync')
+
+        claimed_tasks = self.queue.claim('worker-1')
+        self.assertEqual([(claimed_task.id, claimed_task.attempts) for claimed_task in claimed_tasks], [(task_id, 1)])
+        self.assertEqual(self.claim_ids('worker-2'), [])
+
+        # Heartbeats keep the lease
+        self.clock.advance(50)
+        self.queue.extend_leases('worker-1')
+        self.clock.advance(50)
+        self.assertEqual(self.claim_ids('worker-2'), [])
+
+        # Once it runs out, as when the worker died, another worker gets it
+        self.clock.advance(11)
+        claimed_tasks = self.queue.claim('worker-2')
+        self.assertEqual([(claimed_task.id, claimed_task.attempts) for claimed_task in claimed_tasks], [(task_id, 2)])
+        self.assertEqual(self.queue.get_task(task_id)['worker'], 'worker-2')
+
+    def test_failed_tasks_retry_with_exponential_backoff(self):
+        task_id = self.queue.put('tasks.sync')
+
+        # 5s with up to 20% jitter after the first failure, then 10s
+        for backoff in (5, 10):
+            self.claim_ids()
+            self.queue.fail(task_id, 'ValueError: nope')
+            self.assertEqual(self.queue.get_task(task_id)['status'], 'queued')
+
+            self.clock.advance(backoff * 0.8 - 0.1)
+            self.assertEqual(self.claim_ids(), [])
+            self.clock.advance(backoff * 0.4 + 0.2)
+            self.assertEqual(self.claim_ids(), [task_id])
+
+            # Put it back without using up the attempt, for the next failure
+            self.queue.release([task_id])
+
+    def test_tasks_are_dead_lettered_after_max_attempts(self):
+        task_id = self.queue.put('tasks.sync')
+        for _ in range(2):
+            self.clock.advance(300)
+            self.assertEqual(self.claim_ids(), [task_id])
+            self.queue.fail(task_id, 'ValueError: nope')
+
+        self.clock.advance(300)
+        self.assertEqual(self.claim_ids(), [task_id])
+        with self.assertLogs('core.task_queue', 'ERROR'):
+            self.queue.fail(task_id, 'ValueError: nope')
+
+        task = self.queue.get_task(task_id)
+        self.assertEqual((task['status'], task['attempts'], task['error']), ('dead', 3, 'ValueError: nope'))
+        self.clock.advance(300)
+        self.assertEqual(self.claim_ids(), [])
+
+    def test_lost_lease_on_the_last_attempt_dead_letters(self):
+        task_id = self.queue.put('tasks.sync', max_attempts=1)
+        self.claim_ids()
+
+        self.clock.advance(61)
+        self.assertEqual(self.claim_ids('worker-2'), [])
+        task = self.queue.get_task(task_id)
+        self.assertEqual((task['status'], task['error']), ('dead', 'Worker died while running the task'))
+
+    def test_defer_and_release_keep_the_attempt(self):
+        deferred_id = self.queue.put('tasks.needs_model')
+        released_id = self.queue.put('tasks.sync')
+        self.claim_ids(limit=2)
+
+        self.queue.defer(deferred_id, 30)
+        self.queue.release([released_id])
+        self.assertEqual(self.queue.get_task(deferred_id)['attempts'], 0)
+        self.assertEqual(self.queue.get_task(released_id)['attempts'], 0)
+
+        # Released tasks can be claimed again right away, deferred ones
+        # after the delay
+        self.assertEqual(self.claim_ids(limit=2), [released_id])
+        self.clock.advance(31)
+        self.assertEqual(self.claim_ids(limit=2), [deferred_id])
+
+    def test_tasks_waiting_for_a_resource_are_held_until_released(self):
+        waiting_ids = [self.queue.put('tasks.needs_model', (i,)) for i in range(3)]
+        other_id = self.queue.put('tasks.sync')
+        self.claim_ids(limit=3)
+        for task_id in waiting_ids:
+            self.queue.wait_for_resource(task_id, 'embedding_model')
+        self.assertEqual(self.queue.get_task(waiting_ids[0])['attempts'], 0)
+
+        # They can't be claimed, and don't count as waiting to be
+        self.clock.advance(3600)
+        self.assertEqual(self.claim_ids(limit=10), [other_id])
+        self.assertEqual(self.queue.get_wait_times(), {})
+        self.assertEqual(self.queue.get_waiting_resources(), {'embedding_model'})
+        self.assertTrue(self.queue.is_pending(waiting_ids[0]))
+
+        self.queue.release_waiting('completion_model')
+        self.assertEqual(self.claim_ids(limit=10), [])
+
+        # Released, they wait to be claimed from now
+        self.queue.release_waiting('embedding_model')
+        self.assertEqual(self.queue.get_wait_times(), {'tasks.needs_model': (0, 3)})
+        self.assertEqual(self.claim_ids(limit=10), waiting_ids)
+        self.assertEqual(self.queue.get_waiting_resources(), set())
+
+    def test_cancel(self):
+        running_id = self.queue.put('tasks.sync', (1,))
+        queued_id = self.queue.put('tasks.sync', (2,))
+        self.assertEqual(self.claim_ids(), [running_id])
+
+        self.assertEqual(self.queue.cancel(queued_id), 'cancelled')
+        self.assertEqual(self.queue.get_task(queued_id)['status'], 'cancelled')
+
+        # Running tasks are asked to stop, and their worker marks them
+        self.assertEqual(self.queue.cancel(running_id), 'cancelling')
+        self.assertEqual(self.queue.get_cancel_requests('worker-1'), {running_id})
+        self.queue.mark_cancelled(running_id)
+        self.assertEqual(self.queue.get_task(running_id)['status'], 'cancelled')
+
+        self.assertIsNone(self.queue.cancel(running_id))
+        self.assertIsNone(self.queue.cancel(12345))
+
+    def test_cancelling_tasks_of_dead_workers_are_cancelled(self):
+        task_id = self.queue.put('tasks.sync')
+        self.claim_ids()
+        self.queue.cancel(task_id)
+
+        # Rather than retried, once the lease runs out
+        self.clock.advance(61)
+        self.assertEqual(self.claim_ids('worker-2'), [])
+        self.assertEqual(self.queue.get_task(task_id)['status'], 'cancelled')
+
+    def test_recover_requeues_interrupted_tasks(self):
+        interrupted_id = self.queue.put('tasks.sync', (1,))
+        cancelling_id = self.queue.put('tasks.sync', (2,))
+        self.claim_ids(limit=2)
+        self.queue.cancel(cancelling_id)
+
+        self.queue.recover()
+        self.assertEqual(self.queue.get_task(interrupted_id)['status'], 'queued')
+        self.assertEqual(self.queue.get_task(cancelling_id)['status'], 'cancelled')
+        self.assertEqual(self.claim_ids(limit=2), [interrupted_id])
+
+    def test_claim_limits_sync_tasks(self):
+        sync_ids = [self.queue.put('tasks.sync', (i,)) for i in range(3)]
+        async_ids = [self.queue.put('tasks.async_fetch', (i,)) for i in range(3)]
+        is_async = lambda task_name: task_name == 'tasks.async_fetch'
+
+        # One sync thread free: one sync task, the rest of the batch async
+        self.assertEqual(self.claim_ids(limit=4, max_sync=1, is_async=is_async), sync_ids[:1] + async_ids)
+        self.assertEqual(self.claim_ids(limit=4, max_sync=0, is_async=is_async), [])
+        self.assertEqual(self.claim_ids(limit=4, max_sync=2, is_async=is_async), sync_ids[1:])
+
+    def test_finished_tasks_are_pruned_down_to_the_history_size(self):
+        self.queue.history_size = 2
+        task_ids = [self.queue.put('tasks.sync', (i,)) for i in range(5)]
+        for task_id in self.claim_ids(limit=5):
+            self.queue.complete(task_id)
+        self.queue.prune()
+
+        self.assertEqual([self.queue.get_task(task_id) is not None for task_id in task_ids], [False, False, False, True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()